@@ -3,18 +3,36 @@
 功能说明：Flask应用工厂
 核心功能：初始化Flask应用，注册蓝图，配置CORS
 """
-from flask import Flask
+import logging
+
+from flask import Flask, Request
 from flask_cors import CORS
 from .config import Config
 from .extensions import mongo
-from .api.blueprint_api import blueprint_bp
+from .api.blueprint_api import blueprint_bp, job_service
 # 导入新增的 API
 from .api.auth_api import auth_bp
 from .api.feedback_api import feedback_bp
 from .api.dashboard_api import dashboard_bp
+from .cli import register_commands
+from .services.schema_service import SchemaError, bootstrap_schema
+from .utils.upload_spool import HashingSpoolFile
+
+logger = logging.getLogger(__name__)
+
+
+class SpoolingRequest(Request):
+    """
+    上传文件在 multipart 解析时直接写入暂存目录并计算摘要，接口中由 SpooledUpload 接管，不再复制一遍
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingSpoolFile(Config.UPLOAD_SPOOL_DIR)
+
 
 def create_app(config_class=Config):
     app = Flask(__name__)
+    app.request_class = SpoolingRequest
     app.config.from_object(config_class)
     
     # 初始化扩展
@@ -29,5 +47,29 @@ def create_app(config_class=Config):
     app.register_blueprint(auth_bp, url_prefix='/api/v1/auth')
     app.register_blueprint(feedback_bp, url_prefix='/api/v1/feedback')
     app.register_blueprint(dashboard_bp, url_prefix='/api/v1/dashboard')
+
+    # 索引初始化：默认仅记录失败；开启查询计划校验时任何问题都会中止启动
+    if app.config.get("DB_ENSURE_INDEXES"):
+        verify = app.config.get("DB_VERIFY_QUERY_PLANS")
+        try:
+            bootstrap_schema(mongo.db, verify=verify)
+        except SchemaError:
+            if verify:
+                raise
+            logger.exception("Index bootstrap failed")
+        except Exception as e:
+            # 开启校验时无法连接数据库同样中止启动，否则校验形同虚设
+            if verify:
+                raise
+            logger.error(f"Index bootstrap skipped, database unavailable: {str(e)}")
+
+    # 上次运行中断、已无心跳的任务标记为失败，避免回放接口无限等待
+    try:
+        job_service.fail_stale_jobs()
+    except Exception as e:
+        logger.error(f"Stale job check skipped, database unavailable: {str(e)}")
+
+    # 注册运维命令（flask --app run history migrate 等）
+    register_commands(app)
     
     return app
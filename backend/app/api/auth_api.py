@@ -1,12 +1,12 @@
 # 文件名：auth_api.py
 """
 功能说明：用户认证API
-核心功能：用户注册/登录（基于用户名 + 浏览器指纹）
-依赖模块：flask, pymongo
+核心功能：用户注册/登录（基于用户名 + 浏览器指纹），签发会话令牌
+依赖模块：flask, auth_service
 """
 from flask import Blueprint, request, jsonify
-from app.extensions import mongo
-from datetime import datetime
+from app.services.activity_service import EVENT_LOGIN, record_activity
+from app.services.auth_service import login_or_register, session_manager
 import logging
 
 auth_bp = Blueprint('auth', __name__)
@@ -21,9 +21,9 @@ def login():
       - fingerprint: 浏览器指纹
     逻辑：
       1. 如果用户名不存在 -> 注册新用户 (绑定指纹)
-      2. 如果用户名存在：
-         - 指纹匹配 -> 登录成功
-         - 指纹不匹配 -> 登录失败 (用户名已被占用)
+      2. 如果用户名存在 -> 登录成功，更新为当前设备指纹（多端登录）
+      查找 / 注册 / 更新为一次原子操作
+    返回：user_id、username、session_token（后续请求通过 Authorization: Bearer 携带；未配置 SECRET_KEY 时为 null）
     """
     data = request.json
     username = data.get('username')
@@ -32,43 +32,20 @@ def login():
     if not username or not fingerprint:
         return jsonify({"code": 400, "message": "Username and fingerprint are required", "data": None}), 400
 
-    users_collection = mongo.db.users
-    
-    # 查找用户
-    user = users_collection.find_one({"username": username})
+    try:
+        user, created = login_or_register(username, fingerprint)
+    except Exception as e:
+        logger.error(f"Login failed: {str(e)}")
+        return jsonify({"code": 500, "message": str(e), "data": None}), 500
 
-    if user:
-        # 用户已存在，允许任意指纹登录（多端登录）
-        # 更新指纹信息和最后登录时间
-        users_collection.update_one(
-            {"_id": user["_id"]},
-            {"$set": {
-                "last_login": datetime.utcnow(),
-                "fingerprint": fingerprint # 更新为当前设备的指纹
-            }}
-        )
-        return jsonify({
-            "code": 200, 
-            "message": "Login success", 
-            "data": {
-                "user_id": str(user["_id"]),
-                "username": user["username"]
-            }
-        })
-    else:
-        # 用户不存在，注册新用户
-        new_user = {
-            "username": username,
-            "fingerprint": fingerprint,
-            "created_at": datetime.utcnow(),
-            "last_login": datetime.utcnow()
+    user_id = str(user["_id"])
+    record_activity(EVENT_LOGIN, user_id=user_id, endpoint="auth.register" if created else "auth.login")
+    return jsonify({
+        "code": 200,
+        "message": "Register success" if created else "Login success",
+        "data": {
+            "user_id": user_id,
+            "username": user["username"],
+            "session_token": session_manager.issue(user_id, user["username"]) if session_manager else None
         }
-        result = users_collection.insert_one(new_user)
-        return jsonify({
-            "code": 200, 
-            "message": "Register success", 
-            "data": {
-                "user_id": str(result.inserted_id),
-                "username": username
-            }
-        })
+    })
@@ -9,10 +9,23 @@
 5. 返回SSE流式响应
 依赖模块：flask, analysis_service
 """
-from flask import Blueprint, request, Response, stream_with_context, jsonify, send_file
+from flask import Blueprint, request, Response, stream_with_context, jsonify, send_file, url_for
 from app.services.analysis_service import AnalysisService
+from app.services.auth_service import extract_session_token, resolve_user, session_manager
+from app.services.job_service import JobQueueFullError, JobService
+from app.services.artifact_service import (
+    DOCX_MIMETYPE, HISTORY_PROJECTION, KIND_DOCX, KIND_MINDMAP, MINDMAP_MIMETYPE,
+    get_artifact_stats, get_history_docx, is_history_ready, lookup_artifact, recorded_key, stream_history_mindmap
+)
+from app.services.activity_service import EVENT_ANALYSIS, activity_rollups, record_activity
+from app.services.dashboard_service import dashboard_snapshots
+from app.services.telemetry_service import enqueue_usage_log, get_telemetry_stats
+from app.services.stats_service import book_stats_counter, record_book_usage
+from app.services.history_service import HistoryWriter, count_user_histories, list_user_histories, load_history_content
 from app.extensions import mongo
 from app.utils.docx_generator import generate_blueprint_docx
+from app.utils.upload_spool import SpooledUpload
+from app.config import Config
 from datetime import datetime
 from bson import ObjectId
 import logging
@@ -26,52 +39,13 @@ STREAM_DONE_MARKER = "\n\n[[__STREAM_DONE__]]\n\n"
 # 初始化 Service
 # 注意：在实际生产中，建议使用依赖注入或在请求上下文中获取
 analysis_service = AnalysisService()
-
-def _build_preview(text: str, max_len: int = 400) -> str:
-    if not text:
-        return ""
-    t = text.strip()
-    if len(t) <= max_len:
-        return t
-    return t[:max_len] + "..."
-
-def _save_analysis_history(
-    *,
-    user_id: str,
-    username: str,
-    role: str,
-    file_name: str,
-    custom_prompt: str,
-    methodologies: list,
-    custom_methodologies: list,
-    content: str
-):
-    if not user_id:
-        return
-
-    safe_content = content or ""
-    truncated = False
-    max_chars = 2_000_000
-    if len(safe_content) > max_chars:
-        safe_content = safe_content[:max_chars]
-        truncated = True
-
-    doc = {
-        "user_id": user_id,
-        "username": username,
-        "role": role,
-        "action": "analyze_blueprint",
-        "filename": file_name,
-        "custom_prompt": custom_prompt,
-        "methodologies": methodologies or [],
-        "custom_methodologies": custom_methodologies or [],
-        "content": safe_content,
-        "content_preview": _build_preview(safe_content),
-        "content_length": len(content or ""),
-        "content_truncated": truncated,
-        "created_at": datetime.utcnow()
-    }
-    mongo.db.analysis_histories.insert_one(doc)
+job_service = JobService(
+    max_workers=Config.JOB_MAX_WORKERS,
+    log_size_bytes=Config.JOB_LOG_MAX_BYTES,
+    max_queue=Config.JOB_MAX_QUEUE,
+    heartbeat_interval=Config.JOB_HEARTBEAT_INTERVAL,
+    stale_after=Config.JOB_STALE_SECONDS
+)
 
 DEPARTMENT_DEFAULT_BOOKS = {
     "president_office": [
@@ -132,23 +106,48 @@ def _get_department_default_books(department: str) -> list:
         dept = "all"
     return DEPARTMENT_DEFAULT_BOOKS.get(dept, [])
 
-@blueprint_bp.route('/analyze', methods=['POST'])
-def analyze():
+def _parse_optional_bool(value):
     """
-    POST /api/v1/blueprint/analyze
-    接收文件、提示词、方法论，并进行流式分析
+    解析可选的布尔表单参数：未传递时返回 None（由服务端配置决定）
+    """
+    if value is None or value == '':
+        return None
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+def _resolve_user_id(claimed_user_id: str = None):
+    """
+    按会话令牌确定请求方用户ID（令牌校验走进程内缓存，不访问数据库）
+    :return: (用户ID, 错误响应)
+    """
+    token = extract_session_token(request.headers, request.values)
+    user_id, error = resolve_user(claimed_user_id, token)
+    if error:
+        status, message = error
+        return None, (jsonify({"code": status, "message": message, "data": None}), status)
+    return user_id, None
+
+def _get_requester_key(user_id: str = None) -> str:
+    """
+    LLM 调度使用的请求方标识：优先使用 user_id，未传递时使用客户端地址（经 Nginx 反代时取 X-Real-IP）
+    """
+    return user_id or request.headers.get('X-Real-IP') or request.remote_addr or 'anonymous'
+
+def _parse_analyze_request():
+    """
+    解析并校验分析请求的表单参数
+    :return: (参数字典, 错误响应)；校验通过时错误响应为 None
     """
     if 'file' not in request.files:
-        return jsonify({"code": 400, "message": "No file part", "data": None}), 400
+        return None, (jsonify({"code": 400, "message": "No file part", "data": None}), 400)
         
     file = request.files['file']
     custom_prompt = request.form.get('custom_prompt', '') # 获取用户自定义提示词
-    user_id = request.form.get('user_id')
+    user_id, error_response = _resolve_user_id(request.form.get('user_id'))
+    if error_response:
+        return None, error_response
     username = request.form.get('username')
     role = request.form.get('role', 'all') # 获取用户部门
-    
-    if user_id:
-        pass # Log logic moved to generate()
+    long_document = _parse_optional_bool(request.form.get('long_document')) # 是否开启长文档模式
 
     # 获取方法论选择 (前端可能传递为 'huawei,alibaba' 或多次传递 'methodologies')
     # 处理 multipart/form-data 中的数组
@@ -160,102 +159,162 @@ def analyze():
     custom_methodologies = _get_department_default_books(role)
 
     if len(methodologies) == 0 and len(custom_methodologies) == 0:
-        return jsonify({"code": 400, "message": "请至少选择系统内置方法论", "data": None}), 400
+        return None, (jsonify({"code": 400, "message": "请至少选择系统内置方法论", "data": None}), 400)
     
     if file.filename == '':
-        return jsonify({"code": 400, "message": "No selected file", "data": None}), 400
+        return None, (jsonify({"code": 400, "message": "No selected file", "data": None}), 400)
+
+    return {
+        "file": file,
+        "file_name": file.filename,
+        "custom_prompt": custom_prompt,
+        "user_id": user_id,
+        "username": username,
+        "role": role,
+        "methodologies": methodologies,
+        "custom_methodologies": custom_methodologies,
+        "long_document": long_document
+    }, None
+
+def _run_analysis_pipeline(
+    file_content,
+    *,
+    file_name: str,
+    custom_prompt: str,
+    user_id: str,
+    username: str,
+    role: str,
+    methodologies: list,
+    custom_methodologies: list,
+    long_document: bool = None,
+    endpoint: str = "blueprint.analyze"
+):
+    """
+    蓝图分析流水线：调用 Service 流式分析，记录使用日志/书籍统计/活跃度汇总，结束后保存历史记录
+    同步 SSE 接口与异步任务共用
+    :param endpoint: 发起分析的接口名（用于按接口统计）
+    """
+    # 准备日志数据
+    log_data = {
+        "user_id": user_id,
+        "username": username,
+        "role": role,
+        "action": "analyze_blueprint",
+        "filename": file_name,
+        "custom_prompt": custom_prompt,
+        "created_at": datetime.utcnow()
+    }
+
+    # 输出边生成边分段写入历史记录，内存占用与报告长度无关，进程中断时已输出部分也会保留
+    history_writer = None
+    if user_id:
+        history_writer = HistoryWriter(
+            {
+                "user_id": user_id,
+                "username": username,
+                "role": role,
+                "action": "analyze_blueprint",
+                "filename": file_name,
+                "custom_prompt": custom_prompt,
+                "methodologies": methodologies or [],
+                "custom_methodologies": custom_methodologies or []
+            },
+            segment_chars=Config.HISTORY_SEGMENT_CHARS,
+            flush_interval=Config.HISTORY_FLUSH_INTERVAL,
+            finalize_wait=Config.HISTORY_FINALIZE_WAIT_SECONDS
+        )
+
+    def capture(chunk: str):
+        if history_writer is None:
+            return
+        try:
+            history_writer.write(chunk)
+        except Exception as e:
+            logger.error(f"Failed to persist analysis history segment: {str(e)}")
 
     try:
-        file_name = file.filename
-        
-        # 准备日志数据
-        log_data = {
-            "user_id": user_id,
-            "username": username,
-            "role": role,
-            "action": "analyze_blueprint",
-            "filename": file_name,
-            "custom_prompt": custom_prompt,
-            "created_at": datetime.utcnow()
-        }
-        
+        # 相同文件与参数的并发请求共享一次分析，每个请求仍各自保存历史记录
+        generator = analysis_service.analyze_blueprint_coalesced(
+            file_content,
+            file_name,
+            custom_prompt,
+            methodologies,
+            custom_methodologies,
+            long_document=long_document,
+            user_id=user_id,
+            role=role
+        )
+
+        first_chunk = None
+        try:
+            first_chunk = next(generator)
+        except StopIteration:
+            return
+        except Exception as e:
+            logger.error(f"Error starting analysis: {str(e)}")
+            yield f"\n\n**系统错误**: {str(e)}"
+            return
+
+        if first_chunk and first_chunk.strip() != "🔄 正在解析文档内容，请稍候...":
+            yield first_chunk
+            capture(first_chunk)
+
+        if user_id:
+            try:
+                enqueue_usage_log(log_data)
+                # 书籍计数只做内存累加，由后台批量写入 book_stats
+                record_book_usage(custom_methodologies, role)
+                record_activity(EVENT_ANALYSIS, user_id=user_id, role=role, endpoint=endpoint)
+            except Exception as e:
+                logger.error(f"Failed to log usage: {str(e)}")
+
+        for chunk in generator:
+            yield chunk
+            if chunk:
+                capture(chunk)
+    except Exception as e:
+        logger.error(f"Error during analysis stream: {str(e)}")
+        err_chunk = f"\n\n**系统错误**: {str(e)}"
+        yield err_chunk
+        capture(err_chunk)
+    finally:
+        if history_writer is not None:
+            try:
+                # 等待落库与压缩保存在后台执行，响应结束不等待写入队列
+                history_writer.finalize_in_background()
+            except Exception as e:
+                logger.error(f"Failed to save analysis history: {str(e)}")
+
+@blueprint_bp.route('/analyze', methods=['POST'])
+def analyze():
+    """
+    POST /api/v1/blueprint/analyze
+    接收文件、提示词、方法论，并进行流式分析
+    """
+    params, error_response = _parse_analyze_request()
+    if error_response:
+        return error_response
+
+    try:
+        file = params.pop("file")
+
         # 定义生成器函数
         def generate():
-            captured_chunks = []
+            upload = None
             try:
                 yield "🔄 正在解析文档内容，请稍候...\n\n"
 
-                file_content = file.read()
-
-                generator = analysis_service.analyze_blueprint(
-                    file_content,
-                    file_name,
-                    custom_prompt,
-                    methodologies,
-                    custom_methodologies
-                )
-
-                first_chunk = None
-                try:
-                    first_chunk = next(generator)
-                except StopIteration:
-                    return
-                except Exception as e:
-                    logger.error(f"Error starting analysis: {str(e)}")
-                    yield f"\n\n**系统错误**: {str(e)}"
-                    return
-
-                if first_chunk and first_chunk.strip() != "🔄 正在解析文档内容，请稍候...":
-                    yield first_chunk
-                    captured_chunks.append(first_chunk)
-
-                if user_id:
-                    try:
-                        mongo.db.usage_logs.insert_one(log_data)
-
-                        if custom_methodologies:
-                            for book in custom_methodologies:
-                                if book and book.strip():
-                                    mongo.db.book_stats.update_one(
-                                        {"book_name": book.strip(), "role": "all"},
-                                        {"$inc": {"count": 1}, "$set": {"last_used_at": datetime.utcnow()}},
-                                        upsert=True
-                                    )
-                                    if role and role != 'unknown':
-                                        mongo.db.book_stats.update_one(
-                                            {"book_name": book.strip(), "role": role},
-                                            {"$inc": {"count": 1}, "$set": {"last_used_at": datetime.utcnow()}},
-                                            upsert=True
-                                        )
-                    except Exception as e:
-                        logger.error(f"Failed to log usage: {str(e)}")
+                # 分块落盘并计算摘要，避免将整个文件读入内存
+                upload = SpooledUpload.from_file_storage(file, Config.UPLOAD_SPOOL_DIR)
 
-                for chunk in generator:
+                for chunk in _run_analysis_pipeline(upload, **params):
                     yield chunk
-                    if chunk:
-                        captured_chunks.append(chunk)
             except Exception as e:
                 logger.error(f"Error during analysis stream: {str(e)}")
-                err_chunk = f"\n\n**系统错误**: {str(e)}"
-                yield err_chunk
-                captured_chunks.append(err_chunk)
+                yield f"\n\n**系统错误**: {str(e)}"
             finally:
-                if user_id:
-                    try:
-                        content = "".join(captured_chunks).replace(STREAM_DONE_MARKER, "")
-                        if content.strip():
-                            _save_analysis_history(
-                                user_id=user_id,
-                                username=username,
-                                role=role,
-                                file_name=file_name,
-                                custom_prompt=custom_prompt,
-                                methodologies=methodologies,
-                                custom_methodologies=custom_methodologies,
-                                content=content
-                            )
-                    except Exception as e:
-                        logger.error(f"Failed to save analysis history: {str(e)}")
+                if upload is not None:
+                    upload.close()
                 yield STREAM_DONE_MARKER
 
         # 返回流式响应
@@ -272,9 +331,140 @@ def analyze():
         logger.error(f"API Error: {str(e)}")
         return jsonify({"code": 500, "message": str(e), "data": None}), 500
 
+@blueprint_bp.route('/jobs/analyze', methods=['POST'])
+def submit_analyze_job():
+    """
+    POST /api/v1/blueprint/jobs/analyze
+    以异步任务方式提交蓝图分析（参数同 /analyze），立即返回任务ID
+    通过 GET /jobs/<job_id>/stream 获取输出，断线后可携带 Last-Event-ID 续传
+    """
+    params, error_response = _parse_analyze_request()
+    if error_response:
+        return error_response
+    # 任务输出按任务ID回放，须绑定请求方身份（已由会话令牌校验）
+    if not params.get("user_id"):
+        return jsonify({"code": 400, "message": "user_id is required", "data": None}), 400
+
+    try:
+        file = params.pop("file")
+        upload = SpooledUpload.from_file_storage(file, Config.UPLOAD_SPOOL_DIR)
+        try:
+            job_id = job_service.submit(
+                "analyze_blueprint",
+                params.get("user_id"),
+                lambda: _run_analysis_pipeline(upload, endpoint="blueprint.jobs.analyze", **params),
+                on_finish=upload.close
+            )
+        except JobQueueFullError as e:
+            upload.close()
+            logger.warning(f"Analysis job rejected: {str(e)}")
+            return jsonify({"code": 503, "message": "任务队列已满，请稍后重试", "data": None}), 503
+        return jsonify({
+            "code": 200,
+            "message": "success",
+            "data": {
+                "job_id": job_id,
+                "stream_url": url_for('blueprint.stream_job', job_id=job_id, user_id=params.get("user_id"))
+            }
+        })
+    except Exception as e:
+        logger.error(f"Submit job Error: {str(e)}")
+        return jsonify({"code": 500, "message": str(e), "data": None}), 500
+
+def _serialize_job(job: dict) -> dict:
+    return {
+        "job_id": str(job.get("_id")),
+        "kind": job.get("kind"),
+        "status": job.get("status"),
+        "last_event_id": job.get("last_seq", 0),
+        "error": job.get("error"),
+        "created_at": job.get("created_at").isoformat() if job.get("created_at") else None,
+        "finished_at": job.get("finished_at").isoformat() if job.get("finished_at") else None
+    }
+
+def _get_requester_job(job_id: str):
+    """
+    读取请求方自己的任务；任务不存在或属于其他用户时统一返回 404（不暴露任务是否存在）
+    :return: (任务, 错误响应)
+    """
+    user_id, error_response = _resolve_user_id(request.args.get('user_id'))
+    if error_response:
+        return None, error_response
+    job = job_service.get_job(job_id)
+    if not job or not user_id or job.get("user_id") != user_id:
+        return None, (jsonify({"code": 404, "message": "not found", "data": None}), 404)
+    return job, None
+
+@blueprint_bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id: str):
+    """
+    GET /api/v1/blueprint/jobs/<job_id>
+    查询任务状态（参数：user_id，或携带会话令牌）
+    """
+    job, error_response = _get_requester_job(job_id)
+    if error_response:
+        return error_response
+    return jsonify({"code": 200, "message": "success", "data": _serialize_job(job)})
+
+def _format_sse_event(event_id: int, data: str, event: str = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    # 多行数据需拆分为多个 data 字段
+    for line in data.split("\n"):
+        lines.append(f"data: {line}")
+    return "\n".join(lines) + "\n\n"
+
+@blueprint_bp.route('/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id: str):
+    """
+    GET /api/v1/blueprint/jobs/<job_id>/stream
+    以标准 SSE 格式回放任务输出并跟随实时内容
+    续传：请求头 Last-Event-ID（或查询参数 last_event_id）为已收到的最后事件ID
+    身份：查询参数 user_id 或 session_token（EventSource 无法设置请求头）
+    """
+    job, error_response = _get_requester_job(job_id)
+    if error_response:
+        return error_response
+
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_event_id = 0
+
+    def generate():
+        try:
+            for event_id, data in job_service.stream_events(job_id, last_event_id):
+                if event_id is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield _format_sse_event(event_id, data)
+            final_job = job_service.get_job(job_id) or {}
+            yield _format_sse_event(None, final_job.get("status", ""), event="done")
+        except Exception as e:
+            logger.error(f"Error during job stream: {str(e)}")
+            yield _format_sse_event(None, str(e), event="error")
+
+    return Response(
+        stream_with_context(generate()),
+        content_type='text/event-stream; charset=utf-8',
+        headers={
+            'X-Accel-Buffering': 'no',
+            'Cache-Control': 'no-cache'
+        }
+    )
+
 @blueprint_bp.route('/history', methods=['GET'])
 def get_history_list():
-    user_id = request.args.get('user_id')
+    """
+    GET /api/v1/blueprint/history
+    参数：user_id（必填）、page_size、cursor（续页令牌，推荐）、page（兼容页码分页）、with_total（游标模式下是否返回总数）
+    """
+    user_id, error_response = _resolve_user_id(request.args.get('user_id'))
+    if error_response:
+        return error_response
     if not user_id:
         return jsonify({"code": 400, "message": "user_id is required", "data": None}), 400
 
@@ -290,31 +480,30 @@ def get_history_list():
         page = 1
         page_size = 10
 
-    query = {"user_id": user_id}
-    total = mongo.db.analysis_histories.count_documents(query)
-    cursor = (
-        mongo.db.analysis_histories.find(
-            query,
-            {
-                "content": 0
-            }
-        )
-        .sort("created_at", -1)
-        .skip((page - 1) * page_size)
-        .limit(page_size)
-    )
+    cursor = request.args.get('cursor') or None
+    # 页码模式保持原有响应（含 total）；游标模式下总数按需返回
+    with_total = _parse_optional_bool(request.args.get('with_total'))
+    if with_total is None:
+        with_total = cursor is None
+
+    try:
+        docs, next_cursor = list_user_histories(user_id, page_size, cursor=cursor, page=None if cursor else page)
+    except ValueError:
+        return jsonify({"code": 400, "message": "invalid cursor", "data": None}), 400
 
     items = []
-    for doc in cursor:
+    for doc in docs:
         items.append({
             "id": str(doc.get("_id")),
             "action": doc.get("action"),
             "filename": doc.get("filename"),
             "role": doc.get("role"),
             "created_at": doc.get("created_at").isoformat() if doc.get("created_at") else None,
-            "content_preview": doc.get("content_preview", ""),
-            "content_length": doc.get("content_length", 0),
-            "content_truncated": doc.get("content_truncated", False)
+            # 列表由索引覆盖，缺失的字段返回 null（而非不存在），需按空值取默认值
+            "content_preview": doc.get("content_preview") or "",
+            "content_length": doc.get("content_length") or 0,
+            "content_truncated": bool(doc.get("content_truncated")),
+            "status": doc.get("status") or "done"
         })
 
     return jsonify({
@@ -322,15 +511,19 @@ def get_history_list():
         "message": "success",
         "data": {
             "items": items,
-            "total": total,
+            "total": count_user_histories(user_id) if with_total else None,
             "page": page,
-            "page_size": page_size
+            "page_size": page_size,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None
         }
     })
 
 @blueprint_bp.route('/history/<history_id>', methods=['GET'])
 def get_history_detail(history_id: str):
-    user_id = request.args.get('user_id')
+    user_id, error_response = _resolve_user_id(request.args.get('user_id'))
+    if error_response:
+        return error_response
     if not user_id:
         return jsonify({"code": 400, "message": "user_id is required", "data": None}), 400
 
@@ -343,6 +536,13 @@ def get_history_detail(history_id: str):
     if not doc:
         return jsonify({"code": 404, "message": "not found", "data": None}), 404
 
+    try:
+        content = load_history_content(doc)
+    except ValueError as e:
+        # 分段缺失或压缩格式无法识别：按 JSON 返回错误，不让前端收到 HTML 500
+        logger.error(f"History content Error ({history_id}): {str(e)}")
+        return jsonify({"code": 500, "message": str(e), "data": None}), 500
+
     data = {
         "id": str(doc.get("_id")),
         "action": doc.get("action"),
@@ -352,13 +552,138 @@ def get_history_detail(history_id: str):
         "custom_prompt": doc.get("custom_prompt", ""),
         "methodologies": doc.get("methodologies", []),
         "custom_methodologies": doc.get("custom_methodologies", []),
-        "content": doc.get("content", ""),
+        "content": content,
         "content_length": doc.get("content_length", 0),
-        "content_truncated": doc.get("content_truncated", False)
+        "content_truncated": doc.get("content_truncated", False),
+        "status": doc.get("status", "done")
     }
 
     return jsonify({"code": 200, "message": "success", "data": data})
 
+def _load_history_for_artifact(history_id: str):
+    """
+    校验请求方并读取已完成的历史摘要（不含内联正文），供派生文件接口使用
+    :return: (历史摘要, 错误响应)
+    """
+    user_id, error_response = _resolve_user_id(request.args.get('user_id'))
+    if error_response:
+        return None, error_response
+    if not user_id:
+        return None, (jsonify({"code": 400, "message": "user_id is required", "data": None}), 400)
+
+    try:
+        oid = ObjectId(history_id)
+    except Exception:
+        return None, (jsonify({"code": 400, "message": "invalid history_id", "data": None}), 400)
+
+    doc = mongo.db.analysis_histories.find_one({"_id": oid, "user_id": user_id}, HISTORY_PROJECTION)
+    if not doc:
+        return None, (jsonify({"code": 404, "message": "not found", "data": None}), 404)
+    if not is_history_ready(doc):
+        return None, (jsonify({"code": 409, "message": "history is still being generated", "data": None}), 409)
+    return doc, None
+
+def _not_modified(key: str = None):
+    """
+    客户端缓存的 ETag 与历史记录上记录的派生文件键一致时直接返回 304（不读取正文与文件）
+    """
+    if not key or not request.if_none_match.contains(key):
+        return None
+    response = Response(status=304)
+    response.set_etag(key)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def _send_artifact(artifact, mimetype: str, download_name: str = None):
+    """
+    以静态文件方式下发派生文件：ETag 为内容键，支持 If-None-Match；磁盘存储时同时支持 Range
+    """
+    response = send_file(
+        artifact.path or artifact.stream,
+        mimetype=mimetype,
+        as_attachment=download_name is not None,
+        download_name=download_name,
+        etag=artifact.key,
+        conditional=True
+    )
+    if artifact.path is None and response.status_code == 200:
+        response.content_length = artifact.length
+    # 同一地址的内容可能随生成器版本变化：允许私有缓存，但每次使用前按 ETag 重新验证
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@blueprint_bp.route('/history/<history_id>/export/docx', methods=['GET'])
+def export_history_docx(history_id: str):
+    """
+    GET /api/v1/blueprint/history/<history_id>/export/docx
+    参数：user_id（必填）、filename（下载文件名）
+    按历史记录导出 Word：首次请求生成并保存，之后直接下发已保存的文件
+    """
+    doc, error_response = _load_history_for_artifact(history_id)
+    if error_response:
+        return error_response
+    not_modified = _not_modified(recorded_key(doc, KIND_DOCX))
+    if not_modified:
+        return not_modified
+
+    try:
+        artifact = get_history_docx(doc)
+        if artifact is None:
+            return jsonify({"code": 404, "message": "history has no content", "data": None}), 404
+        filename = request.args.get('filename') or '蓝图大师评审报告.docx'
+        return _send_artifact(artifact, DOCX_MIMETYPE, download_name=filename)
+    except Exception as e:
+        logger.error(f"History export Error: {str(e)}")
+        return jsonify({"code": 500, "message": str(e), "data": None}), 500
+
+@blueprint_bp.route('/history/<history_id>/mindmap', methods=['GET'])
+def get_history_mindmap(history_id: str):
+    """
+    GET /api/v1/blueprint/history/<history_id>/mindmap
+    参数：user_id（必填）
+    按历史记录生成思维导图：已保存时返回 Markmap Markdown（带 ETag / Content-Length）；
+    首次请求与 /generate_mindmap 相同方式流式输出，结束后保存
+    """
+    doc, error_response = _load_history_for_artifact(history_id)
+    if error_response:
+        return error_response
+    not_modified = _not_modified(recorded_key(doc, KIND_MINDMAP))
+    if not_modified:
+        return not_modified
+
+    try:
+        key, artifact, source = lookup_artifact(doc, KIND_MINDMAP)
+        if artifact is not None:
+            return _send_artifact(artifact, MINDMAP_MIMETYPE)
+        if not key:
+            return jsonify({"code": 404, "message": "history has no content", "data": None}), 404
+
+        requester = _get_requester_key(doc.get("user_id"))
+
+        def generate():
+            try:
+                for chunk in stream_history_mindmap(doc["_id"], key, source, analysis_service.generate_mindmap, user_id=requester):
+                    yield chunk
+            except Exception as e:
+                logger.error(f"Error during history mindmap stream: {str(e)}")
+                yield f"\n\n**系统错误**: {str(e)}"
+            finally:
+                yield STREAM_DONE_MARKER
+
+        return Response(
+            stream_with_context(generate()),
+            content_type='text/event-stream; charset=utf-8',
+            headers={
+                'X-Accel-Buffering': 'no',
+                'Cache-Control': 'no-cache'
+            }
+        )
+    except Exception as e:
+        logger.error(f"History mindmap Error: {str(e)}")
+        return jsonify({"code": 500, "message": str(e), "data": None}), 500
+
 @blueprint_bp.route('/analyze_mindmap', methods=['POST'])
 def analyze_mindmap():
     """
@@ -374,14 +699,16 @@ def analyze_mindmap():
         return jsonify({"code": 400, "message": "No selected file", "data": None}), 400
 
     try:
-        file_content = file.read()
+        file_content = SpooledUpload.from_file_storage(file, Config.UPLOAD_SPOOL_DIR)
         file_name = file.filename
+        requester = _get_requester_key(request.form.get('user_id'))
         
         def generate():
             try:
                 generator = analysis_service.analyze_blueprint_to_mindmap(
                     file_content,
-                    file_name
+                    file_name,
+                    user_id=requester
                 )
                 for chunk in generator:
                     yield chunk
@@ -391,7 +718,7 @@ def analyze_mindmap():
             finally:
                 yield STREAM_DONE_MARKER
 
-        return Response(
+        response = Response(
             stream_with_context(generate()),
             content_type='text/event-stream; charset=utf-8',
             headers={
@@ -399,6 +726,9 @@ def analyze_mindmap():
                 'Cache-Control': 'no-cache' # 禁用浏览器/代理缓存
             }
         )
+        # 响应结束（含客户端断开）后删除暂存文件
+        response.call_on_close(file_content.close)
+        return response
     except Exception as e:
         logger.error(f"Error starting mindmap analysis: {str(e)}")
         return jsonify({"code": 500, "message": str(e), "data": None}), 500
@@ -418,14 +748,16 @@ def smart_mindmap():
         return jsonify({"code": 400, "message": "No selected file", "data": None}), 400
 
     try:
-        file_content = file.read()
+        file_content = SpooledUpload.from_file_storage(file, Config.UPLOAD_SPOOL_DIR)
         file_name = file.filename
+        requester = _get_requester_key(request.form.get('user_id'))
         
         def generate():
             try:
                 generator = analysis_service.generate_smart_mindmap(
                     file_content,
-                    file_name
+                    file_name,
+                    user_id=requester
                 )
                 for chunk in generator:
                     yield chunk
@@ -435,7 +767,7 @@ def smart_mindmap():
             finally:
                 yield STREAM_DONE_MARKER
 
-        return Response(
+        response = Response(
             stream_with_context(generate()),
             content_type='text/event-stream; charset=utf-8',
             headers={
@@ -443,6 +775,9 @@ def smart_mindmap():
                 'Cache-Control': 'no-cache' # 禁用浏览器/代理缓存
             }
         )
+        # 响应结束（含客户端断开）后删除暂存文件
+        response.call_on_close(file_content.close)
+        return response
     except Exception as e:
         logger.error(f"Error starting smart mindmap analysis: {str(e)}")
         return jsonify({"code": 500, "message": str(e), "data": None}), 500
@@ -460,9 +795,11 @@ def generate_mindmap():
         return jsonify({"code": 400, "message": "Content is required", "data": None}), 400
         
     try:
+        requester = _get_requester_key(data.get('user_id'))
+
         def generate():
             try:
-                for chunk in analysis_service.generate_mindmap(markdown_content):
+                for chunk in analysis_service.generate_mindmap(markdown_content, user_id=requester):
                     yield chunk
             except Exception as e:
                 logger.error(f"Error during mindmap generation stream: {str(e)}")
@@ -494,12 +831,14 @@ def generate_proposal():
         client_needs = data.get('client_needs', '')
         user_ideas = data.get('user_ideas', '')
         role = data.get('role', 'all')
+        user_id = data.get('user_id')
         methodologies = data.get('methodologies', [])
         custom_methodologies = _get_department_default_books(role)
     else:
         client_needs = request.form.get('client_needs', '')
         user_ideas = request.form.get('user_ideas', '')
         role = request.form.get('role', 'all')
+        user_id = request.form.get('user_id')
         methodologies = request.form.getlist('methodologies')
         if len(methodologies) == 1 and ',' in methodologies[0]:
             methodologies = methodologies[0].split(',')
@@ -516,10 +855,11 @@ def generate_proposal():
         return jsonify({"code": 400, "message": "请至少选择系统内置方法论", "data": None}), 400
         
     try:
+        requester = _get_requester_key(user_id)
         reference_file_content = None
         reference_file_name = None
         if reference_file:
-            reference_file_content = reference_file.read()
+            reference_file_content = SpooledUpload.from_file_storage(reference_file, Config.UPLOAD_SPOOL_DIR)
             reference_file_name = reference_file.filename
 
         def generate():
@@ -530,7 +870,8 @@ def generate_proposal():
                     methodologies,
                     custom_methodologies,
                     reference_file_content,
-                    reference_file_name
+                    reference_file_name,
+                    user_id=requester
                 )
                 for chunk in generator:
                     yield chunk
@@ -540,7 +881,7 @@ def generate_proposal():
             finally:
                 yield STREAM_DONE_MARKER
 
-        return Response(
+        response = Response(
             stream_with_context(generate()),
             content_type='text/event-stream; charset=utf-8',
             headers={
@@ -548,6 +889,9 @@ def generate_proposal():
                 'Cache-Control': 'no-cache'
             }
         )
+        if reference_file_content is not None:
+            response.call_on_close(reference_file_content.close)
+        return response
     except Exception as e:
         logger.error(f"Error starting proposal generation: {str(e)}")
         return jsonify({"code": 500, "message": str(e), "data": None}), 500
@@ -558,6 +902,8 @@ def generate_sub_proposal():
     sub_plan_title = request.form.get('sub_plan_title', '')
     sub_plan_details = request.form.get('sub_plan_details', '')
     role = request.form.get('role', 'all')
+    long_document = _parse_optional_bool(request.form.get('long_document'))
+    requester = _get_requester_key(request.form.get('user_id'))
 
     methodologies = request.form.getlist('methodologies')
     if len(methodologies) == 1 and ',' in methodologies[0]:
@@ -574,7 +920,7 @@ def generate_sub_proposal():
         return jsonify({"code": 400, "message": "请至少选择系统内置方法论", "data": None}), 400
 
     try:
-        parent_file_content = parent_file.read()
+        parent_file_content = SpooledUpload.from_file_storage(parent_file, Config.UPLOAD_SPOOL_DIR)
         parent_file_name = parent_file.filename
 
         def generate():
@@ -585,7 +931,9 @@ def generate_sub_proposal():
                     sub_plan_title,
                     sub_plan_details,
                     methodologies,
-                    custom_methodologies
+                    custom_methodologies,
+                    long_document=long_document,
+                    user_id=requester
                 )
                 for chunk in generator:
                     yield chunk
@@ -595,7 +943,7 @@ def generate_sub_proposal():
             finally:
                 yield STREAM_DONE_MARKER
 
-        return Response(
+        response = Response(
             stream_with_context(generate()),
             content_type='text/event-stream; charset=utf-8',
             headers={
@@ -603,6 +951,8 @@ def generate_sub_proposal():
                 'Cache-Control': 'no-cache'
             }
         )
+        response.call_on_close(parent_file_content.close)
+        return response
     except Exception as e:
         logger.error(f"Error starting sub proposal generation: {str(e)}")
         return jsonify({"code": 500, "message": str(e), "data": None}), 500
@@ -621,17 +971,42 @@ def export_docx():
         return jsonify({"code": 400, "message": "Content is required", "data": None}), 400
         
     try:
-        docx_stream = generate_blueprint_docx(markdown_text)
+        docx_stream = generate_blueprint_docx(markdown_text, spool_max_memory=Config.DOCX_SPOOL_MAX_MEMORY)
+        docx_stream.seek(0, 2)
+        size = docx_stream.tell()
+        docx_stream.seek(0)
         
         # 处理文件名中文编码
         encoded_filename = urllib.parse.quote(filename)
         
-        return send_file(
+        response = send_file(
             docx_stream,
             mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
             as_attachment=True,
             download_name=filename
         )
+        response.content_length = size
+        return response
     except Exception as e:
         logger.error(f"Export Error: {str(e)}")
         return jsonify({"code": 500, "message": str(e), "data": None}), 500
+
+@blueprint_bp.route('/runtime/stats', methods=['GET'])
+def get_runtime_stats():
+    """
+    GET /api/v1/blueprint/runtime/stats
+    获取运行时统计（OCR 缓存命中/未命中/节省字节数等）
+    """
+    try:
+        stats = analysis_service.get_runtime_stats()
+        stats["jobs"] = job_service.get_stats()
+        stats["book_stats_counter"] = book_stats_counter.get_stats()
+        stats["dashboard_snapshots"] = dashboard_snapshots.get_stats()
+        stats["activity_rollups"] = activity_rollups.get_stats()
+        stats["telemetry"] = get_telemetry_stats()
+        stats["sessions"] = session_manager.get_stats() if session_manager else None
+        stats["artifacts"] = get_artifact_stats()
+        return jsonify({"code": 200, "message": "success", "data": stats})
+    except Exception as e:
+        logger.error(f"Runtime stats Error: {str(e)}")
+        return jsonify({"code": 500, "message": str(e), "data": None}), 500
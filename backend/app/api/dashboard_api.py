@@ -4,50 +4,54 @@
 核心功能：
 1. 获取书籍使用排行榜
 2. 获取用户活跃统计
-依赖模块：flask, pymongo
+3. 活跃度时间序列与 DAU/WAU/MAU（读取分桶汇总，见 activity_service）
+说明：统计结果物化缓存（见 dashboard_service），响应携带 ETag / Cache-Control，
+      轮询请求在结果未变化时返回 304
+依赖模块：flask, dashboard_service, activity_service
 """
-from flask import Blueprint, jsonify
-from app.extensions import mongo
+from datetime import datetime, timedelta, timezone
+from flask import Blueprint, jsonify, request
+from app.config import Config
+from app.services.activity_service import BUCKET_SPANS, MAX_SERIES_BUCKETS, get_active_users, get_time_series
+from app.services.dashboard_service import compute_book_stats, compute_user_stats, dashboard_snapshots
 import logging
 
 dashboard_bp = Blueprint('dashboard', __name__)
 logger = logging.getLogger(__name__)
 
+
+# 时间序列默认查询范围（按粒度）
+DEFAULT_SERIES_RANGES = {
+    "minute": timedelta(hours=1),
+    "hour": timedelta(hours=24),
+    "day": timedelta(days=30),
+}
+
+
+def _cached_response(data, etag: str = None, max_age: int = 0):
+    """
+    附加缓存头；If-None-Match 命中时转为 304
+    :param etag: 为空时按响应体计算
+    """
+    response = jsonify({"code": 200, "message": "success", "data": data})
+    if etag:
+        response.set_etag(etag)
+    else:
+        response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
 @dashboard_bp.route('/stats/books', methods=['GET'])
 def get_book_stats():
     """
     GET /api/v1/dashboard/stats/books
-    获取书籍使用排行榜 (Top 10)，支持按角色筛选
+    获取书籍使用排行榜（总榜 Top 10，各角色 Top 5）
     """
     try:
-        pipeline = [
-            {"$match": {"role": "all"}}, # 默认只查总榜，暂不前端筛选
-            {"$sort": {"count": -1}},
-            {"$limit": 10},
-            {"$project": {"_id": 0, "book_name": 1, "count": 1}}
-        ]
-        
-        # 聚合每个角色的 Top 书籍
-        roles = ['cxo', 'iron_triangle', 'pdt_manager', 'cio', 'ar', 'sr', 'fr', 'pdt', 'cfo', 'supply', 'hr']
-        role_stats = {}
-        
-        # 获取总榜
-        total_books = list(mongo.db.book_stats.aggregate(pipeline))
-        role_stats['all'] = total_books
-        
-        # 获取各角色榜单
-        for role in roles:
-             role_pipeline = [
-                {"$match": {"role": role}},
-                {"$sort": {"count": -1}},
-                {"$limit": 5}, # 角色榜单只取前5
-                {"$project": {"_id": 0, "book_name": 1, "count": 1}}
-            ]
-             role_books = list(mongo.db.book_stats.aggregate(role_pipeline))
-             if role_books:
-                 role_stats[role] = role_books
-
-        return jsonify({"code": 200, "message": "success", "data": role_stats})
+        data, etag, max_age = dashboard_snapshots.get("book_stats", compute_book_stats)
+        return _cached_response(data, etag, max_age)
     except Exception as e:
         logger.error(f"Error fetching book stats: {str(e)}")
         return jsonify({"code": 500, "message": str(e), "data": {}}), 500
@@ -56,38 +60,65 @@ def get_book_stats():
 def get_user_stats():
     """
     GET /api/v1/dashboard/stats/users
-    获取用户活跃度统计 (最近24小时活跃用户数，总用户数，活跃用户列表)
+    获取用户活跃度统计 (总用户数，最近登录用户列表，最近使用记录)
     """
     try:
-        total_users = mongo.db.users.count_documents({})
-        
-        # 获取最近活跃的用户（基于最后登录时间）
-        # 取前20位最近登录的用户
-        active_users_cursor = mongo.db.users.find(
-            {}, 
-            {"_id": 0, "username": 1, "last_login": 1}
-        ).sort("last_login", -1).limit(20)
-        
-        active_users = []
-        for user in active_users_cursor:
-            user_data = {
-                "username": user["username"],
-                "last_login": user.get("last_login")
-            }
-            active_users.append(user_data)
-        
-        # 简单统计：获取最近10条使用记录
-        recent_logs = list(mongo.db.usage_logs.find({}, {"_id": 0, "username": 1, "action": 1, "created_at": 1}).sort("created_at", -1).limit(10))
-        
-        return jsonify({
-            "code": 200, 
-            "message": "success", 
-            "data": {
-                "total_users": total_users,
-                "active_users": active_users,
-                "recent_activities": recent_logs
-            }
-        })
+        data, etag, max_age = dashboard_snapshots.get("user_stats", compute_user_stats)
+        return _cached_response(data, etag, max_age)
     except Exception as e:
         logger.error(f"Error fetching user stats: {str(e)}")
         return jsonify({"code": 500, "message": str(e), "data": None}), 500
+
+
+def _parse_time(value: str):
+    # 接受 ISO 8601（无时区视为 UTC，如 2024-05-01T08:00:00；带时区如 Z / +08:00 时换算为 UTC），解析失败返回 None
+    # 统一返回不带时区的 UTC 时间，与库中的 utcnow 时间可直接比较
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00")) if value else None
+    except ValueError:
+        return None
+    if parsed is not None and parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+@dashboard_bp.route('/stats/timeseries', methods=['GET'])
+def get_activity_timeseries():
+    """
+    GET /api/v1/dashboard/stats/timeseries
+    参数：
+      - granularity: minute / hour / day（默认 hour）
+      - start / end: ISO 8601 UTC 时间（可选，默认按粒度取最近 1 小时 / 24 小时 / 30 天）
+    返回每个桶的登录次数、分析次数、去重用户数及按角色 / 接口的分布
+    """
+    granularity = request.args.get('granularity', 'hour')
+    if granularity not in BUCKET_SPANS:
+        return jsonify({"code": 400, "message": "granularity must be minute, hour or day", "data": None}), 400
+
+    end = _parse_time(request.args.get('end')) or datetime.utcnow()
+    start = _parse_time(request.args.get('start')) or end - DEFAULT_SERIES_RANGES[granularity]
+    if start >= end:
+        return jsonify({"code": 400, "message": "start must be earlier than end", "data": None}), 400
+    if (end - start) / BUCKET_SPANS[granularity] > MAX_SERIES_BUCKETS:
+        return jsonify({"code": 400, "message": f"range exceeds {MAX_SERIES_BUCKETS} buckets", "data": None}), 400
+
+    try:
+        series = get_time_series(granularity, start, end)
+        data = {"granularity": granularity, "start": start.isoformat(), "end": end.isoformat(), "series": series}
+        # 汇总数据按刷写间隔更新，缓存期内的重复轮询可直接复用
+        return _cached_response(data, max_age=int(Config.ACTIVITY_FLUSH_INTERVAL))
+    except Exception as e:
+        logger.error(f"Error fetching activity timeseries: {str(e)}")
+        return jsonify({"code": 500, "message": str(e), "data": None}), 500
+
+@dashboard_bp.route('/stats/active-users', methods=['GET'])
+def get_active_user_stats():
+    """
+    GET /api/v1/dashboard/stats/active-users
+    获取 DAU / WAU / MAU 及最近 7 天每日活跃用户数
+    """
+    try:
+        data = get_active_users()
+        return _cached_response(data, max_age=int(Config.ACTIVITY_FLUSH_INTERVAL))
+    except Exception as e:
+        logger.error(f"Error fetching active users: {str(e)}")
+        return jsonify({"code": 500, "message": str(e), "data": None}), 500
@@ -5,7 +5,8 @@
 依赖模块：flask, pymongo
 """
 from flask import Blueprint, request, jsonify
-from app.extensions import mongo
+from app.services.auth_service import extract_session_token, resolve_user
+from app.services.telemetry_service import enqueue_feedback
 from datetime import datetime
 import logging
 
@@ -23,14 +24,15 @@ def submit_feedback():
     """
     data = request.json
     content = data.get('content')
-    user_id = data.get('user_id')
     username = data.get('username')
+    user_id, error = resolve_user(data.get('user_id'), extract_session_token(request.headers, request.values))
+    if error:
+        status, message = error
+        return jsonify({"code": status, "message": message, "data": None}), status
 
     if not content:
         return jsonify({"code": 400, "message": "Content is required", "data": None}), 400
 
-    feedback_collection = mongo.db.feedbacks
-    
     new_feedback = {
         "user_id": user_id,
         "username": username,
@@ -38,6 +40,8 @@ def submit_feedback():
         "created_at": datetime.utcnow()
     }
     
-    feedback_collection.insert_one(new_feedback)
+    # 后台确认写入；队列持续满载时提示稍后重试
+    if enqueue_feedback(new_feedback) is None:
+        return jsonify({"code": 503, "message": "Server busy, please retry later", "data": None}), 503
 
     return jsonify({"code": 200, "message": "Feedback submitted successfully", "data": None})
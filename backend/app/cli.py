@@ -0,0 +1,233 @@
+# 文件名：cli.py
+"""
+功能说明：运维命令（flask CLI）
+核心功能：
+1. flask history migrate：历史记录正文迁移为压缩存储，并输出迁移前后的存储占用与读取延迟
+2. flask db ensure-indexes：幂等创建声明的索引
+3. flask db verify-plans：对热点查询执行 explain，任一查询出现 COLLSCAN 时以非零状态退出
+4. flask docx benchmark：按指定大小合成 Markdown 报告，测量 Word 导出耗时与峰值内存
+用法：在 backend 目录下执行 `flask --app run history migrate`（MONGO_URI 指向本地 mongod 即可验证）
+依赖模块：click, extensions, history_service, schema_service, docx_generator
+"""
+import time
+import tracemalloc
+
+import click
+from flask.cli import AppGroup
+
+from app.extensions import mongo
+from app.services.history_service import load_history_content, migrate_history_storage
+from app.services.schema_service import SchemaError, ensure_indexes, explain_query, hot_queries
+from app.utils.docx_generator import generate_blueprint_docx
+
+history_cli = AppGroup("history", help="分析历史记录维护")
+db_cli = AppGroup("db", help="数据库索引维护")
+docx_cli = AppGroup("docx", help="Word 导出")
+
+HISTORY_COLLECTIONS = ("analysis_histories", "analysis_history_segments", "analysis_history_contents", "analysis_history_content_chunks")
+
+
+def _collection_storage() -> dict:
+    """
+    各集合的数据大小 / 磁盘占用 / 平均文档大小（字节）
+    """
+    stats = {}
+    existing = set(mongo.db.list_collection_names())
+    for name in HISTORY_COLLECTIONS:
+        if name not in existing:
+            stats[name] = {"count": 0, "size": 0, "storage_size": 0, "avg_obj_size": 0}
+            continue
+        s = mongo.db.command("collStats", name)
+        stats[name] = {
+            "count": s.get("count", 0),
+            "size": s.get("size", 0),
+            "storage_size": s.get("storageSize", 0),
+            "avg_obj_size": s.get("avgObjSize", 0)
+        }
+    return stats
+
+
+def _measure_reads(sample_size: int) -> dict:
+    """
+    按抽样记录测量列表查询与详情读取的平均耗时（毫秒）
+    """
+    samples = list(mongo.db.analysis_histories.find({}, {"_id": 1, "user_id": 1}).sort("_id", -1).limit(sample_size))
+    if not samples:
+        return {"samples": 0, "list_ms": 0.0, "detail_ms": 0.0}
+
+    list_total = 0.0
+    detail_total = 0.0
+    for sample in samples:
+        started = time.perf_counter()
+        list(
+            mongo.db.analysis_histories.find({"user_id": sample.get("user_id")}, {"content": 0})
+            .sort("created_at", -1)
+            .limit(10)
+        )
+        list_total += time.perf_counter() - started
+
+        started = time.perf_counter()
+        doc = mongo.db.analysis_histories.find_one({"_id": sample["_id"]})
+        load_history_content(doc)
+        detail_total += time.perf_counter() - started
+
+    return {
+        "samples": len(samples),
+        "list_ms": round(list_total / len(samples) * 1000, 2),
+        "detail_ms": round(detail_total / len(samples) * 1000, 2)
+    }
+
+
+def _print_measurements(title: str, storage: dict, reads: dict) -> None:
+    click.echo(f"== {title} ==")
+    for name, s in storage.items():
+        click.echo(f"  {name}: count={s['count']} size={s['size']} storage_size={s['storage_size']} avg_obj_size={s['avg_obj_size']}")
+    click.echo(f"  reads: samples={reads['samples']} list_avg={reads['list_ms']}ms detail_avg={reads['detail_ms']}ms")
+
+
+@history_cli.command("migrate")
+@click.option("--batch-size", default=200, show_default=True, help="每批处理的记录数")
+@click.option("--sample", default=20, show_default=True, help="读取延迟测量的抽样记录数")
+@click.option("--dry-run", is_flag=True, help="只统计压缩效果，不写入数据库")
+def migrate_history_command(batch_size: int, sample: int, dry_run: bool):
+    """
+    将内联正文 / 已结束的分段正文迁移为压缩存储
+    """
+    _print_measurements("before", _collection_storage(), _measure_reads(sample))
+
+    stats = migrate_history_storage(
+        batch_size=batch_size,
+        dry_run=dry_run,
+        progress=lambda n: click.echo(f"  migrated {n} records...")
+    )
+    ratio = stats["stored_bytes"] / stats["raw_bytes"] if stats["raw_bytes"] else 0.0
+    click.echo(
+        f"{'[dry-run] ' if dry_run else ''}migrated={stats['migrated']} raw_bytes={stats['raw_bytes']} "
+        f"stored_bytes={stats['stored_bytes']} ratio={ratio:.3f}"
+    )
+
+    if not dry_run:
+        _print_measurements("after", _collection_storage(), _measure_reads(sample))
+
+
+def _ensure_indexes_or_exit() -> None:
+    try:
+        results = ensure_indexes(mongo.db)
+    except SchemaError as e:
+        raise click.ClickException(str(e))
+    for r in results:
+        click.echo(f"  {r['collection']}.{r['name']}: {r['status']}")
+
+
+@db_cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """
+    幂等创建声明的索引（含 users.username 唯一索引）
+    """
+    _ensure_indexes_or_exit()
+
+
+@db_cli.command("verify-plans")
+@click.option("--skip-ensure", is_flag=True, help="不先创建索引，直接校验当前执行计划")
+def verify_plans_command(skip_ensure: bool):
+    """
+    对热点查询执行 explain，出现 COLLSCAN 时以非零状态退出
+    """
+    if not skip_ensure:
+        _ensure_indexes_or_exit()
+
+    offenders = []
+    for query in hot_queries():
+        report = explain_query(mongo.db, query)
+        flag = "COLLSCAN" if report["collscan"] else "ok"
+        click.echo(f"  [{flag}] {report['name']}: {' <- '.join(report['stages'])}")
+        if report["collscan"]:
+            offenders.append(report["name"])
+
+    if offenders:
+        raise click.ClickException(f"{len(offenders)} hot queries still use COLLSCAN: {offenders}")
+    click.echo("All hot queries use indexes")
+
+
+def _parse_size(value: str) -> int:
+    value = value.strip().upper()
+    for suffix, factor in (("MB", 1024 * 1024), ("KB", 1024), ("B", 1)):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * factor)
+    return int(value)
+
+
+def _synthetic_report(target_bytes: int) -> str:
+    """
+    合成接近真实报告结构的 Markdown：标题、段落、引用、多级列表、表格、代码块、行内格式
+    """
+    chapters = []
+    size = 0
+    index = 0
+    while size < target_bytes:
+        index += 1
+        chapter = "\n".join([
+            f"# 第{index}章 战略解码",
+            f"## {index}.1 现状评估",
+            "当前业务处于**转型关键期**，需要围绕客户价值重构流程与组织能力，" * 3,
+            "> 关键结论：能力建设应与业务节奏保持一致",
+            "- 战略层面：明确 *三年目标* 与年度里程碑",
+            "  - 拆解到部门 KPI，使用 `BLM` 模型对齐",
+            "    - 每季度复盘一次",
+            "- 运营层面：建立数据驱动的经营分析机制",
+            "1. 识别差距",
+            "2. 制定举措",
+            "   1. 明确责任人",
+            "   2. 设定验收标准",
+            "3. 跟踪闭环",
+            "",
+            "| 维度 | 现状 | 目标 |",
+            "|---|---|---|",
+            "| 组织 | 职能分散 | **端到端协同** |",
+            "| 流程 | 人工审批 | 自动化 |",
+            "",
+            f"### {index}.2 小结",
+            "```",
+            "score = weight * impact",
+            "```",
+            ""
+        ])
+        chapters.append(chapter)
+        size += len(chapter.encode("utf-8"))
+    return "\n".join(chapters)
+
+
+@docx_cli.command("benchmark")
+@click.option("--sizes", default="10KB,1MB,5MB", show_default=True, help="逗号分隔的输入大小")
+def docx_benchmark_command(sizes: str):
+    """
+    测量 Word 导出的耗时与峰值内存（tracemalloc 统计的 Python 分配）
+    """
+    generate_blueprint_docx("# warm up")  # 构建样式模板，不计入测量
+    for label in sizes.split(","):
+        text = _synthetic_report(_parse_size(label))
+        input_bytes = len(text.encode("utf-8"))
+
+        started = time.perf_counter()
+        stream = generate_blueprint_docx(text)
+        elapsed = time.perf_counter() - started
+        stream.seek(0, 2)
+        output_bytes = stream.tell()
+        stream.close()
+
+        # 内存统计单独运行一次，避免 tracemalloc 的开销影响耗时
+        tracemalloc.start()
+        generate_blueprint_docx(text).close()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        click.echo(
+            f"  {label.strip()}: input={input_bytes} bytes output={output_bytes} bytes "
+            f"time={elapsed * 1000:.1f}ms peak_memory={peak / 1024 / 1024:.1f}MB"
+        )
+
+
+def register_commands(app) -> None:
+    app.cli.add_command(history_cli)
+    app.cli.add_command(db_cli)
+    app.cli.add_command(docx_cli)
@@ -4,6 +4,7 @@
 核心功能：从环境变量加载配置
 依赖模块：os, dotenv
 """
+import json
 import os
 from dotenv import load_dotenv
 
@@ -14,15 +15,136 @@ class Config:
     # TextIn OCR 配置
     TEXTIN_APP_ID = os.getenv("TEXTIN_APP_ID")
     TEXTIN_SECRET_CODE = os.getenv("TEXTIN_SECRET_CODE")
+    # OCR 接口地址（留空使用 TextIn 官方地址；测试时可指向本地替身服务）
+    OCR_API_URL = os.getenv("OCR_API_URL")
+    # OCR HTTP 连接池大小（建议与 waitress threads / gunicorn 并发数一致）
+    OCR_HTTP_POOL_SIZE = int(os.getenv("OCR_HTTP_POOL_SIZE", "8"))
     
     # OpenAI/Doubao 配置
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
     LLM_MODEL = os.getenv("LLM_MODEL")
+    # 流式响应中请求用量信息（含缓存命中 token），服务商不支持 stream_options 时设为 false
+    LLM_STREAM_USAGE = os.getenv("LLM_STREAM_USAGE", "true").lower() in ("1", "true", "yes")
+
+    # 多端点 LLM 池（JSON 数组，元素含 base_url / api_key / model / weight / name），留空时仅使用上面的单一端点
+    # 例：[{"name": "primary", "base_url": "...", "api_key": "...", "model": "...", "weight": 2}]
+    LLM_ENDPOINTS = json.loads(os.getenv("LLM_ENDPOINTS", "") or "[]")
+    # 熔断：连续失败次数阈值 / 冷却秒数
+    LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("LLM_CIRCUIT_FAILURE_THRESHOLD", "3"))
+    LLM_CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("LLM_CIRCUIT_COOLDOWN_SECONDS", "30"))
+
+    # LLM 调度：每个模型同时进行的上游流数上限；按模型覆盖（格式 "model-a=4,model-b=2"）；等待多少秒提升一级优先级
+    LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+    LLM_MAX_IN_FLIGHT_BY_MODEL = {
+        k.strip(): int(v)
+        for k, v in (item.split("=", 1) for item in os.getenv("LLM_MAX_IN_FLIGHT_BY_MODEL", "").split(",") if "=" in item)
+    }
+    LLM_PRIORITY_AGING_SECONDS = float(os.getenv("LLM_PRIORITY_AGING_SECONDS", "30"))
+
+    # 上下文预算（token）：窗口留空按模型名内置值；预留输出、方法论上限、文档上限（0 表示仅受窗口限制）
+    LLM_CONTEXT_WINDOW = int(os.getenv("LLM_CONTEXT_WINDOW", "0"))
+    LLM_RESERVED_OUTPUT_TOKENS = int(os.getenv("LLM_RESERVED_OUTPUT_TOKENS", "8192"))
+    LLM_METHODOLOGY_MAX_TOKENS = int(os.getenv("LLM_METHODOLOGY_MAX_TOKENS", "6000"))
+    LLM_DOCUMENT_MAX_TOKENS = int(os.getenv("LLM_DOCUMENT_MAX_TOKENS", "0"))
+
+    # 历史记录分段持久化：单个分段字符数 / 最长写入间隔（秒）
+    HISTORY_SEGMENT_CHARS = int(os.getenv("HISTORY_SEGMENT_CHARS", str(16 * 1024)))
+    HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "3"))
+    # 历史记录结束时（后台线程中）等待排队写入落库的最长时间（秒），超时则保留分段存储，由迁移命令稍后压缩
+    HISTORY_FINALIZE_WAIT_SECONDS = float(os.getenv("HISTORY_FINALIZE_WAIT_SECONDS", "10"))
+
+    # 合并相同的并发分析请求（同一文件、提示词、方法论、部门、模型只执行一次）
+    ANALYSIS_COALESCE_ENABLED = os.getenv("ANALYSIS_COALESCE_ENABLED", "true").lower() in ("1", "true", "yes")
+    # 合并的加入窗口：流程开始超过该秒数或已输出超过该字符数后，相同请求不再加入而是各自执行（限制回放缓冲内存）
+    ANALYSIS_COALESCE_JOIN_SECONDS = float(os.getenv("ANALYSIS_COALESCE_JOIN_SECONDS", "30"))
+    ANALYSIS_COALESCE_MAX_REPLAY_CHARS = int(os.getenv("ANALYSIS_COALESCE_MAX_REPLAY_CHARS", str(256 * 1024)))
+
+    # 长文档模式（默认关闭，可按请求开启）：文档超出预算时按章节并行摘要（map），再对摘要做整体评审（reduce）
+    LLM_LONG_DOC_ENABLED = os.getenv("LLM_LONG_DOC_ENABLED", "false").lower() in ("1", "true", "yes")
+    LLM_LONG_DOC_MAP_CONCURRENCY = int(os.getenv("LLM_LONG_DOC_MAP_CONCURRENCY", "4"))
+    LLM_LONG_DOC_SECTION_TOKENS = int(os.getenv("LLM_LONG_DOC_SECTION_TOKENS", "8000"))
+    LLM_LONG_DOC_DIGEST_MAX_TOKENS = int(os.getenv("LLM_LONG_DOC_DIGEST_MAX_TOKENS", "1500"))
+
+    # LLM 补全缓存（默认关闭；相同模型/消息/温度的请求直接回放缓存结果）
+    LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+    LLM_CACHE_MAX_CHARS = int(os.getenv("LLM_CACHE_MAX_CHARS", str(20_000_000)))
+    LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(24 * 3600)))
+    # 缓存回放节奏：每块字符数 / 块间隔秒数
+    LLM_CACHE_REPLAY_CHUNK_CHARS = int(os.getenv("LLM_CACHE_REPLAY_CHUNK_CHARS", "16"))
+    LLM_CACHE_REPLAY_INTERVAL = float(os.getenv("LLM_CACHE_REPLAY_INTERVAL", "0.02"))
 
     # MongoDB 配置
     MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/blueprint_master")
-    
+    # 书籍使用统计写后缓冲：定期刷写间隔（秒）/ 待写入键数达到阈值时立即刷写
+    BOOK_STATS_FLUSH_INTERVAL = float(os.getenv("BOOK_STATS_FLUSH_INTERVAL", "5"))
+    BOOK_STATS_FLUSH_MAX_KEYS = int(os.getenv("BOOK_STATS_FLUSH_MAX_KEYS", "500"))
+    # 仪表盘统计物化缓存有效期（秒），同时作为响应的 Cache-Control max-age
+    DASHBOARD_CACHE_TTL_SECONDS = float(os.getenv("DASHBOARD_CACHE_TTL_SECONDS", "30"))
+    # 活跃度分桶汇总：写后缓冲刷写间隔（秒）/ 日桶边界相对 UTC 的偏移小时数（8 表示按北京时间自然日）
+    ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "10"))
+    ACTIVITY_UTC_OFFSET_HOURS = float(os.getenv("ACTIVITY_UTC_OFFSET_HOURS", "0"))
+    # 遥测后台写入：单批文档数 / 最长等待（秒）/ 日志队列容量 / 持久队列容量 / 持久队列满时入队最多阻塞秒数
+    TELEMETRY_BATCH_SIZE = int(os.getenv("TELEMETRY_BATCH_SIZE", "500"))
+    TELEMETRY_FLUSH_INTERVAL = float(os.getenv("TELEMETRY_FLUSH_INTERVAL", "1"))
+    TELEMETRY_LOG_MAX_QUEUE = int(os.getenv("TELEMETRY_LOG_MAX_QUEUE", "10000"))
+    TELEMETRY_DURABLE_MAX_QUEUE = int(os.getenv("TELEMETRY_DURABLE_MAX_QUEUE", "5000"))
+    TELEMETRY_DURABLE_BLOCK_SECONDS = float(os.getenv("TELEMETRY_DURABLE_BLOCK_SECONDS", "5"))
+    # 持久队列写入失败时的重试次数 / 首次重试等待秒数（之后每次翻倍）；日志队列不重试
+    TELEMETRY_DURABLE_MAX_RETRIES = int(os.getenv("TELEMETRY_DURABLE_MAX_RETRIES", "5"))
+    TELEMETRY_DURABLE_RETRY_BACKOFF = float(os.getenv("TELEMETRY_DURABLE_RETRY_BACKOFF", "0.5"))
+    # 会话令牌：签名密钥（多进程部署须一致；未配置时不签发令牌，开启 AUTH_REQUIRE_SESSION 时必填）/ 令牌有效期（秒）/ 已验证令牌缓存时长与容量
+    # AUTH_REQUIRE_SESSION 开启后，历史记录与分析等接口必须携带有效令牌
+    SECRET_KEY = os.getenv("SECRET_KEY")
+    SESSION_MAX_AGE_SECONDS = int(os.getenv("SESSION_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+    SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "300"))
+    SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+    AUTH_REQUIRE_SESSION = os.getenv("AUTH_REQUIRE_SESSION", "false").lower() in ("1", "true", "yes")
+    # Word 导出：输出在内存中保留的最大字节数，超过后转存临时文件
+    DOCX_SPOOL_MAX_MEMORY = int(os.getenv("DOCX_SPOOL_MAX_MEMORY", str(8 * 1024 * 1024)))
+    # 历史记录派生文件（Word 导出、思维导图）存储
+    # ARTIFACT_STORE_BACKEND: gridfs (MongoDB GridFS，多进程 / 多机共享) / disk (本地磁盘，目录为 ARTIFACT_STORE_DIR)
+    ARTIFACT_STORE_BACKEND = os.getenv("ARTIFACT_STORE_BACKEND", "gridfs")
+    ARTIFACT_STORE_DIR = os.getenv("ARTIFACT_STORE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "artifacts"))
+    # 启动时幂等创建索引；开启 DB_VERIFY_QUERY_PLANS 时同时校验热点查询计划，出现 COLLSCAN 或数据库不可用即中止启动
+    DB_ENSURE_INDEXES = os.getenv("DB_ENSURE_INDEXES", "true").lower() in ("1", "true", "yes")
+    DB_VERIFY_QUERY_PLANS = os.getenv("DB_VERIFY_QUERY_PLANS", "false").lower() in ("1", "true", "yes")
+
+    # OCR 结果缓存配置
+    # OCR_CACHE_BACKEND: disk (本地磁盘) / mongo (MongoDB 集合) / none (关闭)
+    OCR_CACHE_BACKEND = os.getenv("OCR_CACHE_BACKEND", "disk")
+    OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "ocr"))
+    OCR_CACHE_MAX_BYTES = int(os.getenv("OCR_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+    OCR_CACHE_TTL_SECONDS = int(os.getenv("OCR_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+    # 上传文件落盘暂存目录（留空使用系统临时目录）
+    UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR")
+
+    # OCR 执行器配置（进程级并发上限 / 等待队列长度 / TextIn 限流）
+    OCR_MAX_CONCURRENCY = int(os.getenv("OCR_MAX_CONCURRENCY", "4"))
+    # 进程内同时发往 TextIn 的 HTTP 请求上限（整体识别与分片共用，0 表示不限制）；
+    # 分片模式下每个 OCR 任务并发 OCR_SHARD_CONCURRENCY 个请求，不设上限时最多 OCR_MAX_CONCURRENCY × OCR_SHARD_CONCURRENCY 个
+    OCR_HTTP_MAX_IN_FLIGHT = int(os.getenv("OCR_HTTP_MAX_IN_FLIGHT", os.getenv("OCR_MAX_CONCURRENCY", "4")))
+    OCR_MAX_QUEUE = int(os.getenv("OCR_MAX_QUEUE", "32"))
+    # 每秒允许的 OCR 请求数（0 表示不限流）与突发容量
+    OCR_RATE_LIMIT_PER_SEC = float(os.getenv("OCR_RATE_LIMIT_PER_SEC", "2"))
+    OCR_RATE_LIMIT_BURST = int(os.getenv("OCR_RATE_LIMIT_BURST", "4"))
+
+    # 异步分析任务配置（后台并发任务数 / 任务日志固定集合容量）
+    JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "4"))
+    JOB_LOG_MAX_BYTES = int(os.getenv("JOB_LOG_MAX_BYTES", str(256 * 1024 * 1024)))
+    # 每个进程等待执行的任务数上限（超出时提交返回 503）/ 任务心跳间隔与超时（秒，超时的未结束任务标记为失败）
+    JOB_MAX_QUEUE = int(os.getenv("JOB_MAX_QUEUE", "16"))
+    JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "15"))
+    JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "120"))
+
+    # OCR 分片识别配置（大 PDF 按页窗口并发识别）
+    # OCR_SHARD_PAGES: 每个分片的页数，0 表示关闭分片模式
+    OCR_SHARD_PAGES = int(os.getenv("OCR_SHARD_PAGES", "0"))
+    # 单个文件的并发分片数（与其他 OCR 任务共同受 OCR_HTTP_MAX_IN_FLIGHT 限制）
+    OCR_SHARD_CONCURRENCY = int(os.getenv("OCR_SHARD_CONCURRENCY", "4"))
+    OCR_SHARD_MAX_RETRIES = int(os.getenv("OCR_SHARD_MAX_RETRIES", "2"))
+
     @staticmethod
     def init_app(app):
         pass
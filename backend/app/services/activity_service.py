@@ -0,0 +1,175 @@
+# 文件名：activity_service.py
+"""
+功能说明：按时间分桶的活跃度汇总
+核心功能：
+1. 登录 / 分析等事件在内存中按 (粒度, 桶起始时间) 累加，由写后缓冲定期以 $inc / $addToSet upsert 写入 activity_rollups
+2. 每个桶记录：登录次数、分析次数、按角色 / 接口的次数、去重用户
+3. 时间序列与 DAU/WAU/MAU 查询只读取桶文档（O(桶数)），不再扫描 usage_logs 原始日志
+4. 分钟 / 小时桶通过 TTL 索引自动过期，日桶长期保留
+说明：时间均为 UTC；日桶边界按 ACTIVITY_UTC_OFFSET_HOURS 偏移（如 8 表示按北京时间自然日统计）
+依赖模块：extensions, write_behind
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, Hashable, List, Optional
+
+from pymongo import UpdateOne
+
+from app.config import Config
+from app.extensions import mongo
+from app.utils.write_behind import CounterAggregator, CounterDelta
+
+GRANULARITY_MINUTE = "minute"
+GRANULARITY_HOUR = "hour"
+GRANULARITY_DAY = "day"
+GRANULARITIES = (GRANULARITY_MINUTE, GRANULARITY_HOUR, GRANULARITY_DAY)
+
+# 各粒度的桶长度与保留时长（None 表示不过期）
+BUCKET_SPANS = {
+    GRANULARITY_MINUTE: timedelta(minutes=1),
+    GRANULARITY_HOUR: timedelta(hours=1),
+    GRANULARITY_DAY: timedelta(days=1),
+}
+BUCKET_RETENTION = {
+    GRANULARITY_MINUTE: timedelta(days=2),
+    GRANULARITY_HOUR: timedelta(days=90),
+    GRANULARITY_DAY: None,
+}
+
+EVENT_LOGIN = "logins"
+EVENT_ANALYSIS = "analyses"
+
+# 单次时间序列查询最多返回的桶数
+MAX_SERIES_BUCKETS = 1500
+
+ROLLUP_COLLECTION = "activity_rollups"
+
+
+def _field_key(value: str) -> str:
+    # 角色 / 接口名作为嵌套字段名，去掉 MongoDB 字段名中的保留字符
+    return str(value).replace(".", "_").replace("$", "_") or "unknown"
+
+
+def bucket_start(at: datetime, granularity: str) -> datetime:
+    """
+    计算时间点所在桶的起始时间（UTC）
+    """
+    if granularity == GRANULARITY_MINUTE:
+        return at.replace(second=0, microsecond=0)
+    if granularity == GRANULARITY_HOUR:
+        return at.replace(minute=0, second=0, microsecond=0)
+    offset = timedelta(hours=Config.ACTIVITY_UTC_OFFSET_HOURS)
+    local = (at + offset).replace(hour=0, minute=0, second=0, microsecond=0)
+    return local - offset
+
+
+def _rollup_id(granularity: str, start: datetime) -> str:
+    return f"{granularity}:{start.strftime('%Y-%m-%dT%H:%M')}"
+
+
+def _flush_rollups(batch: Dict[Hashable, CounterDelta]) -> None:
+    operations = []
+    for (granularity, start), delta in batch.items():
+        update: Dict[str, Any] = {"$inc": delta.incs}
+        on_insert: Dict[str, Any] = {"granularity": granularity, "bucket": start}
+        retention = BUCKET_RETENTION[granularity]
+        if retention is not None:
+            on_insert["expires_at"] = start + BUCKET_SPANS[granularity] + retention
+        update["$setOnInsert"] = on_insert
+        if delta.sets:
+            update["$addToSet"] = {field: {"$each": sorted(values)} for field, values in delta.sets.items()}
+        operations.append(UpdateOne({"_id": _rollup_id(granularity, start)}, update, upsert=True))
+    mongo.db[ROLLUP_COLLECTION].bulk_write(operations, ordered=False)
+
+
+activity_rollups = CounterAggregator(
+    _flush_rollups,
+    flush_interval=Config.ACTIVITY_FLUSH_INTERVAL,
+    max_keys=300,
+    name="activity"
+)
+
+
+def record_activity(event: str, user_id: Optional[str] = None, role: Optional[str] = None, endpoint: Optional[str] = None, at: Optional[datetime] = None) -> None:
+    """
+    记录一次事件（仅内存累加，写入由后台完成）
+    :param event: 事件计数字段（EVENT_LOGIN / EVENT_ANALYSIS）
+    :param endpoint: 触发事件的接口名
+    """
+    at = at or datetime.utcnow()
+    incs = {event: 1}
+    if role:
+        incs[f"roles.{_field_key(role)}.{event}"] = 1
+    if endpoint:
+        incs[f"endpoints.{_field_key(endpoint)}"] = 1
+    sets = {"users": [str(user_id)]} if user_id else None
+    for granularity in GRANULARITIES:
+        activity_rollups.add((granularity, bucket_start(at, granularity)), incs, sets=sets)
+
+
+def _serialize_bucket(doc: dict) -> dict:
+    return {
+        "bucket": doc["bucket"].isoformat(),
+        EVENT_LOGIN: doc.get(EVENT_LOGIN, 0),
+        EVENT_ANALYSIS: doc.get(EVENT_ANALYSIS, 0),
+        "distinct_users": doc.get("distinct_users", 0),
+        "roles": doc.get("roles", {}),
+        "endpoints": doc.get("endpoints", {})
+    }
+
+
+def get_time_series(granularity: str, start: datetime, end: datetime, fill_empty: bool = True) -> List[dict]:
+    """
+    查询 [start, end) 范围内的桶（按时间升序），缺失的桶补零
+    """
+    first = bucket_start(start, granularity)
+    pipeline = [
+        {"$match": {"granularity": granularity, "bucket": {"$gte": first, "$lt": end}}},
+        {"$sort": {"granularity": 1, "bucket": 1}},
+        {"$limit": MAX_SERIES_BUCKETS},
+        {"$addFields": {"distinct_users": {"$size": {"$ifNull": ["$users", []]}}}},
+        {"$project": {"users": 0, "expires_at": 0}}
+    ]
+    docs = {doc["bucket"]: doc for doc in mongo.db[ROLLUP_COLLECTION].aggregate(pipeline)}
+    if not fill_empty:
+        return [_serialize_bucket(docs[k]) for k in sorted(docs)]
+
+    series = []
+    cursor = first
+    span = BUCKET_SPANS[granularity]
+    while cursor < end and len(series) < MAX_SERIES_BUCKETS:
+        series.append(_serialize_bucket(docs.get(cursor) or {"bucket": cursor}))
+        cursor += span
+    return series
+
+
+def get_active_users(at: Optional[datetime] = None, days: int = 7) -> Dict[str, Any]:
+    """
+    DAU / WAU / MAU：读取最近 30 个日桶的去重用户集合求并集
+    :param days: 额外返回最近若干天的每日活跃用户数
+    """
+    at = at or datetime.utcnow()
+    today = bucket_start(at, GRANULARITY_DAY)
+    window = max(30, days)
+    docs = mongo.db[ROLLUP_COLLECTION].find(
+        {"granularity": GRANULARITY_DAY, "bucket": {"$gt": today - timedelta(days=window), "$lte": today}},
+        {"bucket": 1, "users": 1}
+    )
+    users_by_day = {doc["bucket"]: set(doc.get("users") or []) for doc in docs}
+
+    def distinct(n_days: int) -> int:
+        merged = set()
+        for i in range(n_days):
+            merged |= users_by_day.get(today - timedelta(days=i), set())
+        return len(merged)
+
+    daily = [
+        {"day": (today - timedelta(days=i)).isoformat(), "active_users": len(users_by_day.get(today - timedelta(days=i), ()))}
+        for i in reversed(range(days))
+    ]
+    return {
+        "dau": distinct(1),
+        "wau": distinct(7),
+        "mau": distinct(30),
+        "daily": daily,
+        "utc_offset_hours": Config.ACTIVITY_UTC_OFFSET_HOURS
+    }
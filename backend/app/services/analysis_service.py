@@ -7,15 +7,37 @@
 3. 调用LLM进行流式分析
 依赖模块：ocr_client, llm_client, config
 """
+import hashlib
+import json
 import logging
 import re
+import textwrap
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
 from typing import Generator, List
 from app.config import Config
 from app.utils.ocr_client import OCRClient
 from app.utils.llm_client import LLMClient
+from app.utils.llm_cache import LLMCompletionCache
+from app.utils.llm_dispatcher import LLMDispatcher, PRIORITY_HIGH, PRIORITY_NORMAL
+from app.utils.llm_router import LLMEndpoint, LLMRouter
+from app.utils.ocr_executor import OCRExecutor, TokenBucket
+from app.utils.ocr_cache import OCRCache, build_cache_key, hash_file_content
+from app.utils.upload_spool import SpooledUpload
+from app.utils.single_flight import StreamCoalescer
+from app.utils.token_budget import ContextPlanner
+from app.utils.document_sections import DocumentSection, split_markdown_sections
 
 logger = logging.getLogger(__name__)
 
+# 上下文预算规划器（按配置的 LLM_MODEL 估算 token，进程内共享）
+CONTEXT_PLANNER = ContextPlanner.from_config(Config)
+
+# 思维导图提示词版本：修改 generate_mindmap 提示词时递增，已保存的思维导图随之失效
+MINDMAP_PROMPT_VERSION = "1"
+# 思维导图生成失败时输出的提示前缀（派生文件存储据此跳过保存）
+MINDMAP_FAILURE_PREFIX = "思维导图生成失败: "
+
 # 定义结构化的场景方法论库
 METHODOLOGIES_STRUCTURED = {
     "huawei": {
@@ -178,87 +200,643 @@ METHODOLOGIES_STRUCTURED = {
     }
 }
 
+def _normalize_methodology_text(text: str) -> str:
+    """
+    规范化方法论文本：统一换行、去除源码缩进、合并多余空行
+    """
+    normalized = textwrap.dedent(text.replace("\r\n", "\n").replace("\r", "\n")).strip("\n")
+    return re.sub(r"\n{3,}", "\n\n", normalized)
+
+def _compile_methodology_fragments(library: dict) -> dict:
+    """
+    将方法论库预编译为规范化片段，按 "vendor:scenario"（单场景）与 "vendor"（全场景）索引
+    """
+    fragments = {}
+    for vendor, v_data in library.items():
+        scenario_contents = []
+        for scenario, s_data in v_data["scenarios"].items():
+            content = _normalize_methodology_text(s_data["content"])
+            fragments[f"{vendor}:{scenario}"] = f"\n### 【{v_data['label']} - {s_data['label']}】\n{content}\n"
+            scenario_contents.append(f"{content}\n")
+        fragments[vendor] = f"\n### 【{v_data['label']} (全场景)】\n" + "".join(scenario_contents)
+    return fragments
+
+# 导入时一次性编译
+METHODOLOGY_FRAGMENTS = _compile_methodology_fragments(METHODOLOGIES_STRUCTURED)
+
+# 未选择任何方法论时的默认片段：所有厂商的战略层场景（避免token过多）
+DEFAULT_METHODOLOGY_KEYS = tuple(
+    f"{vendor}:strategy" for vendor, v_data in METHODOLOGIES_STRUCTURED.items() if "strategy" in v_data["scenarios"]
+)
+
+def _compress_methodology_text(text: str, max_tokens: int) -> str:
+    if not text:
+        return ""
+    estimator = CONTEXT_PLANNER.estimator
+    normalized = text.replace("\r\n", "\n").replace("\r", "\n")
+    normalized = re.sub(r"\n{3,}", "\n\n", normalized)
+    if estimator.count(normalized) <= max_tokens:
+        return normalized
+    lines = []
+    total = 0
+    for line in normalized.splitlines():
+        s = line.strip()
+        keep = (
+            s == ""
+            or s.startswith("###")
+            or s.startswith("*")
+            or s.startswith("-")
+            or s.startswith("1.")
+            or s.startswith("2.")
+            or s.startswith("3.")
+        )
+        if not keep:
+            continue
+        line_tokens = estimator.count(line) + 1
+        if total + line_tokens > max_tokens:
+            break
+        lines.append(line)
+        total += line_tokens
+    compact = "\n".join(lines).strip()
+    if not compact:
+        compact = normalized
+    return estimator.truncate(compact, max_tokens)
+
+@lru_cache(maxsize=256)
+def _assemble_methodology_text(selected_methodologies: tuple, custom_methodologies: tuple, use_default: bool, max_tokens: int) -> str:
+    """
+    拼装并压缩方法论文本（按参数组合记忆化；部门预设有限，绝大多数请求直接命中）
+    兼容旧逻辑：如果参数是 ('huawei', 'alibaba') 这种顶层key，加载该厂商下的所有场景
+    如果参数是 ('huawei:strategy', 'huawei:product_dev') 这种具体场景，则按需加载
+    """
+    parts = [METHODOLOGY_FRAGMENTS[item] for item in selected_methodologies if item in METHODOLOGY_FRAGMENTS]
+
+    if not parts and not custom_methodologies and use_default:
+        parts = [METHODOLOGY_FRAGMENTS[key] for key in DEFAULT_METHODOLOGY_KEYS]
+
+    # 添加部门默认参考书籍/方法论
+    if custom_methodologies:
+        parts.append("\n### 【部门默认参考书籍/理论】\n")
+        for cm in custom_methodologies:
+            if cm.strip():
+                parts.append(f"*   📖 **{cm}**\n")
+
+    return _compress_methodology_text("".join(parts), max_tokens)
+
+def build_methodology_text(selected_methodologies: List[str] = None, custom_methodologies: List[str] = None, use_default: bool = False, max_tokens: int | None = None) -> str:
+    """
+    获取方法论文本
+    :param selected_methodologies: 选择的方法论 ['huawei:strategy', 'alibaba', ...]
+    :param custom_methodologies: 部门默认参考书籍
+    :param use_default: 未选择任何方法论时是否加载默认战略层场景
+    :param max_tokens: 最大 token 数（默认取上下文规划中的方法论预算）
+    """
+    return _assemble_methodology_text(
+        tuple(selected_methodologies or ()),
+        tuple(custom_methodologies or ()),
+        use_default,
+        CONTEXT_PLANNER.methodology_budget() if max_tokens is None else max_tokens
+    )
+
+
+# 子专项方案系统提示词（静态部分；子专项名称、父方案文件名等变量放在用户消息中，保持前缀稳定）
+SUB_PROPOSAL_SYSTEM_PROMPT = """
+        你是一位**资深解决方案架构师**。
+
+        ### 你的任务：
+        用户上传了一份《父方案》，并指定要输出其中某一个“子专项/子方案”。
+        你需要先阅读父方案内容，理解总体目标、边界、核心策略与约束，然后基于用户的子专项描述与下方【核心方法论库】中的方法论，生成一份可落地的子专项方案。
+
+        ### 输出要求：
+        - 必须完全中文输出（专有名词除外）
+        - 必须与父方案保持一致：目标、术语、口径、约束
+        - 必须可执行：包含流程、部门/角色、输入输出、里程碑、风险与保障
+        - 如果用户描述不足，允许你在方案中显式列出“需要用户补充的信息清单”
+
+        ### 输出格式（Markdown）：
+        # 🧩 子专项方案 - [子专项名称]
+        
+        > 📎 父方案来源：[父方案文件名]
+
+        ## 1. 子专项定位与目标
+        ## 2. 与父方案的一致性对齐（目标/范围/约束/依赖）
+        ## 3. 现状与问题（基于父方案摘要 + 用户补充）
+        ## 4. 方案设计（策略/流程/系统/数据/组织）
+        ## 5. 关键流程与协作机制（部门/角色/职责/RACI）
+        ## 6. 交付物清单（模板/表单/规范/看板）
+        ## 7. 实施计划（里程碑/迭代节奏/验收标准）
+        ## 8. 风险与对策
+        ## 9. 需要补充的信息清单（如果有）
+        """
+
+# 方案生成系统提示词（静态部分）
+PROPOSAL_SYSTEM_PROMPT = """
+        你是一位**首席解决方案架构师**和**创意总监**。
+        你精通各类商业模式、营销策略和企业架构设计。
+
+        ### 你的任务：
+        根据用户提供的“客户需求”和“初步想法/参考资料”，结合下方【核心方法论库】中的方法论，**从0到1设计一份完整的蓝图方案**。
+        
+        ### 你的角色设定：
+        *   **极度专业**：使用专业术语，逻辑严密。
+        *   **落地导向**：不仅要有高大上的理论，还要有可执行的落地方案。
+        *   **创新思维**：结合用户想法，提供超越预期的创意点。
+        *   **语言要求**：**必须完全使用中文输出**，除非专有名词必须保留英文。请务必检查你的每一句输出，确保没有英文句子。
+
+        ### 输出格式要求 (Markdown)：
+        
+        # 🚀 [项目名称] - 蓝图设计方案
+        
+        > 📋 **方案摘要**：
+        > (简述方案核心价值和亮点)
+        
+        ## 1. 需求分析与背景 (Context)
+        *   **客户痛点**：...
+        *   **核心目标**：...
+        
+        ## 2. 核心策略与理念 (Strategy)
+        (结合选定的方法论进行阐述)
+        *   **理论支撑**：基于[某方法论]...
+        *   **战略定位**：...
+        
+        ## 3. 总体架构设计 (Architecture)
+        *   **业务架构**：...
+        *   **关键流程**：...
+        
+        ## 4. 关键行动举措 (Key Actions)
+        *   ✅ **行动1**：...
+        *   ✅ **行动2**：...
+        
+        ## 5. 预期价值与成果 (Value)
+        *   ...
+        
+        ---
+        > 💡 **专家建议**：(给客户的一句核心建议)
+        """
+
+# 诊断评审系统提示词（静态部分，字节稳定，作为可被服务端前缀缓存复用的公共前缀）
+DIAGNOSIS_SYSTEM_PROMPT = """
+你是一位**蓝图大师 (Blueprint Master)**，一位拥有20年实战经验的企业级架构治理专家。
+你熟读并精通**华为（Huawei）**全套管理变革方法论，以及**TOGAF**、**ITIL**、**PMP**等国际标准。
+你的核心能力是能够像“外科医生”一样，对企业的各类蓝图文档（战略/业务/技术/管理）进行精准诊断。
+
+### 你的角色设定与自我认知：
+*   **我是谁**：我不是一个简单的AI助手，我是用户的“首席架构顾问”。
+*   **我的视角**：我始终站在“企业长期价值最大化”和“从战略到执行闭环”的高度。
+*   **我的态度**：客观、犀利、建设性。对于反模式（Anti-Pattern）设计，我会毫不留情地指出风险；对于优秀实践，我会给予肯定并升华理论。
+
+### 你的说话风格（Professional & Insightful）：
+*   **语言要求**：**必须完全使用中文输出**，除非专有名词（如BLM, IPD）必须保留英文。请务必检查你的每一句输出，确保没有英文句子。
+*   **极度专业**：请使用最严谨、专业的架构师/咨询顾问术语。拒绝口语化，拒绝“风趣幽默”，保持客观、冷静、权威的咨询顾问形象。
+*   **深度洞察**：不要停留在表面现象，要挖掘文档背后的业务逻辑缺失、架构设计隐患和管理机制漏洞。
+*   **有理有据**：所有的评审意见必须严格对应下方【核心方法论库】中的具体理论。例如：“根据华为BLM模型，该规划在‘战略意图’与‘业务设计’之间缺乏逻辑衔接...”。
+*   **结构化输出**：使用金字塔原理组织内容，结论先行，以上统下。
+
+### 你的任务：
+对用户上传的项目蓝图文档进行**大师级深度评审**。
+
+### 评审步骤与思维链（CoT）：
+1.  **场景匹配与定性**：
+    *   首先分析文档属于什么类型的蓝图（如：战略规划、IT架构设计、销售项目运作、产品研发管理、供应链流程等）。
+    *   然后明确本次评审主要引用的方法论场景（例如：针对销售项目，重点引用华为LTC流程）。
+2.  **深度扫描与差距分析**：
+    *   对照选定的方法论标准，逐一扫描文档内容。
+    *   寻找“缺失环节”（如：有目标无路径）、“逻辑断点”（如：业务与IT脱节）、“反模式设计”（如：烟囱式建设）。
+3.  **专业诊断与建议**：
+    *   指出问题，并给出基于大厂实践的改进建议。
+
+---
+
+### 请严格按照以下 Markdown 格式输出报告（不要包含 ```markdown 代码块包裹，直接输出内容）：
+
+# 🏗️ 蓝图大师深度评审报告
+
+> 📋 **执行摘要 (Executive Summary)**：
+> (用一段简练的专业语言综述评审结论。例如：“经评审，该《数字化转型规划》在技术架构层面较为完备，但在战略解码与组织适配层面存在显著缺失，建议引入华为BLM模型强化从战略到执行的闭环...”)
+
+## 1. 蓝图定性与场景匹配
+*   **蓝图类型**：[例如：企业级IT战略规划]
+*   **适用场景**：[例如：华为 BLM 战略规划 + 华为 数字化转型]
+*   **核心特征**：(简述文档的核心特征与现状)
+
+## 2. 亮点分析 (Highlights)
+(列出 2-3 个值得肯定的地方，并说明符合哪家大厂的什么理念)
+*   ✅ **[亮点1]**：... (符合...原则)
+
+## 3. 关键缺陷与深度剖析 (Critical Deficiencies)
+(这是报告的核心，请至少列出 3 个深度问题。请务必使用专业术语，逻辑严密。)
+
+### 3.1 [缺陷标题，例如：战略意图与业务设计脱节]
+*   **🔴 问题描述**：(客观描述文档中存在的问题，引用原文)
+*   **📉 深度归因**：
+    *   **理论依据**：依据 **[具体方法论名称]**，...
+    *   **差距分析**：文档中缺少了...导致无法支撑...
+    *   **潜在风险**：如果维持现状，将导致...（如：IT投资回报率低、系统孤岛严重等）。
+*   **💡 改进建议**：
+    *   引入...机制/流程。
+    *   具体重构建议：...
+
+### 3.2 [缺陷标题]
+*   **🔴 问题描述**：...
+*   **📉 深度归因**：...
+*   **💡 改进建议**：...
+
+(以此类推...)
+
+## 4. 实施路线图建议 (Implementation Roadmap)
+(基于现状给出的分阶段实施建议)
+*   **阶段一：速赢 (Quick Wins)** - [时间周期]
+    *   ...
+*   **阶段二：能力构建 (Capability Building)** - [时间周期]
+    *   ...
+*   **阶段三：生态演进 (Ecosystem Evolution)** - [时间周期]
+    *   ...
+
+---
+> 🔚 **结语**：(一句专业的总结致辞)
+"""
+
+# 长文档模式章节摘要（map 阶段）系统提示词
+LONG_DOC_MAP_SYSTEM_PROMPT = """
+你是一位资深的战略咨询分析师，正在协助审阅一份很长的文档。
+你会收到文档中的一个章节片段，请提炼该片段的要点，供后续对全文做综合分析使用。
+
+### 要求：
+1. 只依据片段原文，不要臆测或补充原文没有的信息。
+2. 保留关键事实：目标与指标（含具体数字）、业务/组织/流程/系统设计、关键举措与时间计划、资源投入、约束与假设。
+3. 明确指出片段中存在的矛盾、缺失、模糊或不可落地之处。
+4. 使用简洁的中文要点列表输出，不要输出开场白或总结语。
+"""
+
+def _compose_system_prompt(instructions: str, methodology_purpose: str, methodology_text: str) -> str:
+    """
+    组装系统提示词：静态指令在前，部门方法论在后
+    请求间保持字节一致的前缀（静态指令 + 同部门方法论），以命中服务端前缀缓存；
+    文档内容、自定义提示词等可变内容统一放在用户消息中
+    """
+    return f"{instructions}\n### 你的核心方法论库（{methodology_purpose}）：\n{methodology_text}\n"
+
+
 class AnalysisService:
     def __init__(self):
         # 初始化 OCR 客户端
         self.ocr_client = OCRClient(
             app_id=Config.TEXTIN_APP_ID,
-            secret_code=Config.TEXTIN_SECRET_CODE
+            secret_code=Config.TEXTIN_SECRET_CODE,
+            api_url=Config.OCR_API_URL,
+            pool_size=Config.OCR_HTTP_POOL_SIZE,
+            rate_limiter=TokenBucket(Config.OCR_RATE_LIMIT_PER_SEC, Config.OCR_RATE_LIMIT_BURST),
+            max_in_flight=Config.OCR_HTTP_MAX_IN_FLIGHT
         )
         # 初始化 LLM 客户端
         self.llm_client = LLMClient(
-            api_key=Config.OPENAI_API_KEY,
-            base_url=Config.OPENAI_BASE_URL,
-            model=Config.LLM_MODEL
+            router=self._build_llm_router(),
+            cache=LLMCompletionCache(
+                max_chars=Config.LLM_CACHE_MAX_CHARS,
+                ttl_seconds=Config.LLM_CACHE_TTL_SECONDS
+            ) if Config.LLM_CACHE_ENABLED else None,
+            replay_chunk_chars=Config.LLM_CACHE_REPLAY_CHUNK_CHARS,
+            replay_interval=Config.LLM_CACHE_REPLAY_INTERVAL,
+            stream_usage=Config.LLM_STREAM_USAGE,
+            dispatcher=LLMDispatcher(
+                max_in_flight=Config.LLM_MAX_IN_FLIGHT,
+                model_limits=Config.LLM_MAX_IN_FLIGHT_BY_MODEL,
+                aging_seconds=Config.LLM_PRIORITY_AGING_SECONDS
+            )
+        )
+        # 初始化 OCR 结果缓存（所有入口共享）
+        self.ocr_cache = OCRCache.from_config(Config)
+        # 初始化进程级 OCR 执行器（并发上限 + 有界队列）
+        self.ocr_executor = OCRExecutor(
+            max_workers=Config.OCR_MAX_CONCURRENCY,
+            max_queue=Config.OCR_MAX_QUEUE
+        )
+        # 上下文预算规划（系统提示词 / 方法论 / 文档 / 预留输出）
+        self.context_planner = CONTEXT_PLANNER
+        # 相同分析请求合并（同一文件 + 相同参数的并发请求共享一次 OCR 与 LLM 流）
+        self.analysis_coalescer = StreamCoalescer(
+            join_window=Config.ANALYSIS_COALESCE_JOIN_SECONDS,
+            max_replay_chars=Config.ANALYSIS_COALESCE_MAX_REPLAY_CHARS
+        )
+        # 长文档模式章节摘要线程池（进程内共享，限制同时进行的 map 调用数）
+        self.map_executor = ThreadPoolExecutor(
+            max_workers=max(1, Config.LLM_LONG_DOC_MAP_CONCURRENCY),
+            thread_name_prefix="llm-map"
         )
 
-    def _compress_methodology_text(self, text: str, max_chars: int) -> str:
-        if not text:
-            return ""
-        normalized = text.replace("\r\n", "\n").replace("\r", "\n")
-        normalized = re.sub(r"\n{3,}", "\n\n", normalized)
-        if len(normalized) <= max_chars:
-            return normalized
-        lines = []
-        total = 0
-        for line in normalized.splitlines():
-            s = line.strip()
-            keep = (
-                s == ""
-                or s.startswith("###")
-                or s.startswith("*")
-                or s.startswith("-")
-                or s.startswith("1.")
-                or s.startswith("2.")
-                or s.startswith("3.")
+    @staticmethod
+    def _build_llm_router() -> LLMRouter:
+        """
+        构建 LLM 端点池：配置了 LLM_ENDPOINTS 时使用端点池，否则使用 OPENAI_BASE_URL / LLM_MODEL 单端点
+        """
+        endpoint_configs = Config.LLM_ENDPOINTS or [{
+            "base_url": Config.OPENAI_BASE_URL,
+            "api_key": Config.OPENAI_API_KEY,
+            "model": Config.LLM_MODEL
+        }]
+        # 多端点时减少 SDK 内部重试次数，尽快切换到其他端点
+        max_retries = 3 if len(endpoint_configs) == 1 else 1
+        endpoints = [
+            LLMEndpoint(
+                base_url=item.get("base_url"),
+                api_key=item.get("api_key") or Config.OPENAI_API_KEY,
+                model=item.get("model") or Config.LLM_MODEL,
+                weight=float(item.get("weight", 1.0)),
+                name=item.get("name"),
+                max_retries=max_retries
             )
-            if not keep:
-                continue
-            if total + len(line) + 1 > max_chars:
-                break
-            lines.append(line)
-            total += len(line) + 1
-        compact = "\n".join(lines).strip()
-        if not compact:
-            compact = normalized[:max_chars]
-        return compact[:max_chars]
-
-    def _compress_context_text(self, text: str, max_chars: int) -> tuple[str, bool]:
+            for item in endpoint_configs
+        ]
+        return LLMRouter(
+            endpoints,
+            failure_threshold=Config.LLM_CIRCUIT_FAILURE_THRESHOLD,
+            cooldown_seconds=Config.LLM_CIRCUIT_COOLDOWN_SECONDS
+        )
+
+    def _run_ocr(self, file_content: bytes | SpooledUpload, options: dict = None, progress_callback=None) -> str:
+        """
+        执行 OCR 识别：开启分片模式时按页窗口并发识别，否则整体识别
+        :param progress_callback: 分片进度回调 (已完成分片数, 总分片数)
+        """
+        if isinstance(file_content, SpooledUpload):
+            # 落盘文件：分片模式使用只读内存映射，整体识别直接从磁盘流式上传
+            if Config.OCR_SHARD_PAGES > 0:
+                return self._run_ocr(file_content.buffer(), options, progress_callback)
+            with file_content.open() as f:
+                return self.ocr_client.recognize(f, options)
+
+        if Config.OCR_SHARD_PAGES > 0:
+            return self.ocr_client.recognize_sharded(
+                file_content,
+                options,
+                pages_per_shard=Config.OCR_SHARD_PAGES,
+                max_workers=Config.OCR_SHARD_CONCURRENCY,
+                max_retries=Config.OCR_SHARD_MAX_RETRIES,
+                progress_callback=progress_callback
+            )
+        return self.ocr_client.recognize(file_content, options)
+
+    def _lookup_ocr_cache(self, file_content: bytes | SpooledUpload, options: dict = None) -> tuple[str, str | None]:
+        """
+        查询 OCR 缓存
+        :return: (缓存键, 命中的识别文本；未命中为 None)
+        """
+        cache_options = dict(options or {})
+        if Config.OCR_SHARD_PAGES > 0:
+            # 分片模式的响应只包含合并后的 Markdown（无逐页明细），与整体识别的响应不同，需区分缓存
+            cache_options["__sharded__"] = True
+        if isinstance(file_content, SpooledUpload):
+            # 落盘时已增量计算摘要，无需再次读取文件
+            file_digest = file_content.sha256
+        else:
+            file_digest = hash_file_content(file_content)
+        cache_key = build_cache_key(file_digest, cache_options)
+        cached_text = self.ocr_cache.get(cache_key, file_size=len(file_content or b""))
+        if cached_text is not None:
+            logger.info(f"OCR cache hit: {cache_key[:12]}")
+        return cache_key, cached_text
+
+    def _save_ocr_cache(self, cache_key: str, ocr_text: str) -> None:
+        if ocr_text and ocr_text.strip():
+            self.ocr_cache.set(cache_key, ocr_text)
+
+    def _ocr_with_heartbeat(self, file_content: bytes | SpooledUpload, result: dict, options: dict = None) -> Generator[str, None, None]:
+        """
+        通过共享 OCR 执行器识别文件（优先读取缓存），等待期间产出 SSE 心跳
+        心跳中附带排队位置/预计等待时间，或分片识别进度
+        :param result: 输出参数，识别完成后写入 result["text"]
+        """
+        cache_key, ocr_text = self._lookup_ocr_cache(file_content, options)
+        if ocr_text is not None:
+            result["text"] = ocr_text
+            return
+
+        progress = {"done": 0, "total": 0}
+
+        def on_progress(done: int, total: int):
+            progress["done"] = done
+            progress["total"] = total
+
+        job = self.ocr_executor.submit(self._run_ocr, file_content, options, on_progress)
+        try:
+            # 使用 SSE 协议标准的注释格式 ": comment\n\n"
+            # 许多代理服务器（如Nginx）需要看到 \n\n 才会刷新缓冲区
+            # 且注释行以冒号开头是 SSE 规范，避免前端解析错误
+            while not job.wait(timeout=2.0): # 每2秒醒来一次
+                position = self.ocr_executor.position(job)
+                if position > 0:
+                    eta = int(self.ocr_executor.estimated_wait(job))
+                    yield f": waiting ocr queue keep-alive position={position} eta={eta}s\n\n"
+                elif progress["total"] > 1:
+                    yield f": processing ocr keep-alive {progress['done']}/{progress['total']}\n\n"
+                else:
+                    yield ": processing ocr keep-alive\n\n"
+        finally:
+            # 客户端断开时撤销仍在排队的任务
+            if not job.done:
+                self.ocr_executor.cancel(job)
+
+        ocr_text = job.get() or ""
+        self._save_ocr_cache(cache_key, ocr_text)
+        result["text"] = ocr_text
+
+    def get_runtime_stats(self) -> dict:
+        """
+        运行时统计（缓存命中率等）
+        """
+        return {
+            "ocr_cache": self.ocr_cache.get_stats(),
+            "ocr_client": self.ocr_client.get_stats(),
+            "ocr_executor": self.ocr_executor.get_stats(),
+            "llm_cache": self.llm_client.cache.get_stats() if self.llm_client.cache else None,
+            "methodology_cache": _assemble_methodology_text.cache_info()._asdict(),
+            "llm_usage": self.llm_client.usage_stats.get_stats(),
+            "llm_dispatcher": self.llm_client.dispatcher.get_stats(),
+            "llm_router": self.llm_client.router.get_stats(),
+            "analysis_coalescer": self.analysis_coalescer.get_stats(),
+            "context_plan": self.context_planner.describe()
+        }
+
+    def _compress_context_text(self, text: str, max_tokens: int) -> tuple[str, bool]:
+        """
+        将文本压缩到 token 预算内：优先保留开头、各级标题及其后若干行、结尾
+        """
         if not text:
             return "", False
 
+        estimator = self.context_planner.estimator
         original_len = len(text)
         t = text.replace("\r\n", "\n").replace("\r", "\n")
         t = re.sub(r"[ \t]+", " ", t)
         t = re.sub(r"\n{3,}", "\n\n", t)
         t = re.sub(r"```[\s\S]{2000,}?```", "```(已省略超长代码块)```", t)
 
-        if len(t) <= max_chars:
+        if estimator.count(t) <= max_tokens:
             return t, len(t) != original_len
 
-        lines = t.splitlines()
-        heading_indexes: List[int] = []
-        for i, line in enumerate(lines):
-            s = line.strip()
-            if s.startswith("#"):
-                heading_indexes.append(i)
+        # 开头约占预算的 4/9，结尾约占 1/9，中间部分提取标题提纲；提纲用不完的预算再补给开头
+        head = estimator.truncate(t, max_tokens * 4 // 9)
+        tail = estimator.truncate_tail(t, max_tokens // 9)
+        outline_budget = max_tokens - estimator.count(head) - estimator.count(tail) - 4
+
+        # (行在全文中的起始位置, 行内容)
+        middle_lines = []
+        offset = len(head)
+        for line in t[len(head):len(t) - len(tail)].split("\n"):
+            middle_lines.append((offset, line))
+            offset += len(line) + 1
 
         keep_line_indexes = set()
-        for i in heading_indexes[:200]:
-            for j in range(i, min(i + 6, len(lines))):
-                keep_line_indexes.add(j)
+        for i, (_, line) in enumerate(middle_lines):
+            if line.strip().startswith("#"):
+                keep_line_indexes.update(range(i, min(i + 6, len(middle_lines))))
+
+        outline = []
+        used = 0
+        for i in sorted(keep_line_indexes):
+            line_tokens = estimator.count(middle_lines[i][1]) + 1
+            if used + line_tokens > outline_budget:
+                break
+            outline.append(middle_lines[i])
+            used += line_tokens
 
-        extracted_lines = [lines[i] for i in range(len(lines)) if i in keep_line_indexes]
-        extracted = "\n".join(extracted_lines).strip()
+        if outline_budget - used > 0:
+            head = estimator.truncate(t, estimator.count(head) + outline_budget - used)
+            outline = [item for item in outline if item[0] >= len(head)]
+        extracted = "\n".join(line for _, line in outline).strip()
 
-        head = t[:8000]
-        tail = t[-2000:] if len(t) > 2000 else ""
         combined = "\n\n".join([p for p in [head.strip(), extracted, tail.strip()] if p])
         combined = re.sub(r"\n{3,}", "\n\n", combined)
-        combined = combined[:max_chars]
+        combined = estimator.truncate(combined, max_tokens)
         return combined, True
 
-    def analyze_blueprint(self, file_content: bytes, file_name: str, custom_prompt: str = "", selected_methodologies: List[str] = None, custom_methodologies: List[str] = None) -> Generator[str, None, None]:
+    def _fit_document(self, build_messages, document: str) -> tuple[list, bool]:
+        """
+        按 token 预算装入文档：先以空文档构建消息得到固定开销，剩余输入预算全部留给文档
+        :param build_messages: 以文档文本为参数构建消息列表的函数
+        :return: (消息列表, 文档是否经过压缩)
+        """
+        budget = self.context_planner.document_budget(build_messages(""))
+        fitted, compressed = self._compress_context_text(document, budget)
+        messages = build_messages(fitted)
+        logger.info(f"Context plan: document budget {budget} tokens, prompt ~{self.context_planner.estimator.count_messages(messages)} tokens")
+        return messages, compressed
+
+    def _plan_document_messages(self, build_messages, document: str, long_document: bool | None, focus: str, result: dict, user_id: str | None = None) -> Generator[str, None, None]:
+        """
+        构建最终提示词：开启长文档模式且文档超出预算时，先并发提炼各章节要点（map），再以要点汇总构建提示词（reduce）
+        :param long_document: 是否开启长文档模式，None 表示使用配置 LLM_LONG_DOC_ENABLED
+        :param focus: 章节摘要的关注点
+        :param result: 输出参数，写入 result["messages"] 与 result["compressed"]
+        :param user_id: 用户标识（章节摘要调用按用户公平排队）
+        """
+        enabled = Config.LLM_LONG_DOC_ENABLED if long_document is None else long_document
+        if enabled:
+            reduce_budget = self.context_planner.document_budget(build_messages(""))
+            if self.context_planner.estimator.count(document) > reduce_budget:
+                digest_result = {}
+                yield from self._map_document_sections(document, focus, reduce_budget, digest_result, user_id)
+                digest = digest_result["text"]
+                result["messages"], _ = self._fit_document(build_messages, digest)
+                result["compressed"] = self.context_planner.estimator.count(digest) > reduce_budget
+                return
+
+        result["messages"], result["compressed"] = self._fit_document(build_messages, document)
+
+    def _map_document_sections(self, document: str, focus: str, reduce_budget: int, result: dict, user_id: str | None = None) -> Generator[str, None, None]:
+        """
+        长文档 map 阶段：按标题切分后通过共享线程池并发提炼章节要点，等待期间产出进度心跳
+        :param reduce_budget: reduce 阶段文档可用的 token 数，按章节数均分后作为每个章节摘要的长度上限
+        :param result: 输出参数，完成后写入 result["text"]（按原文顺序拼接的章节要点）
+        """
+        estimator = self.context_planner.estimator
+        map_overhead = estimator.count(LONG_DOC_MAP_SYSTEM_PROMPT) + estimator.count(focus) + 200
+        section_tokens = max(1000, min(Config.LLM_LONG_DOC_SECTION_TOKENS, self.context_planner.input_budget - map_overhead))
+        sections = split_markdown_sections(document, section_tokens, estimator)
+        total = len(sections)
+        digest_tokens = max(200, min(Config.LLM_LONG_DOC_DIGEST_MAX_TOKENS, reduce_budget // max(1, total) - 20))
+        logger.info(f"Long document mode: {total} sections, section budget {section_tokens} tokens, digest budget {digest_tokens} tokens")
+
+        yield f"📚 文档较长，已启用长文档模式：拆分为 {total} 个章节并行提炼要点后再综合分析...\n\n"
+
+        futures = [
+            self.map_executor.submit(self._summarize_section, section, index + 1, total, focus, digest_tokens, user_id)
+            for index, section in enumerate(sections)
+        ]
+        try:
+            while True:
+                done, pending = wait(futures, timeout=2.0)
+                if not pending:
+                    break
+                yield f": summarizing sections keep-alive {len(done)}/{total}\n\n"
+        finally:
+            # 客户端断开时撤销尚未开始的章节摘要
+            for future in futures:
+                future.cancel()
+
+        digests = [future.result() for future in futures]
+        result["text"] = "> 说明：原文较长，以下为按章节顺序提炼的要点汇总。\n\n" + "\n\n".join(digests)
+        yield f"✅ 章节要点提炼完成（共 {total} 个章节），正在综合分析...\n\n"
+
+    def _summarize_section(self, section: DocumentSection, index: int, total: int, focus: str, digest_tokens: int, user_id: str | None = None) -> str:
+        """
+        提炼单个章节要点；调用失败时退化为截断的章节原文，保证 reduce 阶段仍能看到该章节
+        """
+        estimator = self.context_planner.estimator
+        title = section.title or f"第 {index} 部分"
+        max_words = int(digest_tokens / estimator.profile.cjk_tokens_per_char)
+        messages = [
+            {"role": "system", "content": LONG_DOC_MAP_SYSTEM_PROMPT},
+            {"role": "user", "content": (
+                f"### 分析关注点：\n{focus}\n\n"
+                f"### 章节位置：第 {index}/{total} 段（{title}）\n\n"
+                f"### 输出长度：不超过 {max_words} 字\n\n"
+                f"### 章节原文：\n{section.text}"
+            )}
+        ]
+        try:
+            digest = self.llm_client.chat(messages, temperature=0.3, endpoint="long_doc_map", user_id=user_id).strip()
+        except Exception as e:
+            logger.warning(f"Section {index}/{total} summary failed, falling back to raw text: {str(e)}")
+            digest = ""
+        if not digest:
+            digest = estimator.truncate(section.text.strip(), digest_tokens)
+        return f"## [{index}/{total}] {title}\n{estimator.truncate(digest, digest_tokens)}"
+
+    def analyze_blueprint_coalesced(self, file_content: bytes | SpooledUpload, file_name: str, custom_prompt: str = "", selected_methodologies: List[str] = None, custom_methodologies: List[str] = None, long_document: bool | None = None, user_id: str | None = None, role: str | None = None) -> Generator[str, None, None]:
+        """
+        分析蓝图文件（合并相同的并发请求）
+        按 (文件摘要, 自定义提示词, 方法论, 部门, 模型) 合并：首个请求执行分析，后续相同请求回放已产出内容并跟随实时输出
+        参数同 analyze_blueprint；role 为用户部门
+        """
+        if not Config.ANALYSIS_COALESCE_ENABLED:
+            yield from self.analyze_blueprint(file_content, file_name, custom_prompt, selected_methodologies, custom_methodologies, long_document=long_document, user_id=user_id)
+            return
+
+        file_digest = file_content.sha256 if isinstance(file_content, SpooledUpload) else hash_file_content(file_content)
+        key = hashlib.sha256(json.dumps({
+            "file": file_digest,
+            "custom_prompt": (custom_prompt or "").strip(),
+            "methodologies": sorted(selected_methodologies or []),
+            "custom_methodologies": list(custom_methodologies or []),
+            "role": role,
+            "model": self.llm_client.model,
+            "long_document": long_document
+        }, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+        cleanup = None
+        if isinstance(file_content, SpooledUpload):
+            # 后台执行可能比首个请求的连接存活更久，需持有暂存文件引用
+            cleanup = file_content.close
+
+        def start():
+            if isinstance(file_content, SpooledUpload):
+                file_content.retain()
+            return self.analyze_blueprint(file_content, file_name, custom_prompt, selected_methodologies, custom_methodologies, long_document=long_document, user_id=user_id)
+
+        yield from self.analysis_coalescer.stream(key, start, cleanup)
+
+    def analyze_blueprint(self, file_content: bytes | SpooledUpload, file_name: str, custom_prompt: str = "", selected_methodologies: List[str] = None, custom_methodologies: List[str] = None, long_document: bool | None = None, user_id: str | None = None) -> Generator[str, None, None]:
         """
         分析蓝图文件
         :param file_content: 文件内容
@@ -266,59 +844,19 @@ class AnalysisService:
         :param custom_prompt: 用户自定义提示词
         :param selected_methodologies: 用户选择的方法论列表 ['huawei', 'alibaba', ...]
         :param custom_methodologies: 用户自定义的方法论列表
+        :param long_document: 是否开启长文档模式（None 表示使用配置）
+        :param user_id: 用户标识（LLM 调度按用户公平排队）
         :return: LLM 流式响应生成器
         """
         try:
             # 0. 发送初始状态，确保流连接建立
             yield f"🔄 正在解析文档内容，请稍候...\n\n"
             
-            # 定时发送心跳包的生成器函数
-            def keep_alive_ocr():
-                import time
-                while True:
-                    time.sleep(2) # 每2秒检查一次
-                    yield f": keep-alive\n\n"
-
-            # 1. OCR 识别
+            # 1. OCR 识别（经由共享执行器排队，期间发送心跳）
             logger.info(f"Starting OCR for file: {file_name}")
-            
-            # 由于OCR是同步阻塞调用，我们无法在其中插入yield。
-            # 如果OCR非常慢（超过60秒），仍然可能导致超时。
-            # 理想方案是将OCR放入独立线程，主线程yield心跳。
-            # 这里先尝试更激进的padding和更快的响应。
-            
-            import threading
-            import queue
-            
-            ocr_queue = queue.Queue()
-            
-            def run_ocr_thread():
-                try:
-                    text = self.ocr_client.recognize(file_content)
-                    ocr_queue.put({"status": "success", "data": text})
-                except Exception as e:
-                    ocr_queue.put({"status": "error", "error": e})
-            
-            ocr_thread = threading.Thread(target=run_ocr_thread)
-            ocr_thread.start()
-            
-            # 等待OCR结果，期间发送心跳
-            # 使用 SSE 协议标准的注释格式 ": comment\n\n"
-            # 许多代理服务器（如Nginx）需要看到 \n\n 才会刷新缓冲区
-            # 且注释行以冒号开头是 SSE 规范，避免前端解析错误
-            while ocr_thread.is_alive():
-                ocr_thread.join(timeout=2.0) # 每2秒醒来一次
-                if ocr_thread.is_alive():
-                     yield f": processing ocr keep-alive\n\n" 
-            
-            # 获取结果
-            if not ocr_queue.empty():
-                result = ocr_queue.get()
-                if result["status"] == "error":
-                     raise result["error"]
-                ocr_text = result["data"]
-            else:
-                ocr_text = ""
+            ocr_result = {}
+            yield from self._ocr_with_heartbeat(file_content, ocr_result)
+            ocr_text = ocr_result["text"]
             
             logger.info(f"OCR result length: {len(ocr_text) if ocr_text else 0}")
 
@@ -330,16 +868,24 @@ class AnalysisService:
             logger.info("OCR completed, constructing prompt...")
 
             # 2. 构建提示词
-            compressed_text, compressed = self._compress_context_text(ocr_text, max_chars=18000)
-            if compressed:
+            plan = {}
+            yield from self._plan_document_messages(
+                lambda text: self._build_prompt(text, custom_prompt, selected_methodologies, custom_methodologies),
+                ocr_text,
+                long_document,
+                "蓝图评审：战略目标与指标、业务与组织架构、关键举措与实施路径、资源与风险，以及其中的缺陷与矛盾",
+                plan,
+                user_id
+            )
+            prompt_messages = plan["messages"]
+            if plan["compressed"]:
                 yield "📉 文档内容较长，已自动提炼关键内容以适配模型上下文限制。\n\n"
 
-            prompt_messages = self._build_prompt(compressed_text, custom_prompt, selected_methodologies, custom_methodologies)
             logger.info(f"Prompt constructed with {len(prompt_messages)} messages")
 
             # 3. LLM 流式分析
             logger.info("Starting LLM stream...")
-            for chunk in self.llm_client.chat_stream(prompt_messages):
+            for chunk in self.llm_client.chat_stream(prompt_messages, endpoint="analyze_blueprint", user_id=user_id, priority=PRIORITY_NORMAL):
                 logger.debug(f"Yielding chunk: {len(chunk)} chars")
                 yield chunk
             logger.info("LLM stream completed")
@@ -348,10 +894,11 @@ class AnalysisService:
             logger.error(f"Analysis failed: {str(e)}", exc_info=True)
             yield f"\n\n**系统错误**: {str(e)}"
 
-    def generate_mindmap(self, markdown_content: str) -> Generator[str, None, None]:
+    def generate_mindmap(self, markdown_content: str, user_id: str | None = None) -> Generator[str, None, None]:
         """
         基于分析报告生成思维导图 (Markmap 格式)
         :param markdown_content: 分析报告内容
+        :param user_id: 用户标识（LLM 调度按用户公平排队）
         :return: LLM 流式响应生成器
         """
         try:
@@ -391,18 +938,19 @@ class AnalysisService:
                 {"role": "user", "content": user_prompt}
             ]
             
-            for chunk in self.llm_client.chat_stream(messages):
+            for chunk in self.llm_client.chat_stream(messages, endpoint="generate_mindmap", user_id=user_id, priority=PRIORITY_HIGH):
                 yield chunk
                 
         except Exception as e:
             logger.error(f"Mindmap generation failed: {str(e)}", exc_info=True)
-            yield f"思维导图生成失败: {str(e)}"
+            yield f"{MINDMAP_FAILURE_PREFIX}{str(e)}"
 
-    def analyze_blueprint_to_mindmap(self, file_content: bytes, file_name: str) -> Generator[str, None, None]:
+    def analyze_blueprint_to_mindmap(self, file_content: bytes | SpooledUpload, file_name: str, user_id: str | None = None) -> Generator[str, None, None]:
         """
         分析蓝图文件并直接生成诊断思维导图
         :param file_content: 文件内容
         :param file_name: 文件名
+        :param user_id: 用户标识（LLM 调度按用户公平排队）
         :return: LLM 流式响应生成器 (Markmap Markdown)
         """
         try:
@@ -410,36 +958,10 @@ class AnalysisService:
             logger.info(f"Starting OCR for diagnosis mindmap: {file_name}")
             yield "# 🚀 正在解析蓝图结构...\n"
             
-            # 使用多线程+心跳机制处理OCR
-            import threading
-            import queue
-            
-            ocr_queue = queue.Queue()
-            
-            def run_ocr_thread():
-                try:
-                    text = self.ocr_client.recognize(file_content)
-                    ocr_queue.put({"status": "success", "data": text})
-                except Exception as e:
-                    ocr_queue.put({"status": "error", "error": e})
-            
-            ocr_thread = threading.Thread(target=run_ocr_thread)
-            ocr_thread.start()
-            
-            # 等待OCR结果，期间发送心跳
-            while ocr_thread.is_alive():
-                ocr_thread.join(timeout=2.0)
-                if ocr_thread.is_alive():
-                     yield f": processing ocr keep-alive\n\n" 
-            
-            # 获取结果
-            if not ocr_queue.empty():
-                result = ocr_queue.get()
-                if result["status"] == "error":
-                     raise result["error"]
-                ocr_text = result["data"]
-            else:
-                ocr_text = ""
+            # 使用共享执行器排队识别，期间发送心跳
+            ocr_result = {}
+            yield from self._ocr_with_heartbeat(file_content, ocr_result)
+            ocr_text = ocr_result["text"]
             
             if not ocr_text or len(ocr_text.strip()) == 0:
                 logger.warning("OCR returned empty text")
@@ -451,8 +973,8 @@ class AnalysisService:
             # 2. 生成思维导图
             yield "\n# 🧠 正在生成诊断思维导图...\n"
             
-            # 构建生成思维导图的 Prompt
-            prompt_messages = [
+            # 构建生成思维导图的 Prompt（文档按 token 预算装入）
+            prompt_messages, _ = self._fit_document(lambda text: [
                 {"role": "system", "content": """
                 你是一个战略咨询专家。请根据用户提供的文档内容，直接生成一份**Markmap格式**的诊断思维导图。
                 
@@ -462,17 +984,17 @@ class AnalysisService:
                 3. 使用 Emoji 增强可读性。
                 4. 只输出 Markmap Markdown 代码，不要包含 ```markdown 代码块标记。
                 """},
-                {"role": "user", "content": f"文档内容如下：\n\n{ocr_text[:50000]}"} # 截断防止超长
-            ]
+                {"role": "user", "content": f"文档内容如下：\n\n{text}"}
+            ], ocr_text)
             
-            for chunk in self.llm_client.chat_stream(prompt_messages):
+            for chunk in self.llm_client.chat_stream(prompt_messages, endpoint="analyze_blueprint_to_mindmap", user_id=user_id, priority=PRIORITY_HIGH):
                 yield chunk
 
         except Exception as e:
             logger.error(f"Mindmap analysis failed: {str(e)}", exc_info=True)
             yield f"\n# ❌ 分析失败: {str(e)}"
 
-    def generate_smart_mindmap(self, file_content: bytes, file_name: str) -> Generator[str, None, None]:
+    def generate_smart_mindmap(self, file_content: bytes | SpooledUpload, file_name: str, user_id: str | None = None) -> Generator[str, None, None]:
         """
         生成智能思维导图
         """
@@ -481,36 +1003,10 @@ class AnalysisService:
             logger.info(f"Starting OCR for smart mindmap: {file_name}")
             yield "# 🚀 正在读取文档内容...\n"
             
-            # 使用多线程+心跳机制处理OCR
-            import threading
-            import queue
-            
-            ocr_queue = queue.Queue()
-            
-            def run_ocr_thread():
-                try:
-                    text = self.ocr_client.recognize(file_content)
-                    ocr_queue.put({"status": "success", "data": text})
-                except Exception as e:
-                    ocr_queue.put({"status": "error", "error": e})
-            
-            ocr_thread = threading.Thread(target=run_ocr_thread)
-            ocr_thread.start()
-            
-            # 等待OCR结果，期间发送心跳
-            while ocr_thread.is_alive():
-                ocr_thread.join(timeout=2.0)
-                if ocr_thread.is_alive():
-                     yield f": processing ocr keep-alive\n\n"
-            
-            # 获取结果
-            if not ocr_queue.empty():
-                result = ocr_queue.get()
-                if result["status"] == "error":
-                     raise result["error"]
-                ocr_text = result["data"]
-            else:
-                ocr_text = ""
+            # 使用共享执行器排队识别，期间发送心跳
+            ocr_result = {}
+            yield from self._ocr_with_heartbeat(file_content, ocr_result)
+            ocr_text = ocr_result["text"]
                 
             if not ocr_text:
                 yield "无法识别文件内容"
@@ -519,29 +1015,30 @@ class AnalysisService:
             logger.info("OCR completed, generating mindmap...")
             yield "\n# 💡 正在构建思维导图...\n"
             
-            prompt_messages = [
+            prompt_messages, _ = self._fit_document(lambda text: [
                 {"role": "system", "content": """
                 请将以下文档内容整理为清晰的 Markmap 思维导图。
                 保持结构化，提取关键信息。
                 只输出 Markdown 内容。
                 """},
-                {"role": "user", "content": ocr_text[:50000]}
-            ]
+                {"role": "user", "content": text}
+            ], ocr_text)
             
-            for chunk in self.llm_client.chat_stream(prompt_messages):
+            for chunk in self.llm_client.chat_stream(prompt_messages, endpoint="generate_smart_mindmap", user_id=user_id, priority=PRIORITY_HIGH):
                 yield chunk
 
         except Exception as e:
             logger.error(f"Smart mindmap failed: {str(e)}", exc_info=True)
             yield f"\n# ❌ 生成失败: {str(e)}"
 
-    def generate_proposal(self, client_needs: str, user_ideas: str, selected_methodologies: List[str] = None, custom_methodologies: List[str] = None, reference_file_content: bytes | None = None, reference_file_name: str | None = None) -> Generator[str, None, None]:
+    def generate_proposal(self, client_needs: str, user_ideas: str, selected_methodologies: List[str] = None, custom_methodologies: List[str] = None, reference_file_content: bytes | SpooledUpload | None = None, reference_file_name: str | None = None, user_id: str | None = None) -> Generator[str, None, None]:
         """
         根据需求和想法生成蓝图方案
         :param client_needs: 客户需求
         :param user_ideas: 用户想法/参考资料
         :param selected_methodologies: 选择的方法论
         :param custom_methodologies: 自定义方法论
+        :param user_id: 用户标识（LLM 调度按用户公平排队）
         :return: LLM 流式响应生成器
         """
         try:
@@ -551,29 +1048,35 @@ class AnalysisService:
             reference_text = ""
             if reference_file_content and reference_file_name:
                 yield "📎 正在解析参考资料，请稍候...\n\n"
-                try:
-                    reference_text = self.ocr_client.recognize(reference_file_content)
-                except Exception as e:
-                    logger.error(f"Reference file OCR failed: {str(e)}", exc_info=True)
+                # 识别失败（含 OCR 排队已满）与其他识别路径一致，由外层返回错误信息，不再忽略参考资料继续生成
+                ocr_result = {}
+                yield from self._ocr_with_heartbeat(reference_file_content, ocr_result)
+                reference_text = ocr_result["text"]
 
             ideas_parts = []
             if user_ideas and user_ideas.strip():
                 ideas_parts.append(user_ideas.strip())
+
+            # 1. 构建提示词（参考资料按剩余 token 预算装入）
             if reference_text and reference_text.strip():
-                compressed_ref, compressed = self._compress_context_text(reference_text.strip(), max_chars=12000)
+                prompt_messages, compressed = self._fit_document(
+                    lambda text: self._build_proposal_prompt(
+                        client_needs,
+                        "\n\n".join(ideas_parts + [f"### 参考资料附件：{reference_file_name}\n{text}"]),
+                        selected_methodologies,
+                        custom_methodologies
+                    ),
+                    reference_text.strip()
+                )
                 if compressed:
                     yield "📉 参考资料较长，已自动提炼关键内容以适配模型上下文限制。\n\n"
-                ideas_parts.append(f"### 参考资料附件：{reference_file_name}\n{compressed_ref}")
-
-            merged_user_ideas = "\n\n".join(ideas_parts)
-
-            # 1. 构建提示词
-            prompt_messages = self._build_proposal_prompt(client_needs, merged_user_ideas, selected_methodologies, custom_methodologies)
+            else:
+                prompt_messages = self._build_proposal_prompt(client_needs, "\n\n".join(ideas_parts), selected_methodologies, custom_methodologies)
             logger.info(f"Proposal prompt constructed with {len(prompt_messages)} messages")
 
             # 2. LLM 流式生成
             logger.info("Starting LLM stream for proposal...")
-            for chunk in self.llm_client.chat_stream(prompt_messages):
+            for chunk in self.llm_client.chat_stream(prompt_messages, endpoint="generate_proposal", user_id=user_id, priority=PRIORITY_NORMAL):
                 yield chunk
             logger.info("LLM stream completed")
 
@@ -581,25 +1084,35 @@ class AnalysisService:
             logger.error(f"Proposal generation failed: {str(e)}", exc_info=True)
             yield f"\n\n**系统错误**: {str(e)}"
 
-    def generate_sub_proposal(self, parent_file_content: bytes, parent_file_name: str, sub_topic: str, user_ideas: str, selected_methodologies: List[str] = None, custom_methodologies: List[str] = None) -> Generator[str, None, None]:
+    def generate_sub_proposal(self, parent_file_content: bytes | SpooledUpload, parent_file_name: str, sub_topic: str, user_ideas: str, selected_methodologies: List[str] = None, custom_methodologies: List[str] = None, long_document: bool | None = None, user_id: str | None = None) -> Generator[str, None, None]:
         try:
             yield "🔄 正在解析父方案内容，请稍候...\n\n"
 
-            parent_text = self.ocr_client.recognize(parent_file_content)
+            ocr_result = {}
+            yield from self._ocr_with_heartbeat(parent_file_content, ocr_result)
+            parent_text = ocr_result["text"]
             if not parent_text or len(parent_text.strip()) == 0:
                 yield "❌ 无法识别父方案内容，请检查文件是否清晰或格式是否正确。"
                 return
 
             yield "🔄 正在生成子专项方案，请稍候...\n\n"
 
-            compressed_parent, compressed = self._compress_context_text(parent_text, max_chars=18000)
-            if compressed:
+            plan = {}
+            yield from self._plan_document_messages(
+                lambda text: self._build_sub_proposal_prompt(text, parent_file_name, sub_topic, user_ideas, selected_methodologies, custom_methodologies),
+                parent_text,
+                long_document,
+                f"为子专项“{sub_topic}”设计方案：父方案的总体目标、边界与约束，以及与该子专项相关的策略、流程、组织、系统与数据",
+                plan,
+                user_id
+            )
+            prompt_messages = plan["messages"]
+            if plan["compressed"]:
                 yield "📉 父方案内容较长，已自动提炼关键内容以适配模型上下文限制。\n\n"
 
-            prompt_messages = self._build_sub_proposal_prompt(compressed_parent, parent_file_name, sub_topic, user_ideas, selected_methodologies, custom_methodologies)
             logger.info(f"Sub proposal prompt constructed with {len(prompt_messages)} messages")
 
-            for chunk in self.llm_client.chat_stream(prompt_messages):
+            for chunk in self.llm_client.chat_stream(prompt_messages, endpoint="generate_sub_proposal", user_id=user_id, priority=PRIORITY_NORMAL):
                 yield chunk
 
         except Exception as e:
@@ -607,63 +1120,14 @@ class AnalysisService:
             yield f"\n\n**系统错误**: {str(e)}"
 
     def _build_sub_proposal_prompt(self, parent_text: str, parent_file_name: str, sub_topic: str, user_ideas: str, selected_methodologies: List[str] = None, custom_methodologies: List[str] = None) -> list:
-        methodology_text = ""
-
-        if selected_methodologies:
-            for item in selected_methodologies:
-                if ":" in item:
-                    vendor, scenario = item.split(":", 1)
-                    if vendor in METHODOLOGIES_STRUCTURED and scenario in METHODOLOGIES_STRUCTURED[vendor]["scenarios"]:
-                        scenario_data = METHODOLOGIES_STRUCTURED[vendor]["scenarios"][scenario]
-                        methodology_text += f"\n### 【{METHODOLOGIES_STRUCTURED[vendor]['label']} - {scenario_data['label']}】\n{scenario_data['content']}\n"
-                else:
-                    vendor = item
-                    if vendor in METHODOLOGIES_STRUCTURED:
-                        methodology_text += f"\n### 【{METHODOLOGIES_STRUCTURED[vendor]['label']} (全场景)】\n"
-                        for s_key, s_data in METHODOLOGIES_STRUCTURED[vendor]["scenarios"].items():
-                            methodology_text += f"{s_data['content']}\n"
-
-        if custom_methodologies:
-            methodology_text += "\n### 【部门默认参考书籍/理论】\n"
-            for cm in custom_methodologies:
-                if cm.strip():
-                    methodology_text += f"*   📖 **{cm}**\n"
-
-        methodology_text = self._compress_methodology_text(methodology_text, max_chars=8000)
+        methodology_text = build_methodology_text(selected_methodologies, custom_methodologies)
 
-        system_prompt = f"""
-        你是一位**资深解决方案架构师**。
-
-        ### 你的核心方法论库（本次子专项方案设计依据）：
-        {methodology_text}
-
-        ### 你的任务：
-        用户上传了一份《父方案》，并指定要输出其中某一个“子专项/子方案”。
-        你需要先阅读父方案内容，理解总体目标、边界、核心策略与约束，然后基于用户的子专项描述与方法论，生成一份可落地的子专项方案。
-
-        ### 输出要求：
-        - 必须完全中文输出（专有名词除外）
-        - 必须与父方案保持一致：目标、术语、口径、约束
-        - 必须可执行：包含流程、部门/角色、输入输出、里程碑、风险与保障
-        - 如果用户描述不足，允许你在方案中显式列出“需要用户补充的信息清单”
-
-        ### 输出格式（Markdown）：
-        # 🧩 子专项方案 - {sub_topic}
-        
-        > 📎 父方案来源：{parent_file_name}
-
-        ## 1. 子专项定位与目标
-        ## 2. 与父方案的一致性对齐（目标/范围/约束/依赖）
-        ## 3. 现状与问题（基于父方案摘要 + 用户补充）
-        ## 4. 方案设计（策略/流程/系统/数据/组织）
-        ## 5. 关键流程与协作机制（部门/角色/职责/RACI）
-        ## 6. 交付物清单（模板/表单/规范/看板）
-        ## 7. 实施计划（里程碑/迭代节奏/验收标准）
-        ## 8. 风险与对策
-        ## 9. 需要补充的信息清单（如果有）
-        """
+        system_prompt = _compose_system_prompt(SUB_PROPOSAL_SYSTEM_PROMPT, "本次子专项方案设计依据", methodology_text)
 
         user_input_content = f"""
+        ### 父方案文件名：
+        {parent_file_name}
+
         ### 父方案内容（OCR 提取，可能存在排版噪声）：
         {parent_text}
 
@@ -683,77 +1147,10 @@ class AnalysisService:
         """
         构建方案生成提示词
         """
-        # 复用 _build_prompt 中的方法论构建逻辑
-        methodology_text = ""
-        
-        if selected_methodologies:
-            for item in selected_methodologies:
-                if ":" in item:
-                    vendor, scenario = item.split(":", 1)
-                    if vendor in METHODOLOGIES_STRUCTURED and scenario in METHODOLOGIES_STRUCTURED[vendor]["scenarios"]:
-                        scenario_data = METHODOLOGIES_STRUCTURED[vendor]["scenarios"][scenario]
-                        methodology_text += f"\n### 【{METHODOLOGIES_STRUCTURED[vendor]['label']} - {scenario_data['label']}】\n{scenario_data['content']}\n"
-                else:
-                    vendor = item
-                    if vendor in METHODOLOGIES_STRUCTURED:
-                        methodology_text += f"\n### 【{METHODOLOGIES_STRUCTURED[vendor]['label']} (全场景)】\n"
-                        for s_key, s_data in METHODOLOGIES_STRUCTURED[vendor]["scenarios"].items():
-                            methodology_text += f"{s_data['content']}\n"
-
-        if custom_methodologies:
-            methodology_text += "\n### 【部门默认参考书籍/理论】\n"
-            for cm in custom_methodologies:
-                if cm.strip():
-                    methodology_text += f"*   📖 **{cm}**\n"
-
-        methodology_text = self._compress_methodology_text(methodology_text, max_chars=8000)
-
-        system_prompt = f"""
-        你是一位**首席解决方案架构师**和**创意总监**。
-        你精通各类商业模式、营销策略和企业架构设计。
-        
-        ### 你的核心方法论库（本次方案设计依据）：
-        {methodology_text}
+        # 复用预编译的方法论片段
+        methodology_text = build_methodology_text(selected_methodologies, custom_methodologies)
 
-        ### 你的任务：
-        根据用户提供的“客户需求”和“初步想法/参考资料”，结合上述方法论，**从0到1设计一份完整的蓝图方案**。
-        
-        ### 你的角色设定：
-        *   **极度专业**：使用专业术语，逻辑严密。
-        *   **落地导向**：不仅要有高大上的理论，还要有可执行的落地方案。
-        *   **创新思维**：结合用户想法，提供超越预期的创意点。
-        *   **语言要求**：**必须完全使用中文输出**，除非专有名词必须保留英文。请务必检查你的每一句输出，确保没有英文句子。
-
-        ### 输出格式要求 (Markdown)：
-        
-        # 🚀 [项目名称] - 蓝图设计方案
-        
-        > 📋 **方案摘要**：
-        > (简述方案核心价值和亮点)
-        
-        ## 1. 需求分析与背景 (Context)
-        *   **客户痛点**：...
-        *   **核心目标**：...
-        
-        ## 2. 核心策略与理念 (Strategy)
-        (结合选定的方法论进行阐述)
-        *   **理论支撑**：基于[某方法论]...
-        *   **战略定位**：...
-        
-        ## 3. 总体架构设计 (Architecture)
-        *   **业务架构**：...
-        *   **关键流程**：...
-        
-        ## 4. 关键行动举措 (Key Actions)
-        *   ✅ **行动1**：...
-        *   ✅ **行动2**：...
-        
-        ## 5. 预期价值与成果 (Value)
-        *   ...
-        
-        ---
-        > 💡 **专家建议**：(给客户的一句核心建议)
-        """
+        system_prompt = _compose_system_prompt(PROPOSAL_SYSTEM_PROMPT, "本次方案设计依据", methodology_text)
 
         user_input_content = f"""
         ### 客户需求 (Client Needs)：
@@ -774,129 +1171,10 @@ class AnalysisService:
         """
         构建提示词工程
         """
-        # 构建方法论部分
-        methodology_text = ""
-        
-        # 兼容旧逻辑：如果参数是 ['huawei', 'alibaba'] 这种顶层key，默认加载该厂商下的所有场景
-        # 如果参数是 ['huawei:strategy', 'huawei:product_dev'] 这种具体场景，则按需加载
-        
-        selected_scenarios = []
-        if selected_methodologies:
-            for item in selected_methodologies:
-                if ":" in item:
-                    # 格式: "vendor:scenario"
-                    vendor, scenario = item.split(":", 1)
-                    if vendor in METHODOLOGIES_STRUCTURED and scenario in METHODOLOGIES_STRUCTURED[vendor]["scenarios"]:
-                        scenario_data = METHODOLOGIES_STRUCTURED[vendor]["scenarios"][scenario]
-                        methodology_text += f"\n### 【{METHODOLOGIES_STRUCTURED[vendor]['label']} - {scenario_data['label']}】\n{scenario_data['content']}\n"
-                else:
-                    # 格式: "vendor" (加载该厂商所有场景)
-                    vendor = item
-                    if vendor in METHODOLOGIES_STRUCTURED:
-                        methodology_text += f"\n### 【{METHODOLOGIES_STRUCTURED[vendor]['label']} (全场景)】\n"
-                        for s_key, s_data in METHODOLOGIES_STRUCTURED[vendor]["scenarios"].items():
-                            methodology_text += f"{s_data['content']}\n"
-
-        # 如果未选择任何方法论且无自定义，默认加载所有厂商的战略层场景（避免token过多）
-        if not methodology_text and not custom_methodologies:
-             for vendor, v_data in METHODOLOGIES_STRUCTURED.items():
-                 if "strategy" in v_data["scenarios"]:
-                     s_data = v_data["scenarios"]["strategy"]
-                     methodology_text += f"\n### 【{v_data['label']} - {s_data['label']}】\n{s_data['content']}\n"
-
-        
-        # 添加用户自定义书籍/方法论
-        if custom_methodologies:
-            methodology_text += "\n### 【部门默认参考书籍/理论】\n"
-            for cm in custom_methodologies:
-                if cm.strip():
-                    methodology_text += f"*   📖 **{cm}**\n"
-
-        methodology_text = self._compress_methodology_text(methodology_text, max_chars=8000)
-
-        system_prompt = f"""
-你是一位**蓝图大师 (Blueprint Master)**，一位拥有20年实战经验的企业级架构治理专家。
-你熟读并精通**华为（Huawei）**全套管理变革方法论，以及**TOGAF**、**ITIL**、**PMP**等国际标准。
-你的核心能力是能够像“外科医生”一样，对企业的各类蓝图文档（战略/业务/技术/管理）进行精准诊断。
-
-### 你的核心方法论库（本次评审依据）：
-{methodology_text}
-
-### 你的角色设定与自我认知：
-*   **我是谁**：我不是一个简单的AI助手，我是用户的“首席架构顾问”。
-*   **我的视角**：我始终站在“企业长期价值最大化”和“从战略到执行闭环”的高度。
-*   **我的态度**：客观、犀利、建设性。对于反模式（Anti-Pattern）设计，我会毫不留情地指出风险；对于优秀实践，我会给予肯定并升华理论。
-
-### 你的说话风格（Professional & Insightful）：
-*   **语言要求**：**必须完全使用中文输出**，除非专有名词（如BLM, IPD）必须保留英文。请务必检查你的每一句输出，确保没有英文句子。
-*   **极度专业**：请使用最严谨、专业的架构师/咨询顾问术语。拒绝口语化，拒绝“风趣幽默”，保持客观、冷静、权威的咨询顾问形象。
-*   **深度洞察**：不要停留在表面现象，要挖掘文档背后的业务逻辑缺失、架构设计隐患和管理机制漏洞。
-*   **有理有据**：所有的评审意见必须严格对应上述【核心方法论库】中的具体理论。例如：“根据华为BLM模型，该规划在‘战略意图’与‘业务设计’之间缺乏逻辑衔接...”。
-*   **结构化输出**：使用金字塔原理组织内容，结论先行，以上统下。
-
-### 你的任务：
-对用户上传的项目蓝图文档进行**大师级深度评审**。
-
-### 评审步骤与思维链（CoT）：
-1.  **场景匹配与定性**：
-    *   首先分析文档属于什么类型的蓝图（如：战略规划、IT架构设计、销售项目运作、产品研发管理、供应链流程等）。
-    *   然后明确本次评审主要引用的方法论场景（例如：针对销售项目，重点引用华为LTC流程）。
-2.  **深度扫描与差距分析**：
-    *   对照选定的方法论标准，逐一扫描文档内容。
-    *   寻找“缺失环节”（如：有目标无路径）、“逻辑断点”（如：业务与IT脱节）、“反模式设计”（如：烟囱式建设）。
-3.  **专业诊断与建议**：
-    *   指出问题，并给出基于大厂实践的改进建议。
+        # 构建方法论部分（未选择任何方法论且无部门书籍时，默认加载所有厂商的战略层场景）
+        methodology_text = build_methodology_text(selected_methodologies, custom_methodologies, use_default=True)
 
----
-
-### 请严格按照以下 Markdown 格式输出报告（不要包含 ```markdown 代码块包裹，直接输出内容）：
-
-# 🏗️ 蓝图大师深度评审报告
-
-> 📋 **执行摘要 (Executive Summary)**：
-> (用一段简练的专业语言综述评审结论。例如：“经评审，该《数字化转型规划》在技术架构层面较为完备，但在战略解码与组织适配层面存在显著缺失，建议引入华为BLM模型强化从战略到执行的闭环...”)
-
-## 1. 蓝图定性与场景匹配
-*   **蓝图类型**：[例如：企业级IT战略规划]
-*   **适用场景**：[例如：华为 BLM 战略规划 + 华为 数字化转型]
-*   **核心特征**：(简述文档的核心特征与现状)
-
-## 2. 亮点分析 (Highlights)
-(列出 2-3 个值得肯定的地方，并说明符合哪家大厂的什么理念)
-*   ✅ **[亮点1]**：... (符合...原则)
-
-## 3. 关键缺陷与深度剖析 (Critical Deficiencies)
-(这是报告的核心，请至少列出 3 个深度问题。请务必使用专业术语，逻辑严密。)
-
-### 3.1 [缺陷标题，例如：战略意图与业务设计脱节]
-*   **🔴 问题描述**：(客观描述文档中存在的问题，引用原文)
-*   **📉 深度归因**：
-    *   **理论依据**：依据 **[具体方法论名称]**，...
-    *   **差距分析**：文档中缺少了...导致无法支撑...
-    *   **潜在风险**：如果维持现状，将导致...（如：IT投资回报率低、系统孤岛严重等）。
-*   **💡 改进建议**：
-    *   引入...机制/流程。
-    *   具体重构建议：...
-
-### 3.2 [缺陷标题]
-*   **🔴 问题描述**：...
-*   **📉 深度归因**：...
-*   **💡 改进建议**：...
-
-(以此类推...)
-
-## 4. 实施路线图建议 (Implementation Roadmap)
-(基于现状给出的分阶段实施建议)
-*   **阶段一：速赢 (Quick Wins)** - [时间周期]
-    *   ...
-*   **阶段二：能力构建 (Capability Building)** - [时间周期]
-    *   ...
-*   **阶段三：生态演进 (Ecosystem Evolution)** - [时间周期]
-    *   ...
-
----
-> 🔚 **结语**：(一句专业的总结致辞)
-"""
+        system_prompt = _compose_system_prompt(DIAGNOSIS_SYSTEM_PROMPT, "本次评审依据", methodology_text)
         
         user_input_content = f"请根据以下项目蓝图文档内容进行分析：\n\n{context_text}"
         
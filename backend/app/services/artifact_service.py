@@ -0,0 +1,169 @@
+# 文件名：artifact_service.py
+"""
+功能说明：历史记录派生文件（Word 导出、思维导图）
+核心功能：
+1. 按历史记录生成派生文件，以 (类型, 生成器版本, 正文摘要) 为键保存到派生文件存储，同一内容只生成一次
+2. 生成后把键记录在历史摘要的 artifacts 字段：再次请求无需读取 / 解压正文即可定位文件，携带相同 ETag 时直接返回 304
+3. Word 导出同步生成（按键分段加锁，并发请求只生成一次）
+4. 思维导图首次请求流式输出（相同键的并发请求合并为一次 LLM 调用），完整结束后保存，之后作为静态文件下发
+依赖模块：extensions, artifact_store, docx_generator, single_flight
+"""
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Generator, Iterable, Optional, Tuple
+
+from bson import ObjectId
+
+from app.config import Config
+from app.extensions import mongo
+from app.services.analysis_service import MINDMAP_FAILURE_PREFIX, MINDMAP_PROMPT_VERSION
+from app.services.history_service import HISTORY_STATUS_DONE, load_history_content
+from app.utils.artifact_store import ArtifactStore, StoredArtifact, build_artifact_key
+from app.utils.docx_generator import RENDERER_VERSION, generate_blueprint_docx
+from app.utils.single_flight import StreamCoalescer
+
+logger = logging.getLogger(__name__)
+
+KIND_DOCX = "docx"
+KIND_MINDMAP = "mindmap"
+
+DOCX_MIMETYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+MINDMAP_MIMETYPE = "text/markdown"
+
+# 查询历史摘要时排除旧记录的内联正文（命中已保存的派生文件时无需读取正文）
+HISTORY_PROJECTION = {"content": 0}
+
+artifact_store = ArtifactStore.from_config(Config)
+mindmap_coalescer = StreamCoalescer(
+    join_window=Config.ANALYSIS_COALESCE_JOIN_SECONDS,
+    max_replay_chars=Config.ANALYSIS_COALESCE_MAX_REPLAY_CHARS
+)
+
+# Word 生成按键分段加锁：相同内容的并发导出只生成一次，锁数量固定
+_DOCX_LOCKS = [threading.Lock() for _ in range(32)]
+
+
+def _docx_lock(key: str) -> threading.Lock:
+    return _DOCX_LOCKS[int(key[:8], 16) % len(_DOCX_LOCKS)]
+
+
+def artifact_version(kind: str) -> str:
+    """
+    生成器版本：Word 为渲染器版本，思维导图为提示词版本 + 模型
+    """
+    if kind == KIND_DOCX:
+        return RENDERER_VERSION
+    return f"{MINDMAP_PROMPT_VERSION}:{Config.LLM_MODEL}"
+
+
+def is_history_ready(doc: dict) -> bool:
+    # 旧记录没有 status 字段，视为已完成
+    return doc.get("status", HISTORY_STATUS_DONE) == HISTORY_STATUS_DONE
+
+
+def recorded_key(doc: dict, kind: str) -> Optional[str]:
+    """
+    历史摘要中记录的派生文件键（生成器版本已变化时视为无记录）
+    """
+    entry = (doc.get("artifacts") or {}).get(kind)
+    if entry and entry.get("version") == artifact_version(kind):
+        return entry.get("key")
+    return None
+
+
+def _record(history_id: ObjectId, kind: str, key: str, length: int) -> None:
+    mongo.db.analysis_histories.update_one(
+        {"_id": history_id},
+        {"$set": {f"artifacts.{kind}": {
+            "key": key,
+            "version": artifact_version(kind),
+            "size": length,
+            "created_at": datetime.utcnow()
+        }}}
+    )
+
+
+def _source_text(doc: dict) -> str:
+    if doc.get("storage") is None and "content" not in doc:
+        # 旧记录正文内联在摘要中，查询时已排除，按需读取
+        doc = mongo.db.analysis_histories.find_one({"_id": doc["_id"]}, {"content": 1}) or {}
+    return load_history_content(doc)
+
+
+def lookup_artifact(doc: dict, kind: str) -> Tuple[Optional[str], Optional[StoredArtifact], Optional[str]]:
+    """
+    查找历史记录的派生文件
+    :return: (键, 已保存的文件, 正文)；记录的键命中时不读取正文（正文为 None）；正文为空时键为 None
+    """
+    key = recorded_key(doc, kind)
+    if key:
+        artifact = artifact_store.open(key)
+        if artifact is not None:
+            return key, artifact, None
+
+    source = _source_text(doc)
+    if not source:
+        return None, None, source
+    key = build_artifact_key(kind, artifact_version(kind), source)
+    artifact = artifact_store.open(key)
+    if artifact is not None:
+        # 其他历史记录已生成过相同内容的文件（或键记录丢失），补记到当前记录
+        _record(doc["_id"], kind, key, artifact.length)
+    return key, artifact, source
+
+
+def get_history_docx(doc: dict) -> Optional[StoredArtifact]:
+    """
+    获取历史记录的 Word 文件，不存在时生成并保存
+    :return: 已保存的文件；正文为空时返回 None
+    """
+    key, artifact, source = lookup_artifact(doc, KIND_DOCX)
+    if artifact is not None or not key:
+        return artifact
+
+    with _docx_lock(key):
+        # 等锁期间可能已由并发请求生成
+        artifact = artifact_store.open(key)
+        if artifact is None:
+            docx_stream = generate_blueprint_docx(source, spool_max_memory=Config.DOCX_SPOOL_MAX_MEMORY)
+            try:
+                docx_stream.seek(0)
+                artifact_store.put(key, docx_stream, DOCX_MIMETYPE)
+            finally:
+                docx_stream.close()
+            artifact = artifact_store.open(key)
+    if artifact is None:
+        raise RuntimeError(f"artifact {key} missing after write")
+    _record(doc["_id"], KIND_DOCX, key, artifact.length)
+    return artifact
+
+
+def stream_history_mindmap(history_id: ObjectId, key: str, source: str, generate: Callable[..., Iterable[str]], user_id: Optional[str] = None) -> Generator[str, None, None]:
+    """
+    流式生成思维导图，完整结束后保存（相同键的并发请求共享一次生成）
+    :param generate: 思维导图生成函数 generate(markdown_content, user_id=...)
+    """
+    def produce() -> Generator[str, None, None]:
+        parts = []
+        for chunk in generate(source, user_id=user_id):
+            parts.append(chunk)
+            yield chunk
+        text = "".join(parts).strip()
+        if not text or text.startswith(MINDMAP_FAILURE_PREFIX):
+            return
+        try:
+            length = artifact_store.put(key, text.encode("utf-8"), MINDMAP_MIMETYPE)
+            _record(history_id, KIND_MINDMAP, key, length)
+        except Exception as e:
+            # 保存失败不影响本次输出，下次请求重新生成
+            logger.error(f"Failed to store mindmap of history {history_id}: {str(e)}")
+
+    yield from mindmap_coalescer.stream(key, produce)
+
+
+def get_artifact_stats() -> dict:
+    return {
+        "store": artifact_store.get_stats(),
+        "mindmap_coalescer": mindmap_coalescer.get_stats()
+    }
@@ -0,0 +1,167 @@
+# 文件名：auth_service.py
+"""
+功能说明：用户登录与会话校验
+核心功能：
+1. 登录即注册：一次 find_one_and_update(upsert) 完成查找 / 创建 / 更新，依赖 users.username 唯一索引避免并发注册重名
+2. 签发签名会话令牌（itsdangerous，包含 user_id / username / 签发时间），服务端无需存储会话；
+   未配置 SECRET_KEY 时仅在 AUTH_REQUIRE_SESSION 开启时启动失败，否则不签发令牌
+3. 已验证令牌的进程内 TTL 缓存，后续请求校验身份不访问 MongoDB
+4. 按令牌解析请求方身份：令牌与客户端传入的 user_id 不一致时拒绝
+依赖模块：extensions, itsdangerous, pymongo
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.config import Config
+from app.extensions import mongo
+
+logger = logging.getLogger(__name__)
+
+SESSION_SALT = "blueprint-session"
+
+
+def login_or_register(username: str, fingerprint: str) -> Tuple[dict, bool]:
+    """
+    登录（用户不存在时注册），单次原子操作
+    :return: (用户文档, 是否新注册)
+    """
+    now = datetime.utcnow()
+    query = {"username": username}
+    update = {
+        "$set": {"last_login": now, "fingerprint": fingerprint},  # 允许多端登录，记录当前设备指纹
+        "$setOnInsert": {"username": username, "created_at": now}
+    }
+    # 返回更新前的文档：为空即本次插入了新用户（_id 由 upsert 生成，需另行读取）
+    projection = {"username": 1}
+    try:
+        before = mongo.db.users.find_one_and_update(query, update, projection=projection, upsert=True, return_document=ReturnDocument.BEFORE)
+    except DuplicateKeyError:
+        # 并发首次登录：另一请求已插入，按已存在用户重试
+        before = mongo.db.users.find_one_and_update(query, update, projection=projection, return_document=ReturnDocument.BEFORE)
+    if before is not None:
+        return before, False
+    return mongo.db.users.find_one(query, projection), True
+
+
+class SessionManager:
+    """
+    会话令牌签发与校验（带已验证令牌缓存）
+    """
+
+    def __init__(self, secret_key: str, max_age_seconds: int, cache_ttl_seconds: float = 300.0, cache_size: int = 10000):
+        self.max_age_seconds = max_age_seconds
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self.cache_size = max(1, cache_size)
+        self._serializer = URLSafeTimedSerializer(secret_key, salt=SESSION_SALT)
+        # token -> (claims, 缓存过期时间 monotonic)
+        self._cache: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"issued": 0, "cache_hits": 0, "verified": 0, "rejected": 0}
+
+    def issue(self, user_id: str, username: str) -> str:
+        token = self._serializer.dumps({"uid": user_id, "u": username})
+        with self._lock:
+            self._stats["issued"] += 1
+        return token
+
+    def verify(self, token: str) -> Optional[Dict[str, Any]]:
+        """
+        校验令牌
+        :return: {"user_id", "username"}；签名无效或已过期时返回 None
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(token)
+            if cached and cached[1] > now:
+                self._cache.move_to_end(token)
+                self._stats["cache_hits"] += 1
+                return cached[0]
+
+        try:
+            payload, issued_at = self._serializer.loads(token, max_age=self.max_age_seconds, return_timestamp=True)
+        except (SignatureExpired, BadSignature):
+            with self._lock:
+                self._cache.pop(token, None)
+                self._stats["rejected"] += 1
+            return None
+
+        claims = {"user_id": payload.get("uid"), "username": payload.get("u")}
+        # 缓存有效期不超过令牌剩余有效期
+        remaining = self.max_age_seconds - (time.time() - issued_at.timestamp())
+        with self._lock:
+            self._stats["verified"] += 1
+            self._cache[token] = (claims, now + max(0.0, min(self.cache_ttl_seconds, remaining)))
+            self._cache.move_to_end(token)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return claims
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["cached"] = len(self._cache)
+        return stats
+
+
+def _build_session_manager() -> Optional[SessionManager]:
+    """
+    按配置创建会话管理器
+    - 配置了 SECRET_KEY：签发并校验令牌
+    - 未配置且 AUTH_REQUIRE_SESSION 开启：启动失败（令牌是唯一身份凭证，不能没有签名密钥）
+    - 未配置且未强制会话：不签发令牌，沿用客户端传入的 user_id（CLI 命令、本地开发无需配置密钥）
+    不使用进程内随机密钥兜底：多进程部署时各进程签发的令牌互不认可，重启后全部失效
+    """
+    if not Config.SECRET_KEY:
+        if Config.AUTH_REQUIRE_SESSION:
+            raise RuntimeError("AUTH_REQUIRE_SESSION is enabled but SECRET_KEY is not set; configure the same SECRET_KEY for every worker (e.g. python -c \"import secrets; print(secrets.token_hex(32))\")")
+        logger.warning("SECRET_KEY is not set; session tokens are disabled and requests are identified by user_id")
+        return None
+    return SessionManager(
+        Config.SECRET_KEY,
+        max_age_seconds=Config.SESSION_MAX_AGE_SECONDS,
+        cache_ttl_seconds=Config.SESSION_CACHE_TTL_SECONDS,
+        cache_size=Config.SESSION_CACHE_SIZE
+    )
+
+
+# 未配置 SECRET_KEY 且未强制会话时为 None
+session_manager = _build_session_manager()
+
+
+def extract_session_token(headers: Mapping[str, str], values: Mapping[str, str]) -> Optional[str]:
+    """
+    从请求中读取会话令牌：Authorization: Bearer / X-Session-Token 请求头，或 session_token 参数（EventSource 无法设置请求头）
+    """
+    authorization = headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        return authorization[len("Bearer "):].strip() or None
+    return headers.get("X-Session-Token") or values.get("session_token") or None
+
+
+def resolve_user(claimed_user_id: Optional[str], token: Optional[str]) -> Tuple[Optional[str], Optional[Tuple[int, str]]]:
+    """
+    确定请求方用户ID
+    - 携带有效令牌：以令牌中的用户为准，客户端传入的 user_id 与之不一致时拒绝
+    - 携带无效 / 过期令牌：拒绝
+    - 未携带令牌：AUTH_REQUIRE_SESSION 开启时拒绝，否则沿用客户端传入的 user_id（兼容旧客户端）
+    - 未启用会话令牌（未配置 SECRET_KEY）：忽略令牌，沿用客户端传入的 user_id
+    :return: (用户ID, 错误 (HTTP 状态码, 消息))
+    """
+    if token and session_manager is not None:
+        claims = session_manager.verify(token)
+        if claims is None:
+            return None, (401, "Invalid or expired session")
+        if claimed_user_id and claimed_user_id != claims["user_id"]:
+            return None, (403, "user_id does not match session")
+        return claims["user_id"], None
+    if Config.AUTH_REQUIRE_SESSION:
+        return None, (401, "Session token is required")
+    return claimed_user_id, None
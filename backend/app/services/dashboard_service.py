@@ -0,0 +1,159 @@
+# 文件名：dashboard_service.py
+"""
+功能说明：仪表盘统计计算与物化缓存
+核心功能：
+1. 书籍排行：一次 $group + $topN 聚合同时得到总榜与各角色榜（原为每个角色一次聚合，共 12 次；需 MongoDB 5.2+）
+2. 用户活跃：总用户数（集合元数据）、最近登录用户、最近使用记录均走索引
+3. 结果物化到 dashboard_snapshots 集合并在进程内缓存，TTL 内所有请求（含多进程）共享同一次计算
+4. 为结果生成 ETag，配合 HTTP 缓存头让轮询请求直接返回 304
+依赖模块：extensions, threading
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Tuple
+
+from app.config import Config
+from app.extensions import mongo
+
+logger = logging.getLogger(__name__)
+
+# 角色榜单（与前端角色列表一致）
+DASHBOARD_ROLES = ['cxo', 'iron_triangle', 'pdt_manager', 'cio', 'ar', 'sr', 'fr', 'pdt', 'cfo', 'supply', 'hr']
+ALL_ROLE = "all"
+ALL_TOP_N = 10
+ROLE_TOP_N = 5
+
+
+def compute_book_stats() -> Dict[str, list]:
+    """
+    书籍使用排行：总榜取前 10，各角色榜取前 5（无数据的角色不返回）
+    按角色分组时由 $topN 只保留每组前 N 本（分组内存与书籍总数无关），单次聚合完成
+    """
+    pipeline = [
+        {"$match": {"role": {"$in": [ALL_ROLE] + DASHBOARD_ROLES}}},
+        {"$group": {"_id": "$role", "books": {"$topN": {
+            "n": {"$cond": [{"$eq": ["$role", ALL_ROLE]}, ALL_TOP_N, ROLE_TOP_N]},
+            "sortBy": {"count": -1, "book_name": 1},
+            "output": {"book_name": "$book_name", "count": "$count"}
+        }}}}
+    ]
+    grouped = {doc["_id"]: doc["books"] for doc in mongo.db.book_stats.aggregate(pipeline)}
+
+    role_stats = {ALL_ROLE: grouped.get(ALL_ROLE, [])}
+    for role in DASHBOARD_ROLES:
+        if grouped.get(role):
+            role_stats[role] = grouped[role]
+    return role_stats
+
+
+def compute_user_stats() -> Dict[str, Any]:
+    """
+    用户活跃度：总用户数、最近登录的 20 位用户、最近 10 条使用记录
+    """
+    total_users = mongo.db.users.estimated_document_count()
+    active_users = [
+        {"username": user["username"], "last_login": user.get("last_login")}
+        for user in mongo.db.users.find({}, {"_id": 0, "username": 1, "last_login": 1}).sort("last_login", -1).limit(20)
+    ]
+    recent_logs = list(
+        mongo.db.usage_logs.find({}, {"_id": 0, "username": 1, "action": 1, "created_at": 1}).sort("created_at", -1).limit(10)
+    )
+    return {
+        "total_users": total_users,
+        "active_users": active_users,
+        "recent_activities": recent_logs
+    }
+
+
+def _etag_for(data: Any) -> str:
+    payload = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class DashboardSnapshots:
+    """
+    物化统计结果的读取与刷新
+    """
+
+    def __init__(self, ttl_seconds: float = 30.0, collection_name: str = "dashboard_snapshots"):
+        self.ttl_seconds = max(1.0, ttl_seconds)
+        self.collection_name = collection_name
+        # name -> (data, etag, 过期时间 monotonic)
+        self._local: Dict[str, Tuple[Any, str, float]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self._stats = {"local_hits": 0, "snapshot_hits": 0, "computed": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key: str) -> None:
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def _lock_for(self, name: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name: str, compute: Callable[[], Any]) -> Tuple[Any, str, int]:
+        """
+        获取统计结果
+        :param name: 快照名称（物化文档 _id）
+        :param compute: 快照缺失或过期时的计算函数
+        :return: (数据, ETag, 剩余有效秒数)
+        """
+        cached = self._local.get(name)
+        if cached and cached[2] > time.monotonic():
+            self._count("local_hits")
+            return cached[0], cached[1], self._remaining(cached[2])
+
+        # 同一进程内并发的请求只有一个执行读取 / 计算，其余等待后复用结果
+        with self._lock_for(name):
+            cached = self._local.get(name)
+            if cached and cached[2] > time.monotonic():
+                self._count("local_hits")
+                return cached[0], cached[1], self._remaining(cached[2])
+
+            collection = mongo.db[self.collection_name]
+            now = datetime.utcnow()
+            doc = collection.find_one({"_id": name})
+            if doc and doc.get("expires_at") and doc["expires_at"] > now:
+                # 其他进程刚刷新过物化结果
+                self._count("snapshot_hits")
+                data, etag = doc["data"], doc["etag"]
+                remaining = (doc["expires_at"] - now).total_seconds()
+            else:
+                started = time.perf_counter()
+                data = compute()
+                etag = _etag_for(data)
+                remaining = self.ttl_seconds
+                collection.replace_one(
+                    {"_id": name},
+                    {
+                        "_id": name,
+                        "data": data,
+                        "etag": etag,
+                        "computed_at": now,
+                        "expires_at": now + timedelta(seconds=self.ttl_seconds),
+                        "compute_ms": round((time.perf_counter() - started) * 1000, 2)
+                    },
+                    upsert=True
+                )
+                self._count("computed")
+
+            expires = time.monotonic() + remaining
+            self._local[name] = (data, etag, expires)
+            return data, etag, self._remaining(expires)
+
+    @staticmethod
+    def _remaining(expires: float) -> int:
+        return max(0, int(expires - time.monotonic()))
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+dashboard_snapshots = DashboardSnapshots(ttl_seconds=Config.DASHBOARD_CACHE_TTL_SECONDS)
@@ -0,0 +1,567 @@
+# 文件名：history_service.py
+"""
+功能说明：分析历史记录持久化
+核心功能：
+1. 流式输出过程中按固定大小或时间间隔将内容分段，经后台确认写入队列批量写入 analysis_history_segments
+2. 分段写入时同步增量压缩，压缩数据按块经同一队列写入 analysis_history_content_chunks（内存中只保留当前块）；
+   结束后在后台线程等待落库，补全摘要记录（预览、长度、截断标记、状态），写入 analysis_history_contents 并清理分段
+3. 读取详情时按需解压正文（兼容分段存储与旧记录的内联 content 字段）
+4. 旧记录迁移：内联正文 / 已结束的分段正文迁移为压缩存储
+5. 列表分页：基于 (created_at, _id) 续页令牌的键集分页，总数按需返回并短时缓存
+依赖模块：extensions, zlib
+"""
+import base64
+import json
+import logging
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from bson import Binary, ObjectId
+
+from app.extensions import mongo
+from app.services.schema_service import HISTORY_LIST_INDEX, ensure_indexes, history_list_projection
+from app.services.telemetry_service import durable_writer
+from app.utils.write_behind import WriteBehindError
+
+logger = logging.getLogger(__name__)
+
+HISTORY_STATUS_STREAMING = "streaming"
+HISTORY_STATUS_DONE = "done"
+# 摘要或分段重试耗尽仍未写入，正文不完整
+HISTORY_STATUS_FAILED = "failed"
+
+# 正文存储方式：inline（旧记录，正文在摘要文档中）/ segments（输出中的分段）/ compressed（压缩正文独立存储）
+STORAGE_SEGMENTS = "segments"
+STORAGE_COMPRESSED = "compressed"
+
+CONTENT_CODEC = "zlib"
+COMPRESS_LEVEL = 6
+
+# 预览长度与保存上限（与原有内联存储保持一致）
+PREVIEW_CHARS = 400
+# 结束时等待排队中的摘要 / 分段 / 压缩块落库的默认最长时间（秒）
+FINALIZE_WAIT_SECONDS = 10.0
+# 压缩正文单块大小（字节）：攒满一块即入队写入，不在内存中保留完整压缩正文
+CONTENT_CHUNK_BYTES = 255 * 1024
+MAX_CONTENT_CHARS = 2_000_000
+
+# 列表查询返回的字段（不含正文），均在列表索引中，查询由索引覆盖
+LIST_PROJECTION = history_list_projection()
+
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+_list_index_ready = False
+_chunk_indexes_ready = False
+
+# 结束阶段（等待落库、补全摘要、清理分段）在后台执行，不占用响应线程
+_finalize_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-finalize")
+
+# 用户历史记录总数缓存 {user_id: (总数, 过期时间)}
+_total_cache: Dict[str, Tuple[int, float]] = {}
+_total_cache_lock = threading.Lock()
+TOTAL_CACHE_TTL_SECONDS = 60
+
+
+def _segments():
+    global _indexes_ready
+    if not _indexes_ready:
+        with _indexes_lock:
+            if not _indexes_ready:
+                ensure_indexes(mongo.db, ["analysis_history_segments"])
+                _indexes_ready = True
+    return mongo.db.analysis_history_segments
+
+
+def _histories():
+    """
+    摘要集合；首次使用时确保列表查询的覆盖索引存在
+    """
+    global _list_index_ready
+    if not _list_index_ready:
+        with _indexes_lock:
+            if not _list_index_ready:
+                ensure_indexes(mongo.db, ["analysis_histories"])
+                _list_index_ready = True
+    return mongo.db.analysis_histories
+
+
+def _contents():
+    return mongo.db.analysis_history_contents
+
+
+def _content_chunks():
+    """
+    压缩正文分块集合；首次使用时确保 (history_id, seq) 唯一索引存在（重试写入时重复的块被忽略）
+    """
+    global _chunk_indexes_ready
+    if not _chunk_indexes_ready:
+        with _indexes_lock:
+            if not _chunk_indexes_ready:
+                ensure_indexes(mongo.db, ["analysis_history_content_chunks"])
+                _chunk_indexes_ready = True
+    return mongo.db.analysis_history_content_chunks
+
+
+def _store_compressed(history_id: ObjectId, data: bytes, raw_length: int) -> None:
+    # 整体写入（迁移）时清理输出过程中未完成的压缩块
+    _content_chunks().delete_many({"history_id": history_id})
+    _contents().replace_one(
+        {"_id": history_id},
+        {
+            "_id": history_id,
+            "codec": CONTENT_CODEC,
+            "data": Binary(data),
+            "raw_length": raw_length,
+            "stored_bytes": len(data),
+            "created_at": datetime.utcnow()
+        },
+        upsert=True
+    )
+
+
+def build_preview(text: str, max_len: int = PREVIEW_CHARS) -> str:
+    if not text:
+        return ""
+    t = text.strip()
+    if len(t) <= max_len:
+        return t
+    return t[:max_len] + "..."
+
+
+class HistoryWriter:
+    """
+    历史记录分段写入器：内存中只保留当前未写入的分段、未满一块的压缩数据与预览所需的开头部分
+    """
+
+    def __init__(self, summary: dict, segment_chars: int = 16 * 1024, flush_interval: float = 3.0, finalize_wait: float = FINALIZE_WAIT_SECONDS):
+        """
+        :param summary: 摘要记录的元数据（user_id / username / role / filename 等）
+        :param segment_chars: 单个分段的字符数
+        :param flush_interval: 最长写入间隔（秒）
+        :param finalize_wait: 结束时等待排队中的写入落库的最长时间（秒），超时则保留分段存储
+        """
+        self.summary = summary
+        self.segment_chars = segment_chars
+        self.flush_interval = flush_interval
+        self.finalize_wait = finalize_wait
+        self.history_id: Optional[ObjectId] = None
+        self.seq = 0
+        self.total_chars = 0
+        self.saved_chars = 0
+        self.truncated = False
+        self._buffer = []
+        self._buffer_len = 0
+        self._head = ""
+        self._has_content = False
+        self._last_flush = time.monotonic()
+        # 摘要与各分段的入队序号（首个为摘要）；摘要入队失败（队列满）后不再写入分段
+        self._queued_seqs: List[int] = []
+        self._dropped = False
+        # 分段写入时同步增量压缩，压缩数据攒满一块即入队写入，结束时无需再读回全部分段
+        self._compressor = zlib.compressobj(COMPRESS_LEVEL)
+        self._pending_compressed = []
+        self._pending_bytes = 0
+        self._chunk_seqs: List[int] = []
+        self._chunk_count = 0
+        self._stored_bytes = 0
+        self._raw_bytes = 0
+        # 压缩块入队失败后不再压缩，正文保留在分段存储，由迁移命令稍后压缩
+        self._compress_failed = False
+
+    def _ensure_summary(self) -> None:
+        if self.history_id is not None:
+            return
+        now = datetime.utcnow()
+        doc = dict(self.summary)
+        # 本地生成 ID，摘要与分段一起经后台队列写入，不阻塞输出
+        doc.update({
+            "_id": ObjectId(),
+            "storage": STORAGE_SEGMENTS,
+            "status": HISTORY_STATUS_STREAMING,
+            "content_preview": "",
+            "content_length": 0,
+            "content_truncated": False,
+            "created_at": now,
+            "updated_at": now
+        })
+        self.history_id = doc["_id"]
+        # 后台批量插入不经过 _segments() / _content_chunks()，先确保唯一索引存在
+        _segments()
+        _content_chunks()
+        seq = durable_writer.put("analysis_histories", doc)
+        if seq is None:
+            self._dropped = True
+            logger.error(f"History {self.history_id} dropped: write queue full")
+            return
+        self._queued_seqs.append(seq)
+        invalidate_history_total(doc.get("user_id"))
+
+    def write(self, chunk: str) -> None:
+        if not chunk:
+            return
+        self.total_chars += len(chunk)
+        if not self._has_content and chunk.strip():
+            self._has_content = True
+        if len(self._head) < PREVIEW_CHARS * 2:
+            self._head += chunk[:PREVIEW_CHARS * 2 - len(self._head)]
+
+        # 超出保存上限的部分只计入长度
+        remaining = MAX_CONTENT_CHARS - self.saved_chars - self._buffer_len
+        if remaining <= 0:
+            self.truncated = True
+            return
+        if len(chunk) > remaining:
+            chunk = chunk[:remaining]
+            self.truncated = True
+
+        self._buffer.append(chunk)
+        self._buffer_len += len(chunk)
+        if self._buffer_len >= self.segment_chars or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if not self._buffer or not self._has_content:
+            # 尚无有效内容时不创建记录（与原逻辑一致：空白输出不保存历史）
+            return
+        self._ensure_summary()
+        data = "".join(self._buffer)
+        self._buffer = []
+        self._buffer_len = 0
+        if self._dropped:
+            return
+        self.seq += 1
+        seq = durable_writer.put("analysis_history_segments", {
+            "history_id": self.history_id,
+            "seq": self.seq,
+            "data": data,
+            "created_at": datetime.utcnow()
+        })
+        if seq is None:
+            # 分段缺失时正文不完整，放弃本条记录的后续写入
+            self._dropped = True
+            logger.error(f"History {self.history_id} segment {self.seq} dropped: write queue full")
+            return
+        self._queued_seqs.append(seq)
+        self.saved_chars += len(data)
+        raw = data.encode("utf-8")
+        self._raw_bytes += len(raw)
+        if not self._compress_failed:
+            self._add_compressed(self._compressor.compress(raw))
+
+    def _add_compressed(self, data: bytes, final: bool = False) -> None:
+        """
+        累积压缩输出，攒满一块（或结束时）入队写入
+        """
+        if data:
+            self._pending_compressed.append(data)
+            self._pending_bytes += len(data)
+        if self._pending_bytes < CONTENT_CHUNK_BYTES and not (final and self._pending_bytes):
+            return
+        data = b"".join(self._pending_compressed)
+        self._pending_compressed = []
+        self._pending_bytes = 0
+        seq = durable_writer.put("analysis_history_content_chunks", {
+            "history_id": self.history_id,
+            "seq": self._chunk_count + 1,
+            "data": Binary(data),
+            "created_at": datetime.utcnow()
+        })
+        if seq is None:
+            self._compress_failed = True
+            logger.warning(f"History {self.history_id} content chunk dropped: write queue full, keeping segment storage")
+            return
+        self._chunk_count += 1
+        self._chunk_seqs.append(seq)
+        self._stored_bytes += len(data)
+
+    def finalize(self) -> Optional[ObjectId]:
+        """
+        写入剩余内容，等待落库后保存压缩正文并补全摘要记录，随后清理分段（在调用线程中执行）
+        :return: 历史记录ID（无有效内容时为 None）
+        :raises WriteBehindError: 摘要或分段重试耗尽仍未写入（不再保存正文）
+        """
+        if not self._flush_final():
+            return None
+        return self._complete()
+
+    def finalize_in_background(self) -> Optional[Future]:
+        """
+        写入剩余内容后立即返回，等待落库与补全摘要在后台线程执行（响应线程不等待队列）
+        :return: 结束阶段的 Future（结果同 finalize，失败时异常已记录日志）；无有效内容时为 None
+        """
+        if not self._flush_final():
+            return None
+        future = _finalize_executor.submit(self._complete)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def _log_failure(self, future: Future) -> None:
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Failed to finalize history {self.history_id}: {str(error)}")
+
+    def _flush_final(self) -> bool:
+        """
+        写入剩余分段与最后一个压缩块
+        :return: 是否需要结束阶段（无有效内容或已放弃写入时为 False）
+        """
+        self.flush()
+        if self.history_id is None or self._dropped:
+            return False
+        if not self._compress_failed:
+            self._add_compressed(self._compressor.flush(), final=True)
+        return True
+
+    def _complete(self) -> ObjectId:
+        # 摘要与分段落库后再补全摘要、清理分段；超时则保留分段存储，由迁移命令稍后处理
+        deadline = time.monotonic() + self.finalize_wait
+        try:
+            completed = durable_writer.wait_for(self._queued_seqs, self.finalize_wait)
+        except WriteBehindError as e:
+            self._mark_failed(e.failed_seqs)
+            raise
+        if not completed:
+            logger.warning(f"History {self.history_id} segments still queued, leaving it in segment storage")
+            return self.history_id
+
+        summary = {
+            "status": HISTORY_STATUS_DONE,
+            "segment_count": self.seq,
+            "content_preview": build_preview(self._head),
+            "content_length": self.total_chars,
+            "content_truncated": self.truncated,
+            "finished_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        }
+        compressed = self._store_chunked_content(max(0.0, deadline - time.monotonic()))
+        if compressed:
+            summary.update({"storage": STORAGE_COMPRESSED, "content_stored_bytes": self._stored_bytes})
+        mongo.db.analysis_histories.update_one({"_id": self.history_id}, {"$set": summary})
+        if compressed:
+            _segments().delete_many({"history_id": self.history_id})
+        return self.history_id
+
+    def _store_chunked_content(self, timeout: float) -> bool:
+        """
+        压缩块落库后写入正文记录（只记录块数，不含数据）
+        :param timeout: 等待压缩块落库的剩余时间（秒）
+        :return: 是否已保存；失败时正文保留在分段存储（已完成的记录由迁移命令压缩）
+        """
+        if self._compress_failed:
+            return False
+        try:
+            completed = durable_writer.wait_for(self._chunk_seqs, timeout)
+        except WriteBehindError as e:
+            logger.warning(f"History {self.history_id} lost {len(e.failed_seqs)} content chunks, keeping segment storage")
+            _content_chunks().delete_many({"history_id": self.history_id})
+            return False
+        if not completed:
+            logger.warning(f"History {self.history_id} content chunks still queued, keeping segment storage")
+            return False
+        _contents().replace_one(
+            {"_id": self.history_id},
+            {
+                "_id": self.history_id,
+                "codec": CONTENT_CODEC,
+                "chunks": self._chunk_count,
+                "raw_length": self._raw_bytes,
+                "stored_bytes": self._stored_bytes,
+                "created_at": datetime.utcnow()
+            },
+            upsert=True
+        )
+        return True
+
+
+    def _mark_failed(self, failed_seqs) -> None:
+        """
+        摘要未写入时清理已写入的分段；仅分段缺失时将摘要标记为失败（正文不完整，不再压缩保存）
+        """
+        _content_chunks().delete_many({"history_id": self.history_id})
+        if self._queued_seqs[0] in failed_seqs:
+            logger.error(f"History {self.history_id} summary was not written, discarding its segments")
+            _segments().delete_many({"history_id": self.history_id})
+            return
+        logger.error(f"History {self.history_id} lost {len(failed_seqs)} segments, marking it failed")
+        mongo.db.analysis_histories.update_one(
+            {"_id": self.history_id},
+            {"$set": {"status": HISTORY_STATUS_FAILED, "updated_at": datetime.utcnow()}}
+        )
+
+
+def _decompress(content_doc: dict) -> str:
+    """
+    解压正文：迁移写入的正文内联在 data 字段，输出过程中写入的正文按块存储
+    """
+    codec = content_doc.get("codec")
+    if codec != CONTENT_CODEC:
+        raise ValueError(f"unsupported history content codec: {codec}")
+    if "data" in content_doc:
+        return zlib.decompress(content_doc["data"]).decode("utf-8")
+
+    decompressor = zlib.decompressobj()
+    parts = []
+    count = 0
+    cursor = _content_chunks().find({"history_id": content_doc["_id"]}, {"data": 1, "_id": 0}).sort("seq", 1)
+    for chunk in cursor:
+        parts.append(decompressor.decompress(chunk["data"]))
+        count += 1
+    if count != content_doc.get("chunks") or not decompressor.eof:
+        raise ValueError(f"history content {content_doc['_id']} is incomplete: {count}/{content_doc.get('chunks')} chunks")
+    return b"".join(parts).decode("utf-8")
+
+
+def _join_segments(history_id: ObjectId) -> str:
+    cursor = _segments().find({"history_id": history_id}, {"data": 1, "_id": 0}).sort("seq", 1)
+    return "".join(segment.get("data", "") for segment in cursor)
+
+
+def load_history_content(doc: dict) -> str:
+    """
+    读取历史记录正文：压缩存储的记录按需解压，分段存储（输出中或中断）的记录按序号拼接，旧记录直接返回内联 content
+    """
+    storage = doc.get("storage")
+    if storage == STORAGE_COMPRESSED:
+        content_doc = _contents().find_one({"_id": doc["_id"]})
+        return _decompress(content_doc) if content_doc else ""
+    if storage == STORAGE_SEGMENTS:
+        return _join_segments(doc["_id"])
+    return doc.get("content", "")
+
+
+def migrate_history_storage(batch_size: int = 200, stale_after: timedelta = timedelta(hours=1), dry_run: bool = False, progress: Optional[Callable[[int], None]] = None) -> Dict[str, int]:
+    """
+    将旧记录迁移为压缩存储（可重复执行）
+    - 内联 content 的旧记录：压缩正文写入内容集合，并从摘要文档中移除 content
+    - 分段存储且已结束（或超过 stale_after 未更新、视为中断）的记录：拼接分段后压缩，删除分段
+    :return: 统计 {migrated, raw_bytes, stored_bytes}
+    """
+    stats = {"migrated": 0, "raw_bytes": 0, "stored_bytes": 0}
+    query = {
+        "$or": [
+            {"storage": {"$exists": False}, "content": {"$exists": True}},
+            {"storage": STORAGE_SEGMENTS, "status": HISTORY_STATUS_DONE},
+            {"storage": STORAGE_SEGMENTS, "status": {"$ne": HISTORY_STATUS_FAILED}, "updated_at": {"$lt": datetime.utcnow() - stale_after}}
+        ]
+    }
+    last_id = None
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        docs = list(mongo.db.analysis_histories.find(batch_query).sort("_id", 1).limit(batch_size))
+        if not docs:
+            break
+        for doc in docs:
+            last_id = doc["_id"]
+            content = load_history_content(doc)
+            raw = content.encode("utf-8")
+            compressed = zlib.compress(raw, COMPRESS_LEVEL)
+            stats["raw_bytes"] += len(raw)
+            stats["stored_bytes"] += len(compressed)
+            if dry_run:
+                stats["migrated"] += 1
+                continue
+            _store_compressed(doc["_id"], compressed, len(raw))
+            update = {
+                "$set": {
+                    "storage": STORAGE_COMPRESSED,
+                    "content_stored_bytes": len(compressed),
+                    "status": HISTORY_STATUS_DONE
+                },
+                "$unset": {"content": ""}
+            }
+            if doc.get("storage") == STORAGE_SEGMENTS:
+                # 中断的记录在输出过程中只写了分段，按正文补全长度与预览
+                update["$set"]["content_length"] = max(doc.get("content_length", 0), len(content))
+                if not doc.get("content_preview"):
+                    update["$set"]["content_preview"] = build_preview(content)
+            mongo.db.analysis_histories.update_one({"_id": doc["_id"]}, update)
+            if doc.get("storage") == STORAGE_SEGMENTS:
+                _segments().delete_many({"history_id": doc["_id"]})
+            stats["migrated"] += 1
+        if progress:
+            progress(stats["migrated"])
+    return stats
+
+
+def encode_cursor(created_at: datetime, history_id: ObjectId) -> str:
+    """
+    续页令牌：对 (created_at 毫秒时间戳, _id) 做 URL 安全的 base64 编码，对客户端不透明
+    """
+    # 库中时间为 UTC（naive datetime），按 UTC 换算时间戳
+    millis = int(created_at.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    payload = json.dumps({"t": millis, "i": str(history_id)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    """
+    解析续页令牌；格式非法时抛出 ValueError
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        created_at = datetime.utcfromtimestamp(payload["t"] / 1000)
+        return created_at, ObjectId(payload["i"])
+    except Exception as e:
+        raise ValueError("invalid cursor") from e
+
+
+def invalidate_history_total(user_id: Optional[str]) -> None:
+    with _total_cache_lock:
+        _total_cache.pop(user_id, None)
+
+
+def count_user_histories(user_id: str) -> int:
+    """
+    用户历史记录总数（缓存 TTL_SECONDS 秒；本进程新增记录时立即失效）
+    """
+    now = time.monotonic()
+    with _total_cache_lock:
+        cached = _total_cache.get(user_id)
+        if cached and cached[1] > now:
+            return cached[0]
+    total = _histories().count_documents({"user_id": user_id})
+    with _total_cache_lock:
+        _total_cache[user_id] = (total, now + TOTAL_CACHE_TTL_SECONDS)
+    return total
+
+
+def list_user_histories(user_id: str, page_size: int, cursor: Optional[str] = None, page: Optional[int] = None) -> Tuple[List[dict], Optional[str]]:
+    """
+    查询用户历史记录列表（按 created_at、_id 倒序）
+    :param cursor: 续页令牌（上一页返回的 next_cursor），优先于 page
+    :param page: 页码（兼容旧的分页器，页码越大跳过的索引项越多）
+    :return: (记录列表, 下一页令牌；没有更多记录时为 None)
+    """
+    query = {"user_id": user_id}
+    skip = 0
+    if cursor:
+        created_at, last_id = decode_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": last_id}}
+        ]
+    elif page and page > 1:
+        skip = (page - 1) * page_size
+
+    docs = list(
+        _histories().find(query, LIST_PROJECTION)
+        .sort([("created_at", -1), ("_id", -1)])
+        .skip(skip)
+        .limit(page_size + 1)
+        .hint(HISTORY_LIST_INDEX)
+    )
+    next_cursor = None
+    if len(docs) > page_size:
+        docs = docs[:page_size]
+        last = docs[-1]
+        if last.get("created_at"):
+            next_cursor = encode_cursor(last["created_at"], last["_id"])
+    return docs, next_cursor
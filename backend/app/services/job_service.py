@@ -0,0 +1,309 @@
+# 文件名：job_service.py
+"""
+功能说明：异步分析任务服务
+核心功能：
+1. 提交任务后立即返回任务ID，由后台线程执行分析流水线
+2. 流水线输出按序号分段追加到任务日志（MongoDB 固定集合，环形缓冲）
+3. 支持从指定序号（Last-Event-ID）回放并继续跟随实时输出
+4. 进程内限制排队任务数，超出时拒绝提交；执行中的任务定期刷新心跳（updated_at）
+5. 心跳超时的未结束任务（进程重启、工作线程异常退出）标记为失败，回放随之结束
+依赖模块：extensions, concurrent.futures
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Generator, Iterable, Optional, Set
+
+from bson import ObjectId
+from pymongo.errors import CollectionInvalid
+
+from app.extensions import mongo
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUS_QUEUED = "queued"
+JOB_STATUS_RUNNING = "running"
+JOB_STATUS_DONE = "done"
+JOB_STATUS_FAILED = "failed"
+FINISHED_STATUSES = (JOB_STATUS_DONE, JOB_STATUS_FAILED)
+ACTIVE_STATUSES = (JOB_STATUS_QUEUED, JOB_STATUS_RUNNING)
+
+STALE_JOB_ERROR = "任务执行中断（服务重启或工作线程退出），请重新提交"
+
+
+class JobQueueFullError(Exception):
+    """
+    排队中的任务数已达上限
+    """
+    pass
+
+
+class JobLogWriter:
+    """
+    任务日志写入器：合并细碎的 token，按大小或时间间隔写入一个日志段
+    """
+
+    def __init__(self, job_service: "JobService", job_id: ObjectId, flush_bytes: int = 2048, flush_interval: float = 0.5):
+        self.job_service = job_service
+        self.job_id = job_id
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.seq = 0
+        self._buffer = []
+        self._buffer_len = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, chunk: str) -> None:
+        if not chunk:
+            return
+        self._buffer.append(chunk)
+        self._buffer_len += len(chunk)
+        if self._buffer_len >= self.flush_bytes or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        data = "".join(self._buffer)
+        self._buffer = []
+        self._buffer_len = 0
+        self.seq += 1
+        self.job_service._events().insert_one({
+            "job_id": self.job_id,
+            "seq": self.seq,
+            "data": data,
+            "created_at": datetime.utcnow()
+        })
+        self.job_service._jobs().update_one(
+            {"_id": self.job_id},
+            {"$set": {"last_seq": self.seq, "updated_at": datetime.utcnow()}}
+        )
+
+
+class JobService:
+    """
+    后台任务执行与日志回放
+    """
+
+    def __init__(self, max_workers: int = 4, log_size_bytes: int = 256 * 1024 * 1024, poll_interval: float = 0.5, max_queue: int = 16, heartbeat_interval: float = 15.0, stale_after: float = 120.0):
+        """
+        :param max_workers: 同时执行的任务数
+        :param log_size_bytes: 任务日志固定集合容量
+        :param poll_interval: 回放轮询间隔（秒）
+        :param max_queue: 等待执行的任务数上限（不含执行中的）
+        :param heartbeat_interval: 本进程未结束任务的心跳间隔（秒）
+        :param stale_after: 未结束任务超过该秒数没有心跳视为中断
+        """
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="analysis-job")
+        self.log_size_bytes = log_size_bytes
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = max(1.0, heartbeat_interval)
+        self.stale_after = max(self.heartbeat_interval * 2, stale_after)
+        self._collections_ready = False
+        self._init_lock = threading.Lock()
+        # 本进程中排队 / 执行中的任务
+        self._lock = threading.Lock()
+        self._active: Set[ObjectId] = set()
+        self._running = 0
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self._stats: Dict[str, int] = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "stale_failed": 0}
+
+    def _jobs(self):
+        return mongo.db.analysis_jobs
+
+    def _events(self):
+        self._ensure_collections()
+        return mongo.db.analysis_job_events
+
+    def _ensure_collections(self) -> None:
+        """
+        延迟创建固定集合（环形缓冲，写满后自动覆盖最早的日志段）及索引
+        """
+        if self._collections_ready:
+            return
+        with self._init_lock:
+            if self._collections_ready:
+                return
+            try:
+                mongo.db.create_collection("analysis_job_events", capped=True, size=self.log_size_bytes)
+            except CollectionInvalid:
+                pass
+            mongo.db.analysis_job_events.create_index([("job_id", 1), ("seq", 1)])
+            self._collections_ready = True
+
+    def submit(self, kind: str, user_id: Optional[str], pipeline: Callable[[], Iterable[str]], on_finish: Optional[Callable[[], None]] = None) -> str:
+        """
+        提交任务
+        :param kind: 任务类型（如 analyze_blueprint）
+        :param user_id: 用户ID（查询与回放时校验）
+        :param pipeline: 返回输出块迭代器的可调用对象，在后台线程中执行
+        :param on_finish: 任务结束后的清理回调（如删除暂存文件）；提交被拒绝时不调用
+        :return: 任务ID
+        :raises JobQueueFullError: 排队任务数已达上限
+        """
+        job_id = ObjectId()
+        with self._lock:
+            if len(self._active) >= self.max_workers + self.max_queue:
+                self._stats["rejected"] += 1
+                raise JobQueueFullError(f"job queue is full ({self.max_queue} waiting)")
+            self._active.add(job_id)
+            self._stats["submitted"] += 1
+            if self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat, name="analysis-job-heartbeat", daemon=True)
+                self._heartbeat_thread.start()
+        try:
+            now = datetime.utcnow()
+            self._jobs().insert_one({
+                "_id": job_id,
+                "kind": kind,
+                "user_id": user_id,
+                "status": JOB_STATUS_QUEUED,
+                "last_seq": 0,
+                "created_at": now,
+                "updated_at": now
+            })
+            self._ensure_collections()
+            self.executor.submit(self._run, job_id, pipeline, on_finish)
+        except BaseException:
+            with self._lock:
+                self._active.discard(job_id)
+            raise
+        return str(job_id)
+
+    def _run(self, job_id: ObjectId, pipeline: Callable[[], Iterable[str]], on_finish: Optional[Callable[[], None]]) -> None:
+        writer = JobLogWriter(self, job_id)
+        status = JOB_STATUS_DONE
+        error = None
+        with self._lock:
+            self._running += 1
+        try:
+            self._jobs().update_one({"_id": job_id}, {"$set": {"status": JOB_STATUS_RUNNING, "started_at": datetime.utcnow(), "updated_at": datetime.utcnow()}})
+            for chunk in pipeline():
+                # 流水线中的 SSE 心跳注释无需持久化，回放接口会自行发送心跳
+                if chunk.startswith(": ") and chunk.endswith("\n\n"):
+                    continue
+                writer.write(chunk)
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}", exc_info=True)
+            status = JOB_STATUS_FAILED
+            error = str(e)
+            writer.write(f"\n\n**系统错误**: {str(e)}")
+        finally:
+            try:
+                writer.flush()
+                self._jobs().update_one(
+                    {"_id": job_id},
+                    {"$set": {"status": status, "error": error, "finished_at": datetime.utcnow(), "updated_at": datetime.utcnow()}}
+                )
+            except Exception as e:
+                logger.error(f"Failed to finalize job {job_id}: {str(e)}")
+            with self._lock:
+                self._active.discard(job_id)
+                self._running -= 1
+                self._stats["completed" if status == JOB_STATUS_DONE else "failed"] += 1
+            if on_finish:
+                try:
+                    on_finish()
+                except Exception as e:
+                    logger.error(f"Job {job_id} cleanup failed: {str(e)}")
+
+    def _heartbeat(self) -> None:
+        """
+        定期刷新本进程排队 / 执行中任务的 updated_at，其他进程据此区分存活任务与中断任务
+        """
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                active = list(self._active)
+            if not active:
+                continue
+            try:
+                self._jobs().update_many(
+                    {"_id": {"$in": active}, "status": {"$in": list(ACTIVE_STATUSES)}},
+                    {"$set": {"updated_at": datetime.utcnow()}}
+                )
+            except Exception as e:
+                logger.error(f"Job heartbeat failed: {str(e)}")
+
+    def fail_stale_jobs(self) -> int:
+        """
+        将心跳超时的未结束任务标记为失败（启动时调用；回放时也会按单个任务判断）
+        :return: 标记的任务数
+        """
+        result = self._jobs().update_many(
+            {"status": {"$in": list(ACTIVE_STATUSES)}, "updated_at": {"$lt": datetime.utcnow() - timedelta(seconds=self.stale_after)}},
+            {"$set": {"status": JOB_STATUS_FAILED, "error": STALE_JOB_ERROR, "finished_at": datetime.utcnow(), "updated_at": datetime.utcnow()}}
+        )
+        if result.modified_count:
+            logger.warning(f"Marked {result.modified_count} interrupted jobs as failed")
+            with self._lock:
+                self._stats["stale_failed"] += result.modified_count
+        return result.modified_count
+
+    def _fail_if_stale(self, job: dict) -> bool:
+        """
+        任务心跳超时时标记为失败（以 updated_at 为条件，避免覆盖刚刚恢复心跳的任务）
+        :return: 是否已标记（其他进程已标记时由下一次轮询读到结束状态）
+        """
+        updated_at = job.get("updated_at")
+        with self._lock:
+            alive_here = job.get("_id") in self._active
+        if alive_here or not updated_at:
+            return False
+        if datetime.utcnow() - updated_at < timedelta(seconds=self.stale_after):
+            return False
+        result = self._jobs().update_one(
+            {"_id": job["_id"], "status": {"$in": list(ACTIVE_STATUSES)}, "updated_at": updated_at},
+            {"$set": {"status": JOB_STATUS_FAILED, "error": STALE_JOB_ERROR, "finished_at": datetime.utcnow(), "updated_at": datetime.utcnow()}}
+        )
+        if result.modified_count:
+            logger.warning(f"Job {job['_id']} has no heartbeat for {self.stale_after:.0f}s, marked as failed")
+            with self._lock:
+                self._stats["stale_failed"] += 1
+        return bool(result.modified_count)
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        try:
+            oid = ObjectId(job_id)
+        except Exception:
+            return None
+        return self._jobs().find_one({"_id": oid})
+
+    def stream_events(self, job_id: str, last_event_id: int = 0, heartbeat_interval: float = 2.0) -> Generator[tuple, None, None]:
+        """
+        回放并跟随任务日志
+        :param last_event_id: 客户端已收到的最后序号（Last-Event-ID）
+        :return: 生成器，产出 (序号, 文本)；序号为 None 表示心跳
+        """
+        oid = ObjectId(job_id)
+        last_seq = max(0, last_event_id)
+        last_sent_at = time.monotonic()
+        while True:
+            # 先读取任务状态，再读取日志段：避免状态变为已结束后漏读最后的日志段
+            job = self._jobs().find_one({"_id": oid}, {"status": 1, "updated_at": 1})
+            if not job:
+                return
+            for event in self._events().find({"job_id": oid, "seq": {"$gt": last_seq}}).sort("seq", 1):
+                last_seq = event["seq"]
+                last_sent_at = time.monotonic()
+                yield last_seq, event["data"]
+            if job.get("status") in FINISHED_STATUSES or self._fail_if_stale(job):
+                return
+            if time.monotonic() - last_sent_at >= heartbeat_interval:
+                last_sent_at = time.monotonic()
+                yield None, None
+            time.sleep(self.poll_interval)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["running"] = self._running
+            stats["queued"] = len(self._active) - self._running
+        stats["max_workers"] = self.max_workers
+        stats["max_queue"] = self.max_queue
+        return stats
@@ -0,0 +1,343 @@
+# 文件名：schema_service.py
+"""
+功能说明：MongoDB 索引声明与查询计划校验
+核心功能：
+1. 按集合声明业务所需索引（用户名唯一、书籍统计 (book_name, role) 唯一、各排序字段等）
+2. 幂等创建索引：已存在且定义一致时跳过，定义冲突或存在重复数据时明确报错
+3. 对 blueprint_api / auth_api / dashboard_api（及其调用的服务）中的热点查询执行 explain，发现 COLLSCAN 即报错；
+   标记为覆盖查询的（历史列表）还要求计划中没有 FETCH 且 totalDocsExamined 为 0
+说明：所有函数接收 pymongo Database 参数，不依赖 Flask 上下文，可直接连接本地 mongod 验证：
+      MongoClient("mongodb://localhost:27017")["blueprint_master_test"]
+依赖模块：pymongo, bson
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+from bson import ObjectId
+from bson.son import SON
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# 创建唯一索引时已有重复数据
+_DUPLICATE_KEY_CODE = 11000
+# 索引定义冲突（同键不同名 / 同名不同键或选项）
+_INDEX_CONFLICT_CODES = (85, 86)
+
+
+class SchemaError(RuntimeError):
+    """
+    索引无法创建或热点查询未命中索引
+    """
+
+
+# 历史列表返回的字段：全部放入列表索引（键序在 user_id / created_at / _id 之后），列表查询只读索引、不读取文档
+HISTORY_LIST_FIELDS = ("action", "filename", "role", "status", "content_length", "content_truncated", "content_preview")
+HISTORY_LIST_INDEX = "user_created_list"
+
+# 集合 -> 索引声明列表；name 必须显式指定，用于判断是否已存在
+# 说明：analysis_job_events 为固定集合，由 JobService 负责创建（先建固定集合再建索引），不在此声明
+INDEX_DECLARATIONS: Dict[str, List[Dict[str, Any]]] = {
+    "users": [
+        # auth_service.login_or_register 按用户名 upsert；唯一索引同时防止并发注册产生重名用户
+        {"keys": [("username", ASCENDING)], "name": "username_unique", "unique": True},
+        # dashboard_api 最近登录用户
+        {"keys": [("last_login", DESCENDING)], "name": "last_login_desc"},
+    ],
+    "book_stats": [
+        # blueprint_api 按 (book_name, role) 累加计数
+        {"keys": [("book_name", ASCENDING), ("role", ASCENDING)], "name": "book_role_unique", "unique": True},
+        # dashboard_service 书籍排行按 role 过滤（各角色由 $topN 按 count 取前 N）
+        {"keys": [("role", ASCENDING), ("count", DESCENDING)], "name": "role_count_desc"},
+    ],
+    "usage_logs": [
+        # dashboard_api 最近使用记录
+        {"keys": [("created_at", DESCENDING)], "name": "created_at_desc"},
+    ],
+    "feedbacks": [
+        {"keys": [("created_at", DESCENDING)], "name": "created_at_desc"},
+    ],
+    "analysis_histories": [
+        # history_service 列表查询的覆盖索引（查询 hint 此索引）；前缀同时服务于按用户计数
+        # 取代早期的 user_created_id (user_id, created_at, _id)，已部署的旧索引可手动删除
+        # 说明：content_preview 最长约 400 字，需 MongoDB 4.2+（取消了 1024 字节的索引键长度限制）
+        {
+            "keys": [("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)] + [(f, ASCENDING) for f in HISTORY_LIST_FIELDS],
+            "name": HISTORY_LIST_INDEX,
+        },
+    ],
+    "activity_rollups": [
+        # dashboard_api 时间序列 / 活跃用户（按粒度过滤、按桶时间范围查询）
+        {"keys": [("granularity", ASCENDING), ("bucket", ASCENDING)], "name": "granularity_bucket"},
+        # 分钟 / 小时桶到期自动删除；日桶不设 expires_at，长期保留
+        {"keys": [("expires_at", ASCENDING)], "name": "expires_at_ttl", "expireAfterSeconds": 0},
+    ],
+    "analysis_history_segments": [
+        # 沿用早期由 history_service 自动生成的索引名，避免与已部署的索引冲突
+        {"keys": [("history_id", ASCENDING), ("seq", ASCENDING)], "name": "history_id_1_seq_1", "unique": True},
+    ],
+    "analysis_history_content_chunks": [
+        # history_service 按块写入压缩正文，按序号读取；唯一索引使队列重试写入的重复块被忽略
+        {"keys": [("history_id", ASCENDING), ("seq", ASCENDING)], "name": "history_id_1_seq_1", "unique": True},
+    ],
+}
+
+# 创建索引时允许透传的选项
+_INDEX_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+def _same_index(existing: Dict[str, Any], spec: Dict[str, Any]) -> bool:
+    existing_keys = [(k, int(v)) if isinstance(v, (int, float)) else (k, v) for k, v in existing.get("key", [])]
+    if existing_keys != list(spec["keys"]):
+        return False
+    return all(existing.get(opt) == spec.get(opt) for opt in _INDEX_OPTIONS if opt in spec or opt in existing)
+
+
+def _duplicate_groups(collection, keys: List[tuple], limit: int = 5) -> List[Dict[str, Any]]:
+    """
+    唯一索引创建失败时列出重复的键值，便于人工清理
+    """
+    group_id = {k.replace(".", "_"): f"${k}" for k, _ in keys}
+    pipeline = [
+        {"$group": {"_id": group_id, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": limit},
+    ]
+    return list(collection.aggregate(pipeline, allowDiskUse=True))
+
+
+def ensure_indexes(db, collections: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+    """
+    幂等创建声明的索引
+    :param db: pymongo Database
+    :param collections: 仅处理指定集合（默认全部）
+    :return: 每个索引的处理结果 [{"collection", "name", "status": created/exists}]
+    :raises SchemaError: 索引定义冲突或唯一索引遇到重复数据
+    """
+    names = list(collections) if collections is not None else list(INDEX_DECLARATIONS)
+    results = []
+    for coll_name in names:
+        collection = db[coll_name]
+        existing = collection.index_information()
+        for spec in INDEX_DECLARATIONS.get(coll_name, []):
+            name = spec["name"]
+            if name in existing:
+                if not _same_index(existing[name], spec):
+                    raise SchemaError(f"{coll_name}.{name} exists with a different definition: {existing[name]}")
+                results.append({"collection": coll_name, "name": name, "status": "exists"})
+                continue
+
+            options = {opt: spec[opt] for opt in _INDEX_OPTIONS if opt in spec}
+            try:
+                collection.create_index(spec["keys"], name=name, **options)
+            except OperationFailure as e:
+                if e.code == _DUPLICATE_KEY_CODE:
+                    duplicates = _duplicate_groups(collection, spec["keys"])
+                    raise SchemaError(f"cannot create unique index {coll_name}.{name}, duplicate keys: {duplicates}")
+                if e.code in _INDEX_CONFLICT_CODES:
+                    raise SchemaError(f"index conflict on {coll_name}.{name}: {e}")
+                raise
+            logger.info(f"Created index {coll_name}.{name}")
+            results.append({"collection": coll_name, "name": name, "status": "created"})
+    return results
+
+
+def history_list_projection() -> Dict[str, int]:
+    """
+    历史列表查询的投影（仅包含列表索引中的字段，查询可被索引覆盖）
+    """
+    projection = {"_id": 1, "created_at": 1}
+    projection.update({field: 1 for field in HISTORY_LIST_FIELDS})
+    return projection
+
+
+def hot_queries() -> List[Dict[str, Any]]:
+    """
+    各接口的热点查询（与 API / 服务中的实际查询形状保持一致，参数取占位值）
+    command 为 explain 的目标命令；covered 为 True 时要求查询被索引覆盖（不读取文档）
+    """
+    sample_oid = ObjectId()
+    sample_time = datetime.utcnow()
+    sample_user = "explain-user"
+    return [
+        {
+            "name": "auth_service.login_or_register: upsert by username",
+            "command": SON([
+                ("findAndModify", "users"),
+                ("query", {"username": sample_user}),
+                ("update", {"$set": {"last_login": sample_time}, "$setOnInsert": {"username": sample_user, "created_at": sample_time}}),
+                ("upsert", True), ("new", True),
+            ]),
+        },
+        {
+            "name": "dashboard_service.compute_user_stats: recent logins",
+            "command": SON([
+                ("find", "users"), ("filter", {}),
+                ("projection", {"_id": 0, "username": 1, "last_login": 1}),
+                ("sort", SON([("last_login", -1)])), ("limit", 20),
+            ]),
+        },
+        {
+            "name": "dashboard_service.compute_user_stats: recent usage logs",
+            "command": SON([
+                ("find", "usage_logs"), ("filter", {}),
+                ("projection", {"_id": 0, "username": 1, "action": 1, "created_at": 1}),
+                ("sort", SON([("created_at", -1)])), ("limit", 10),
+            ]),
+        },
+        {
+            "name": "dashboard_service.compute_book_stats: ranking for all roles",
+            "command": SON([
+                ("aggregate", "book_stats"),
+                ("pipeline", [
+                    {"$match": {"role": {"$in": ["all", "cxo", "hr"]}}},
+                    {"$group": {"_id": "$role", "books": {"$topN": {
+                        "n": {"$cond": [{"$eq": ["$role", "all"]}, 10, 5]},
+                        "sortBy": SON([("count", -1), ("book_name", 1)]),
+                        "output": {"book_name": "$book_name", "count": "$count"},
+                    }}}},
+                ]),
+                ("cursor", {}),
+            ]),
+        },
+        {
+            "name": "activity_service.get_time_series: buckets in range",
+            "command": SON([
+                ("aggregate", "activity_rollups"),
+                ("pipeline", [
+                    {"$match": {"granularity": "hour", "bucket": {"$gte": sample_time - timedelta(days=1), "$lt": sample_time}}},
+                    {"$sort": SON([("granularity", 1), ("bucket", 1)])},
+                    {"$limit": 1500},
+                ]),
+                ("cursor", {}),
+            ]),
+        },
+        {
+            "name": "activity_service.get_active_users: daily buckets",
+            "command": SON([
+                ("find", "activity_rollups"),
+                ("filter", {"granularity": "day", "bucket": {"$gt": sample_time - timedelta(days=30), "$lte": sample_time}}),
+                ("projection", {"bucket": 1, "users": 1}),
+            ]),
+        },
+        {
+            "name": "stats_service: book_stats bulk upsert",
+            "command": SON([
+                ("update", "book_stats"),
+                ("updates", [{
+                    "q": {"book_name": "explain-book", "role": "all"},
+                    "u": {"$inc": {"count": 1}, "$max": {"last_used_at": sample_time}},
+                    "upsert": True,
+                }]),
+            ]),
+        },
+        {
+            "name": "blueprint_api.get_history_list: first page",
+            "covered": True,
+            "command": SON([
+                ("find", "analysis_histories"), ("filter", {"user_id": sample_user}),
+                ("projection", history_list_projection()),
+                ("sort", SON([("created_at", -1), ("_id", -1)])), ("limit", 11),
+                ("hint", HISTORY_LIST_INDEX),
+            ]),
+        },
+        {
+            "name": "blueprint_api.get_history_list: keyset page",
+            "covered": True,
+            "command": SON([
+                ("find", "analysis_histories"),
+                ("filter", {
+                    "user_id": sample_user,
+                    "$or": [
+                        {"created_at": {"$lt": sample_time}},
+                        {"created_at": sample_time, "_id": {"$lt": sample_oid}},
+                    ],
+                }),
+                ("projection", history_list_projection()),
+                ("sort", SON([("created_at", -1), ("_id", -1)])), ("limit", 11),
+                ("hint", HISTORY_LIST_INDEX),
+            ]),
+        },
+        {
+            "name": "blueprint_api.get_history_list: total count",
+            "command": SON([("count", "analysis_histories"), ("query", {"user_id": sample_user})]),
+        },
+        {
+            "name": "blueprint_api.get_history_detail: find by id and owner",
+            "command": SON([("find", "analysis_histories"), ("filter", {"_id": sample_oid, "user_id": sample_user}), ("limit", 1)]),
+        },
+        {
+            "name": "history_service: join content segments",
+            "command": SON([
+                ("find", "analysis_history_segments"), ("filter", {"history_id": sample_oid}),
+                ("sort", SON([("seq", 1)])),
+            ]),
+        },
+    ]
+
+
+def _plan_stages(node: Any, stages: List[str]) -> None:
+    """
+    递归收集胜出计划中的所有 stage（跳过 rejectedPlans）
+    兼容经典执行引擎（inputStage / inputStages）、SBE（queryPlan）与聚合（stages / $cursor）的 explain 结构
+    """
+    if isinstance(node, dict):
+        stage = node.get("stage")
+        if isinstance(stage, str):
+            stages.append(stage)
+        for key, value in node.items():
+            if key == "rejectedPlans":
+                continue
+            _plan_stages(value, stages)
+    elif isinstance(node, list):
+        for item in node:
+            _plan_stages(item, stages)
+
+
+def explain_query(db, query: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    对单个热点查询执行 explain：一般查询为 queryPlanner 级别（不实际执行）；
+    覆盖查询为 executionStats 级别（执行占位参数的查询），以读取 totalDocsExamined
+    :return: {"name", "stages", "collscan", "covered", "docs_examined"}
+    """
+    covered = bool(query.get("covered"))
+    result = db.command("explain", query["command"], verbosity="executionStats" if covered else "queryPlanner")
+    stages: List[str] = []
+    _plan_stages(result.get("queryPlanner", result), stages)
+    report = {"name": query["name"], "stages": stages, "collscan": "COLLSCAN" in stages, "covered": None, "docs_examined": None}
+    if covered:
+        report["docs_examined"] = (result.get("executionStats") or {}).get("totalDocsExamined")
+        report["covered"] = "FETCH" not in stages and not report["docs_examined"]
+    return report
+
+
+def verify_query_plans(db, queries: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    校验热点查询均命中索引，覆盖查询不读取文档
+    :return: 每个查询的 explain 摘要
+    :raises SchemaError: 任一查询的执行计划包含 COLLSCAN，或覆盖查询出现 FETCH / totalDocsExamined > 0
+    """
+    reports = [explain_query(db, q) for q in (queries or hot_queries())]
+    offenders = [r["name"] for r in reports if r["collscan"]]
+    if offenders:
+        raise SchemaError(f"hot queries still use COLLSCAN: {offenders}")
+    uncovered = [f"{r['name']} (stages={r['stages']}, docs_examined={r['docs_examined']})" for r in reports if r["covered"] is False]
+    if uncovered:
+        raise SchemaError(f"hot queries are not covered by their index: {uncovered}")
+    return reports
+
+
+def bootstrap_schema(db, verify: bool = False) -> None:
+    """
+    应用启动时调用：创建索引，可选校验热点查询计划
+    """
+    results = ensure_indexes(db)
+    created = [f"{r['collection']}.{r['name']}" for r in results if r["status"] == "created"]
+    if created:
+        logger.info(f"Created indexes: {created}")
+    if verify:
+        verify_query_plans(db)
+        logger.info("All hot queries use indexes")
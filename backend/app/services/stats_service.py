@@ -0,0 +1,49 @@
+# 文件名：stats_service.py
+"""
+功能说明：使用统计写入
+核心功能：
+1. 书籍使用计数：请求线程只在内存中累加 (book_name, role) 增量，
+   由写后缓冲定期 / 达到阈值时以一次无序 bulk_write 批量 $inc 写入 book_stats
+依赖模块：extensions, write_behind
+"""
+from datetime import datetime
+from typing import Dict, Hashable, Iterable
+
+from pymongo import UpdateOne
+
+from app.config import Config
+from app.extensions import mongo
+from app.utils.write_behind import CounterAggregator, CounterDelta
+
+
+def _flush_book_stats(batch: Dict[Hashable, CounterDelta]) -> None:
+    operations = []
+    for (book_name, role), delta in batch.items():
+        update = {"$inc": delta.incs}
+        if delta.maxes:
+            # 批次可能乱序到达，最后使用时间只前进不后退
+            update["$max"] = delta.maxes
+        operations.append(UpdateOne({"book_name": book_name, "role": role}, update, upsert=True))
+    mongo.db.book_stats.bulk_write(operations, ordered=False)
+
+
+book_stats_counter = CounterAggregator(
+    _flush_book_stats,
+    flush_interval=Config.BOOK_STATS_FLUSH_INTERVAL,
+    max_keys=Config.BOOK_STATS_FLUSH_MAX_KEYS,
+    name="book_stats"
+)
+
+
+def record_book_usage(books: Iterable[str], role: str = None) -> None:
+    """
+    记录一次分析用到的书籍：总榜 (role=all) 与所属角色榜各计 1 次
+    """
+    now = datetime.utcnow()
+    for book in books or []:
+        if not book or not book.strip():
+            continue
+        name = book.strip()
+        book_stats_counter.add((name, "all"), {"count": 1}, {"last_used_at": now})
+        if role and role != 'unknown':
+            book_stats_counter.add((name, role), {"count": 1}, {"last_used_at": now})
@@ -0,0 +1,68 @@
+# 文件名：telemetry_service.py
+"""
+功能说明：遥测与历史记录的后台批量写入
+核心功能：
+1. 日志级（usage_logs）：不确认写入（w=0），队列满时直接丢弃并计数，不影响请求
+2. 持久级（feedbacks、分析历史摘要与分段）：确认写入（w=1），写入失败按指数退避重试，重试耗尽记录失败序号；队列满时阻塞等待（背压），超时后丢弃并计数
+3. 两级队列均以 insert_many(ordered=False) 批量写入，进程退出时写出剩余文档
+依赖模块：extensions, write_behind
+"""
+from typing import Any, Dict, List, Optional
+
+from pymongo import WriteConcern
+from pymongo.errors import BulkWriteError
+
+from app.config import Config
+from app.extensions import mongo
+from app.utils.write_behind import TelemetryWriter
+
+_LOG_WRITE_CONCERN = WriteConcern(w=0)
+_DURABLE_WRITE_CONCERN = WriteConcern(w=1)
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _insert_unacknowledged(collection: str, docs: List[dict]) -> None:
+    mongo.db.get_collection(collection, write_concern=_LOG_WRITE_CONCERN).insert_many(docs, ordered=False)
+
+
+def _insert_acknowledged(collection: str, docs: List[dict]) -> None:
+    try:
+        mongo.db.get_collection(collection, write_concern=_DURABLE_WRITE_CONCERN).insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        # 重试时上次已写入的文档（_id 已由驱动填充）报重复键，视为写入成功
+        details = e.details or {}
+        if details.get("writeConcernErrors") or any(err.get("code") != DUPLICATE_KEY_ERROR for err in details.get("writeErrors", [])):
+            raise
+
+
+log_writer = TelemetryWriter(
+    _insert_unacknowledged,
+    max_queue=Config.TELEMETRY_LOG_MAX_QUEUE,
+    batch_size=Config.TELEMETRY_BATCH_SIZE,
+    flush_interval=Config.TELEMETRY_FLUSH_INTERVAL,
+    block_timeout=None,
+    name="logs"
+)
+
+durable_writer = TelemetryWriter(
+    _insert_acknowledged,
+    max_queue=Config.TELEMETRY_DURABLE_MAX_QUEUE,
+    batch_size=Config.TELEMETRY_BATCH_SIZE,
+    flush_interval=Config.TELEMETRY_FLUSH_INTERVAL,
+    block_timeout=Config.TELEMETRY_DURABLE_BLOCK_SECONDS,
+    max_retries=Config.TELEMETRY_DURABLE_MAX_RETRIES,
+    retry_backoff=Config.TELEMETRY_DURABLE_RETRY_BACKOFF,
+    name="durable"
+)
+
+
+def enqueue_usage_log(doc: dict) -> Optional[int]:
+    return log_writer.put("usage_logs", doc)
+
+
+def enqueue_feedback(doc: dict) -> Optional[int]:
+    return durable_writer.put("feedbacks", doc)
+
+
+def get_telemetry_stats() -> Dict[str, Any]:
+    return {"logs": log_writer.get_stats(), "durable": durable_writer.get_stats()}
@@ -0,0 +1,202 @@
+# 文件名：artifact_store.py
+"""
+功能说明：派生文件存储（Word 导出、思维导图等由历史记录生成的产物）
+核心功能：
+1. 以内容摘要作为键（内容寻址）：相同输入只生成、保存一次，键同时作为 HTTP ETag
+2. 支持 MongoDB GridFS 与本地磁盘两种存储；读取时返回文件路径或流及其长度，便于直接作为静态文件下发
+3. 写入幂等：键已存在时跳过；磁盘写入先写临时文件再原子替换
+4. 统计命中/未命中/写入字节数
+依赖模块：gridfs, hashlib, os, shutil, threading, extensions
+"""
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from typing import Any, BinaryIO, Dict, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+_COPY_CHUNK_BYTES = 1024 * 1024
+
+
+def build_artifact_key(kind: str, version: str, source: str) -> str:
+    """
+    构建产物键：产物类型 + 生成器版本 + 源内容的 SHA-256
+    :param kind: 产物类型（如 docx / mindmap）
+    :param version: 生成器版本（输出格式或提示词变化时变更，旧产物随之失效）
+    :param source: 源内容（历史记录正文）
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{kind}|{version}|".encode("utf-8"))
+    digest.update((source or "").encode("utf-8"))
+    return digest.hexdigest()
+
+
+class StoredArtifact:
+    """
+    已保存的产物：磁盘存储提供 path，GridFS 提供可读流 stream
+    """
+
+    __slots__ = ("key", "length", "path", "stream")
+
+    def __init__(self, key: str, length: int, path: Optional[str] = None, stream: Optional[BinaryIO] = None):
+        self.key = key
+        self.length = length
+        self.path = path
+        self.stream = stream
+
+    def close(self) -> None:
+        if self.stream is not None:
+            self.stream.close()
+
+
+class DiskArtifactStore:
+    """
+    本地磁盘存储：按键前两位分目录，避免单目录文件过多
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root_dir, key[:2], key)
+
+    def open(self, key: str) -> Optional[StoredArtifact]:
+        path = self._path(key)
+        try:
+            length = os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+        return StoredArtifact(key, length, path=path)
+
+    def put(self, key: str, data: Union[bytes, BinaryIO], content_type: str) -> int:
+        path = self._path(key)
+        if os.path.exists(path):
+            return os.path.getsize(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    shutil.copyfileobj(data, f, _COPY_CHUNK_BYTES)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return os.path.getsize(path)
+
+
+class GridFSArtifactStore:
+    """
+    MongoDB GridFS 存储（存储桶：artifacts），文件名即键
+    并发写入同一键时可能产生多个版本，内容相同，读取时取最新版本
+    """
+
+    def __init__(self, bucket_name: str = "artifacts"):
+        self.bucket_name = bucket_name
+        self._bucket = None
+
+    def _gridfs(self):
+        # 延迟导入：Store 在应用工厂初始化 mongo 之前实例化
+        if self._bucket is None:
+            from gridfs import GridFSBucket
+            from app.extensions import mongo
+
+            self._bucket = GridFSBucket(mongo.db, bucket_name=self.bucket_name)
+        return self._bucket
+
+    def open(self, key: str) -> Optional[StoredArtifact]:
+        from gridfs.errors import NoFile
+
+        try:
+            stream = self._gridfs().open_download_stream_by_name(key)
+        except NoFile:
+            return None
+        return StoredArtifact(key, stream.length, stream=stream)
+
+    def put(self, key: str, data: Union[bytes, BinaryIO], content_type: str) -> int:
+        existing = self.open(key)
+        if existing is not None:
+            existing.close()
+            return existing.length
+        upload = self._gridfs().open_upload_stream(key, metadata={"content_type": content_type})
+        try:
+            if isinstance(data, bytes):
+                upload.write(data)
+            else:
+                for chunk in iter(lambda: data.read(_COPY_CHUNK_BYTES), b""):
+                    upload.write(chunk)
+        except BaseException:
+            # 删除已写入的分块，避免留下没有文件记录的孤立分块
+            upload.abort()
+            raise
+        upload.close()
+        return upload.length
+
+
+class ArtifactStore:
+    """
+    派生文件存储（对外门面）
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "bytes_written": 0, "errors": 0}
+
+    @classmethod
+    def from_config(cls, config) -> "ArtifactStore":
+        backend = (getattr(config, "ARTIFACT_STORE_BACKEND", "gridfs") or "gridfs").lower()
+        try:
+            if backend == "disk":
+                store = DiskArtifactStore(config.ARTIFACT_STORE_DIR)
+            else:
+                store = GridFSArtifactStore()
+        except Exception as e:
+            logger.error(f"Failed to init artifact store ({backend}), falling back to GridFS: {str(e)}")
+            store = GridFSArtifactStore()
+        return cls(store)
+
+    def open(self, key: str) -> Optional[StoredArtifact]:
+        """
+        打开已保存的产物；不存在或读取失败时返回 None（由调用方重新生成）
+        """
+        try:
+            artifact = self.store.open(key)
+        except Exception as e:
+            logger.error(f"Artifact store read failed: {str(e)}")
+            self._incr("errors")
+            return None
+        self._incr("hits" if artifact is not None else "misses")
+        return artifact
+
+    def put(self, key: str, data: Union[bytes, BinaryIO], content_type: str) -> int:
+        """
+        保存产物（键已存在时跳过）
+        :return: 产物字节数
+        """
+        try:
+            length = self.store.put(key, data, content_type)
+        except Exception:
+            self._incr("errors")
+            raise
+        self._incr("writes")
+        self._incr("bytes_written", length)
+        return length
+
+    def _incr(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += value
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+        stats["backend"] = type(self.store).__name__
+        return stats
@@ -0,0 +1,107 @@
+# 文件名：document_sections.py
+"""
+功能说明：长文档按标题切分
+核心功能：
+1. 按 Markdown 标题将 OCR 文本切分为章节
+2. 相邻的小章节合并、超长章节按段落拆分，使每段不超过 token 上限
+依赖模块：token_budget
+"""
+import re
+from dataclasses import dataclass
+from typing import List
+
+from app.utils.token_budget import TokenEstimator
+
+_HEADING_PATTERN = re.compile(r"^\s{0,3}#{1,6}\s*\S")
+
+
+@dataclass
+class DocumentSection:
+    """
+    文档片段
+    :param title: 片段内第一个标题（无标题时为空）
+    :param text: 片段原文
+    :param tokens: 估算的 token 数
+    """
+    title: str
+    text: str
+    tokens: int
+
+
+def _split_by_headings(text: str) -> List[str]:
+    blocks = []
+    current: List[str] = []
+    for line in text.split("\n"):
+        if _HEADING_PATTERN.match(line) and any(l.strip() for l in current):
+            blocks.append("\n".join(current))
+            current = []
+        current.append(line)
+    if any(l.strip() for l in current):
+        blocks.append("\n".join(current))
+    return blocks
+
+
+def _split_oversized(block: str, max_tokens: int, estimator: TokenEstimator) -> List[str]:
+    """
+    将超过上限的章节按段落拆分；单个段落仍超限时按 token 截断成多段
+    """
+    pieces = []
+    current: List[str] = []
+    current_tokens = 0
+    for paragraph in re.split(r"\n{2,}", block):
+        paragraph_tokens = estimator.count(paragraph) + 1
+        while paragraph_tokens > max_tokens:
+            head = estimator.truncate(paragraph, max_tokens) or paragraph[:1]
+            if current:
+                pieces.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            pieces.append(head)
+            paragraph = paragraph[len(head):]
+            paragraph_tokens = estimator.count(paragraph) + 1
+        if not paragraph.strip():
+            continue
+        if current and current_tokens + paragraph_tokens > max_tokens:
+            pieces.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(paragraph)
+        current_tokens += paragraph_tokens
+    if current:
+        pieces.append("\n\n".join(current))
+    return pieces
+
+
+def _first_heading(text: str) -> str:
+    for line in text.split("\n"):
+        if _HEADING_PATTERN.match(line):
+            return line.strip().lstrip("#").strip()
+    return ""
+
+
+def split_markdown_sections(text: str, max_tokens: int, estimator: TokenEstimator) -> List[DocumentSection]:
+    """
+    将 Markdown 文本切分为按标题对齐、每段不超过 max_tokens 的片段（保持原文顺序）
+    """
+    max_tokens = max(1, max_tokens)
+    pieces: List[str] = []
+    for block in _split_by_headings(text or ""):
+        if estimator.count(block) > max_tokens:
+            pieces.extend(_split_oversized(block, max_tokens, estimator))
+        else:
+            pieces.append(block)
+
+    # 合并相邻的小片段，减少调用次数
+    sections: List[DocumentSection] = []
+    buffer: List[str] = []
+    buffer_tokens = 0
+    for piece in pieces:
+        piece_tokens = estimator.count(piece) + 1
+        if buffer and buffer_tokens + piece_tokens > max_tokens:
+            merged = "\n".join(buffer)
+            sections.append(DocumentSection(_first_heading(merged), merged, buffer_tokens))
+            buffer, buffer_tokens = [], 0
+        buffer.append(piece)
+        buffer_tokens += piece_tokens
+    if buffer:
+        merged = "\n".join(buffer)
+        sections.append(DocumentSection(_first_heading(merged), merged, buffer_tokens))
+    return sections
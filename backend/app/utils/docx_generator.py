@@ -1,97 +1,389 @@
 # 文件名：docx_generator.py
 """
 功能说明：Markdown 转 Word 文档生成器
-核心功能：解析 Markdown 文本并生成格式化的 .docx 文件
-依赖模块：python-docx
+核心功能：
+1. 预置样式模板：字体、标题颜色、引用、代码、表格等样式在模板中定义一次（进程内缓存），段落只引用样式，无需逐个设置字体
+2. 逐行解析 Markdown（预编译正则），直接生成 WordprocessingML 片段并流式写入 docx 压缩包，不在内存中构建文档对象树
+3. 支持标题（1-6 级）、引用、多级有序 / 无序列表（有序列表按段重新编号）、表格、代码块、粗体 / 斜体 / 行内代码
+4. 输出写入 SpooledTemporaryFile：小文档留在内存，大文档自动转存临时文件
+依赖模块：python-docx（仅用于生成样式模板）, zipfile
 """
+import io
+import re
+import tempfile
+import threading
+import zipfile
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
 from docx import Document
-from docx.shared import Pt, RGBColor
-from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
+from docx.enum.style import WD_STYLE_TYPE
 from docx.oxml.ns import qn
-import re
-import io
+from docx.shared import Pt, RGBColor
+
+FONT_NAME = u'微软雅黑'
+CODE_FONT_NAME = 'Consolas'
+
+DOCUMENT_PART = "word/document.xml"
+NUMBERING_PART = "word/numbering.xml"
+
+# 输出格式版本：渲染规则或样式变化时递增，已保存的派生文件随之失效
+RENDERER_VERSION = "2"
+
+# 默认输出在内存中保留的最大字节数，超过后转存临时文件
+DEFAULT_SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+# 正文 XML 累积到该字符数时写入压缩流
+_WRITE_CHUNK_CHARS = 256 * 1024
+# 版心宽度（twips，Letter 纸宽 12240 - 左右边距 1800 × 2），用于表格均分列宽
+_TEXT_WIDTH_TWIPS = 8640
+# 列表最多支持的嵌套层级（对应 List Bullet / List Bullet 2 / List Bullet 3 等样式）
+_MAX_LIST_LEVELS = 3
+
+_HEADING_RE = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+_BULLET_RE = re.compile(r'^([ \t]*)[-*+]\s+(.*)$')
+_ORDERED_RE = re.compile(r'^([ \t]*)(\d+)[.)]\s+(.*)$')
+_QUOTE_RE = re.compile(r'^>\s?(.*)$')
+_FENCE_RE = re.compile(r'^\s*(```|~~~)')
+_RULE_RE = re.compile(r'^\s*(?:-{3,}|\*{3,}|_{3,})\s*$')
+_TABLE_SEPARATOR_RE = re.compile(r'^\s*\|?\s*:?-{3,}:?\s*(?:\|\s*:?-{3,}:?\s*)*\|?\s*$')
+_TABLE_CELL_SPLIT_RE = re.compile(r'(?<!\\)\|')
+_INLINE_RE = re.compile(r'\*\*(.+?)\*\*|__(.+?)__|`([^`]+)`|\*([^*\s][^*]*?)\*')
+# XML 1.0 不允许的控制字符（模型输出中偶有出现，python-docx 遇到会直接报错）
+_INVALID_XML_CHARS_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
 
-def generate_blueprint_docx(markdown_text: str) -> io.BytesIO:
+_BOLD = '<w:b/>'
+_ITALIC = '<w:i/>'
+_CODE = f'<w:rFonts w:ascii="{CODE_FONT_NAME}" w:hAnsi="{CODE_FONT_NAME}"/>'
+
+
+class _DocxTemplate:
     """
-    将 Markdown 文本转换为 Word 文档流
-    :param markdown_text: Markdown 格式的分析报告
-    :return: BytesIO 对象 (docx 文件流)
+    预置样式的空白文档：各部件原始内容 + 正文 XML 的头尾 + 列表样式对应的编号定义
+    """
+
+    def __init__(self):
+        document = Document()
+        styles = document.styles
+
+        _set_style_font(styles['Normal'], FONT_NAME)
+        for level in range(1, 7):
+            _set_style_font(styles[f'Heading {level}'], FONT_NAME)
+        styles['Heading 1'].font.color.rgb = RGBColor(216, 30, 6)  # 红色
+        styles['Heading 2'].font.color.rgb = RGBColor(0, 0, 0)
+
+        quote = styles.add_style('Blueprint Quote', WD_STYLE_TYPE.PARAGRAPH)
+        quote.base_style = styles['Normal']
+        quote.font.italic = True
+        quote.font.color.rgb = RGBColor(100, 100, 100)
+
+        code = styles.add_style('Blueprint Code', WD_STYLE_TYPE.PARAGRAPH)
+        code.base_style = styles['Normal']
+        _set_style_font(code, CODE_FONT_NAME)
+        code.font.size = Pt(9)
+        code.paragraph_format.space_after = Pt(0)
+
+        self.style_ids = {
+            'quote': quote.style_id,
+            'code': code.style_id,
+            'table': styles['Table Grid'].style_id,
+            'headings': [styles[f'Heading {level}'].style_id for level in range(1, 7)],
+            'bullets': [styles['List Bullet' if i == 0 else f'List Bullet {i + 1}'].style_id for i in range(_MAX_LIST_LEVELS)],
+            'numbers': [styles['List Number' if i == 0 else f'List Number {i + 1}'].style_id for i in range(_MAX_LIST_LEVELS)]
+        }
+
+        # 有序列表样式引用的抽象编号，用于为每段列表生成重新起始编号的 w:num
+        numbering = document.part.numbering_part.element
+        abstract_by_num = {
+            num.get(qn('w:numId')): num.find(qn('w:abstractNumId')).get(qn('w:val'))
+            for num in numbering.findall(qn('w:num'))
+        }
+        self.number_abstract_ids = []
+        for i in range(_MAX_LIST_LEVELS):
+            style = styles['List Number' if i == 0 else f'List Number {i + 1}']
+            num_ids = style.element.xpath('./w:pPr/w:numPr/w:numId/@w:val')
+            self.number_abstract_ids.append(abstract_by_num.get(num_ids[0]) if num_ids else None)
+        self.next_num_id = max((int(n) for n in abstract_by_num), default=0) + 1
+
+        # 正文只保留节属性，拆成头尾两段供流式写入时包裹段落
+        body = document.element.body
+        for child in list(body):
+            if child.tag != qn('w:sectPr'):
+                body.remove(child)
+
+        stream = io.BytesIO()
+        document.save(stream)
+        with zipfile.ZipFile(stream) as zf:
+            self.parts: List[Tuple[zipfile.ZipInfo, bytes]] = [(info, zf.read(info.filename)) for info in zf.infolist()]
+
+        parts = dict((info.filename, data) for info, data in self.parts)
+        document_xml = parts[DOCUMENT_PART].decode('utf-8')
+        body_start = re.search(r'<w:body[^>]*>', document_xml).end()
+        sect_start = document_xml.index('<w:sectPr', body_start)
+        self.document_head = document_xml[:body_start]
+        self.document_tail = document_xml[sect_start:]
+        self.numbering_xml = parts[NUMBERING_PART].decode('utf-8')
+
+
+def _set_style_font(style, font_name: str) -> None:
+    """
+    样式级字体（含东亚字体）；去掉主题字体属性，否则主题字体优先于显式字体
+    """
+    style.font.name = font_name
+    rfonts = style.element.get_or_add_rPr().get_or_add_rFonts()
+    rfonts.set(qn('w:eastAsia'), font_name)
+    for attr in ('w:asciiTheme', 'w:hAnsiTheme', 'w:eastAsiaTheme', 'w:cstheme'):
+        rfonts.attrib.pop(qn(attr), None)
+
+
+_template: Optional[_DocxTemplate] = None
+_template_lock = threading.Lock()
+
+
+def _get_template() -> _DocxTemplate:
+    global _template
+    if _template is None:
+        with _template_lock:
+            if _template is None:
+                _template = _DocxTemplate()
+    return _template
+
+
+def _text(value: str) -> str:
+    return escape(_INVALID_XML_CHARS_RE.sub('', value))
+
+
+def _run(text: str, props: str = '') -> str:
+    if not text:
+        return ''
+    rpr = f'<w:rPr>{props}</w:rPr>' if props else ''
+    return f'<w:r>{rpr}<w:t xml:space="preserve">{_text(text)}</w:t></w:r>'
+
+
+def _inline_runs(text: str, base_props: str = '') -> str:
+    """
+    行内格式：**粗体** / __粗体__ / *斜体* / `代码`
     """
-    document = Document()
-    
-    # 设置中文字体
-    document.styles['Normal'].font.name = u'微软雅黑'
-    document.styles['Normal']._element.rPr.rFonts.set(qn('w:eastAsia'), u'微软雅黑')
-    
+    runs = []
+    pos = 0
+    for match in _INLINE_RE.finditer(text):
+        runs.append(_run(text[pos:match.start()], base_props))
+        bold, bold_alt, code, italic = match.groups()
+        if bold is not None or bold_alt is not None:
+            runs.append(_run(bold if bold is not None else bold_alt, base_props + _BOLD))
+        elif code is not None:
+            runs.append(_run(code, base_props + _CODE))
+        else:
+            runs.append(_run(italic, base_props + _ITALIC))
+        pos = match.end()
+    runs.append(_run(text[pos:], base_props))
+    return ''.join(runs)
+
+
+def _paragraph(content: str, style_id: Optional[str] = None, num: Optional[Tuple[int, int]] = None) -> str:
+    ppr = ''
+    if style_id or num:
+        style = f'<w:pStyle w:val="{style_id}"/>' if style_id else ''
+        numpr = f'<w:numPr><w:ilvl w:val="{num[1]}"/><w:numId w:val="{num[0]}"/></w:numPr>' if num else ''
+        ppr = f'<w:pPr>{style}{numpr}</w:pPr>'
+    return f'<w:p>{ppr}{content}</w:p>'
+
+
+def _split_table_row(line: str) -> List[str]:
+    line = line.strip()
+    if line.startswith('|'):
+        line = line[1:]
+    if line.endswith('|') and not line.endswith('\\|'):
+        line = line[:-1]
+    return [cell.strip().replace('\\|', '|') for cell in _TABLE_CELL_SPLIT_RE.split(line)]
+
+
+def _table(rows: List[List[str]], style_id: str) -> str:
+    columns = max(len(row) for row in rows)
+    width = _TEXT_WIDTH_TWIPS // columns
+    parts = [
+        f'<w:tbl><w:tblPr><w:tblStyle w:val="{style_id}"/><w:tblW w:w="0" w:type="auto"/>'
+        '<w:tblLook w:val="04A0" w:firstRow="1" w:lastRow="0" w:firstColumn="1" w:lastColumn="0" w:noHBand="0" w:noVBand="1"/></w:tblPr>',
+        '<w:tblGrid>' + f'<w:gridCol w:w="{width}"/>' * columns + '</w:tblGrid>'
+    ]
+    for index, row in enumerate(rows):
+        header = index == 0
+        cells = row + [''] * (columns - len(row))
+        parts.append('<w:tr><w:trPr><w:tblHeader/></w:trPr>' if header else '<w:tr>')
+        for cell in cells:
+            content = _inline_runs(cell, _BOLD if header else '')
+            parts.append(f'<w:tc><w:tcPr><w:tcW w:w="{width}" w:type="dxa"/></w:tcPr>{_paragraph(content)}</w:tc>')
+        parts.append('</w:tr>')
+    parts.append('</w:tbl>')
+    return ''.join(parts)
+
+
+class _ListState:
+    """
+    列表层级跟踪：按缩进宽度栈确定层级，有序列表每段分配新的编号实例
+    """
+
+    def __init__(self, template: _DocxTemplate):
+        self.template = template
+        self.indents: List[int] = []
+        # 层级 -> 当前有序列表的 numId（无序列表为 None）
+        self.active_nums: Dict[int, Optional[int]] = {}
+        self.new_nums: List[Tuple[int, str, int]] = []
+        self.next_num_id = template.next_num_id
+
+    def reset(self) -> None:
+        self.indents = []
+        self.active_nums = {}
+
+    def level_for(self, indent: int) -> int:
+        while self.indents and indent < self.indents[-1]:
+            self.indents.pop()
+        if not self.indents or indent > self.indents[-1]:
+            self.indents.append(indent)
+        level = min(len(self.indents), _MAX_LIST_LEVELS) - 1
+        for deeper in [lv for lv in self.active_nums if lv > level]:
+            del self.active_nums[deeper]
+        return level
+
+    def bullet(self, level: int) -> None:
+        self.active_nums[level] = None
+
+    def number(self, level: int, start: int) -> Optional[int]:
+        num_id = self.active_nums.get(level)
+        if num_id is None:
+            abstract_id = self.template.number_abstract_ids[level]
+            if abstract_id is None:
+                return None
+            num_id = self.next_num_id
+            self.next_num_id += 1
+            self.new_nums.append((num_id, abstract_id, start))
+            self.active_nums[level] = num_id
+        return num_id
+
+    def numbering_xml(self) -> str:
+        extra = ''.join(
+            f'<w:num w:numId="{num_id}"><w:abstractNumId w:val="{abstract_id}"/>'
+            f'<w:lvlOverride w:ilvl="0"><w:startOverride w:val="{start}"/></w:lvlOverride></w:num>'
+            for num_id, abstract_id, start in self.new_nums
+        )
+        xml = self.template.numbering_xml
+        end = xml.rindex('</w:numbering>')
+        return xml[:end] + extra + xml[end:]
+
+
+def _render_blocks(markdown_text: str, template: _DocxTemplate, lists: _ListState):
+    """
+    逐块生成正文 XML 片段
+    """
+    ids = template.style_ids
     lines = markdown_text.split('\n')
-    
-    for line in lines:
-        line = line.strip()
+    total = len(lines)
+    index = 0
+    in_code = False
+
+    while index < total:
+        raw = lines[index].rstrip('\r')
+        index += 1
+
+        # 代码块：原样输出，不解析 Markdown
+        if _FENCE_RE.match(raw):
+            in_code = not in_code
+            lists.reset()
+            continue
+        if in_code:
+            yield _paragraph(_run(raw.expandtabs(4)), ids['code'])
+            continue
+
+        line = raw.strip()
         if not line:
             continue
-            
-        # 1. 标题处理
-        if line.startswith('# '):
-            # 一级标题
-            h1 = document.add_heading(line.replace('# ', '').strip(), level=1)
-            run = h1.runs[0]
-            run.font.name = u'微软雅黑'
-            run._element.rPr.rFonts.set(qn('w:eastAsia'), u'微软雅黑')
-            run.font.color.rgb = RGBColor(216, 30, 6) # 红色
-        elif line.startswith('## '):
-            # 二级标题
-            h2 = document.add_heading(line.replace('## ', '').strip(), level=2)
-            run = h2.runs[0]
-            run.font.name = u'微软雅黑'
-            run._element.rPr.rFonts.set(qn('w:eastAsia'), u'微软雅黑')
-            run.font.color.rgb = RGBColor(0, 0, 0)
-        elif line.startswith('### '):
-            # 三级标题
-            h3 = document.add_heading(line.replace('### ', '').strip(), level=3)
-            run = h3.runs[0]
-            run.font.name = u'微软雅黑'
-            run._element.rPr.rFonts.set(qn('w:eastAsia'), u'微软雅黑')
-            
-        # 2. 引用块处理
-        elif line.startswith('> '):
-            p = document.add_paragraph()
-            run = p.add_run(line.replace('> ', '').strip())
-            run.font.italic = True
-            run.font.color.rgb = RGBColor(100, 100, 100)
-            p.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
-            
-        # 3. 列表项处理
-        elif line.startswith('* ') or line.startswith('- '):
-            content = line[2:].strip()
-            p = document.add_paragraph(style='List Bullet')
-            _add_formatted_run(p, content)
-            
-        # 4. 数字列表
-        elif re.match(r'^\d+\.\s', line):
-            content = re.sub(r'^\d+\.\s', '', line).strip()
-            p = document.add_paragraph(style='List Number')
-            _add_formatted_run(p, content)
-            
-        # 5. 普通段落
-        else:
-            p = document.add_paragraph()
-            _add_formatted_run(p, line)
-            
-    # 保存到内存流
-    file_stream = io.BytesIO()
-    document.save(file_stream)
-    file_stream.seek(0)
-    return file_stream
-
-def _add_formatted_run(paragraph, text):
+
+        # 表格：表头行 + 分隔行 + 数据行
+        if line.startswith('|') and index < total and _TABLE_SEPARATOR_RE.match(lines[index]):
+            rows = [_split_table_row(line)]
+            index += 1
+            while index < total and lines[index].strip().startswith('|'):
+                rows.append(_split_table_row(lines[index]))
+                index += 1
+            lists.reset()
+            yield _table(rows, ids['table'])
+            # 相邻表格之间需要段落分隔，否则 Word 会合并为一个表格
+            yield '<w:p/>'
+            continue
+
+        match = _BULLET_RE.match(raw) if not _RULE_RE.match(line) else None
+        if match:
+            level = lists.level_for(len(match.group(1).expandtabs(4)))
+            lists.bullet(level)
+            yield _paragraph(_inline_runs(match.group(2).strip()), ids['bullets'][level])
+            continue
+
+        match = _ORDERED_RE.match(raw)
+        if match:
+            level = lists.level_for(len(match.group(1).expandtabs(4)))
+            num_id = lists.number(level, int(match.group(2)))
+            yield _paragraph(_inline_runs(match.group(3).strip()), ids['numbers'][level], (num_id, 0) if num_id else None)
+            continue
+
+        lists.reset()
+
+        match = _HEADING_RE.match(line)
+        if match:
+            yield _paragraph(_inline_runs(match.group(2)), ids['headings'][len(match.group(1)) - 1])
+            continue
+
+        if _RULE_RE.match(line):
+            continue
+
+        match = _QUOTE_RE.match(line)
+        if match:
+            yield _paragraph(_inline_runs(match.group(1).strip()), ids['quote'])
+            continue
+
+        yield _paragraph(_inline_runs(line))
+
+
+def write_blueprint_docx(markdown_text: str, fileobj) -> int:
     """
-    处理段落中的粗体 (**text**)
+    将 Markdown 文本转换为 docx 并写入文件对象
+    :param fileobj: 可写（可 seek）的二进制文件对象
+    :return: 写入的字节数
     """
-    # 简单的正则匹配粗体
-    parts = re.split(r'(\*\*.*?\*\*)', text)
-    for part in parts:
-        if part.startswith('**') and part.endswith('**'):
-            run = paragraph.add_run(part[2:-2])
-            run.font.bold = True
-        else:
-            paragraph.add_run(part)
+    template = _get_template()
+    lists = _ListState(template)
+    start = fileobj.tell()
+
+    with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for info, data in template.parts:
+            if info.filename not in (DOCUMENT_PART, NUMBERING_PART):
+                zf.writestr(info, data, compress_type=zipfile.ZIP_DEFLATED)
+
+        with zf.open(DOCUMENT_PART, 'w', force_zip64=True) as part:
+            buffer = [template.document_head]
+            buffered = len(template.document_head)
+            for fragment in _render_blocks(markdown_text or '', template, lists):
+                buffer.append(fragment)
+                buffered += len(fragment)
+                if buffered >= _WRITE_CHUNK_CHARS:
+                    part.write(''.join(buffer).encode('utf-8'))
+                    buffer = []
+                    buffered = 0
+            buffer.append(template.document_tail)
+            part.write(''.join(buffer).encode('utf-8'))
+
+        # 编号定义依赖正文中出现的有序列表段数，正文写完后再写入
+        zf.writestr(NUMBERING_PART, lists.numbering_xml().encode('utf-8'), compress_type=zipfile.ZIP_DEFLATED)
+
+    return fileobj.tell() - start
+
+
+def generate_blueprint_docx(markdown_text: str, spool_max_memory: int = DEFAULT_SPOOL_MAX_MEMORY):
+    """
+    将 Markdown 文本转换为 Word 文档流
+    :param markdown_text: Markdown 格式的分析报告
+    :param spool_max_memory: 输出在内存中保留的最大字节数，超过后转存临时文件
+    :return: 已定位到开头的文件对象（SpooledTemporaryFile，docx 文件流）
+    """
+    stream = tempfile.SpooledTemporaryFile(max_size=spool_max_memory)
+    write_blueprint_docx(markdown_text, stream)
+    stream.seek(0)
+    return stream
@@ -0,0 +1,101 @@
+# 文件名：llm_cache.py
+"""
+功能说明：LLM 补全结果缓存
+核心功能：
+1. 以 (model, messages, temperature) 规范化哈希作为缓存键
+2. 进程内 LRU 存储，按总字符数与 TTL 淘汰
+3. 按接口统计命中率与节省的 token 数（按模型估算，与上下文规划使用同一估算器）
+依赖模块：hashlib, json, threading, token_budget
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from app.utils.token_budget import estimator_for
+
+
+def build_completion_key(model: str, messages: List[Dict[str, str]], temperature: float) -> str:
+    """
+    构建补全缓存键：对消息做规范化序列化后取 SHA-256
+    """
+    payload = json.dumps(
+        {"model": model, "messages": messages, "temperature": round(float(temperature), 4)},
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCompletionCache:
+    """
+    LLM 补全缓存（进程内 LRU）
+    """
+
+    def __init__(self, max_chars: int = 20_000_000, ttl_seconds: int = 24 * 3600):
+        self.max_chars = max_chars
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._total_chars = 0
+        self._lock = threading.Lock()
+        self._endpoint_stats: Dict[str, Dict[str, int]] = {}
+
+    def get(self, key: str, endpoint: str = "default") -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and self.ttl_seconds > 0 and time.time() - entry["created_at"] > self.ttl_seconds:
+                self._remove(key)
+                entry = None
+
+            stats = self._endpoint_stats.setdefault(endpoint, {"hits": 0, "misses": 0, "tokens_saved": 0})
+            if not entry:
+                stats["misses"] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            stats["hits"] += 1
+            stats["tokens_saved"] += entry["prompt_tokens"] + entry["completion_tokens"]
+            return entry["text"]
+
+    def set(self, key: str, text: str, messages: List[Dict[str, str]], model: Optional[str] = None) -> None:
+        """
+        :param model: 生成该结果的模型（用于估算节省的 token 数）
+        """
+        if not text or len(text) > self.max_chars:
+            return
+        estimator = estimator_for(model)
+        prompt_tokens = estimator.count_messages(messages)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                "text": text,
+                "created_at": time.time(),
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": estimator.count(text)
+            }
+            self._total_chars += len(text)
+            while self._total_chars > self.max_chars and self._entries:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._total_chars -= len(entry["text"])
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            endpoints = {}
+            for endpoint, stats in self._endpoint_stats.items():
+                lookups = stats["hits"] + stats["misses"]
+                endpoints[endpoint] = dict(stats, hit_rate=round(stats["hits"] / lookups, 4) if lookups else 0.0)
+            return {
+                "entries": len(self._entries),
+                "total_chars": self._total_chars,
+                "max_chars": self.max_chars,
+                "endpoints": endpoints
+            }
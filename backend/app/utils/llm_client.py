@@ -7,84 +7,291 @@
 import logging
 import queue
 import threading
-from typing import List, Dict, Generator, Any
-from openai import OpenAI
+import time
+from typing import List, Dict, Generator, Any, Optional
+from app.utils.llm_cache import LLMCompletionCache, build_completion_key
+from app.utils.llm_dispatcher import LLMDispatcher, LLMRequest, PRIORITY_NORMAL
+from app.utils.llm_router import LLMEndpoint, LLMRouter
+from app.utils.token_budget import estimator_for
 
 logger = logging.getLogger(__name__)
 
+
+class _ModelHandoff(Exception):
+    """
+    调度分组对应模型的端点均已失败：释放当前调度名额，按其他模型重新排队
+    """
+
+    def __init__(self, model: str):
+        super().__init__(model)
+        self.model = model
+
+
+class LLMUsageStats:
+    """
+    LLM 用量统计：按接口累计 prompt/completion/缓存命中 token 数与首 token 耗时
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, endpoint: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int, ttft: Optional[float]) -> None:
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                "calls": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cached_tokens": 0,
+                "total_ttft_seconds": 0.0,
+                "ttft_samples": 0
+            })
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["cached_tokens"] += cached_tokens
+            if ttft is not None:
+                stats["total_ttft_seconds"] += ttft
+                stats["ttft_samples"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            endpoints = {}
+            totals = {"prompt_tokens": 0, "cached_tokens": 0}
+            for endpoint, stats in self._endpoints.items():
+                item = {k: v for k, v in stats.items() if k not in ("total_ttft_seconds", "ttft_samples")}
+                item["prefix_cache_hit_ratio"] = round(stats["cached_tokens"] / stats["prompt_tokens"], 4) if stats["prompt_tokens"] else 0.0
+                item["avg_ttft_seconds"] = round(stats["total_ttft_seconds"] / stats["ttft_samples"], 3) if stats["ttft_samples"] else None
+                endpoints[endpoint] = item
+                totals["prompt_tokens"] += stats["prompt_tokens"]
+                totals["cached_tokens"] += stats["cached_tokens"]
+        totals["prefix_cache_hit_ratio"] = round(totals["cached_tokens"] / totals["prompt_tokens"], 4) if totals["prompt_tokens"] else 0.0
+        return {"total": totals, "endpoints": endpoints}
+
+
+def _read_cached_tokens(usage) -> int:
+    """
+    读取 usage.prompt_tokens_details.cached_tokens（不同服务商可能缺省该字段）
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is None:
+        return 0
+    if isinstance(details, dict):
+        return int(details.get("cached_tokens") or 0)
+    return int(getattr(details, "cached_tokens", 0) or 0)
+
 class LLMClient:
     """
     通用LLM客户端，基于OpenAI SDK
     """
     
-    def __init__(self, api_key: str, base_url: str, model: str):
+    def __init__(self, api_key: str = None, base_url: str = None, model: str = None, cache: Optional[LLMCompletionCache] = None, replay_chunk_chars: int = 16, replay_interval: float = 0.02, stream_usage: bool = True, dispatcher: Optional[LLMDispatcher] = None, router: Optional[LLMRouter] = None):
         """
         初始化 LLM 客户端
-        :param api_key: API Key
-        :param base_url: API Base URL
-        :param model: 模型名称
+        :param api_key: API Key（未传入 router 时使用）
+        :param base_url: API Base URL（未传入 router 时使用）
+        :param model: 模型名称（未传入 router 时使用）
+        :param cache: 补全缓存（为 None 时不启用）
+        :param replay_chunk_chars: 缓存命中时每个回放块的字符数
+        :param replay_interval: 缓存命中时回放块之间的间隔秒数
+        :param stream_usage: 是否在流式响应中请求用量信息（stream_options.include_usage）
+        :param dispatcher: 进程级调度器（限制并发流数并公平排队；为 None 时使用默认配置新建）
+        :param router: 多端点路由（为 None 时以 api_key/base_url/model 构建单端点路由）
         """
-        if not api_key or not base_url:
-            raise ValueError("api_key and base_url are required")
-            
-        self.client = OpenAI(
-            api_key=api_key,
-            base_url=base_url,
-            timeout=600.0,  # 显式设置超时时间，匹配 Nginx 和 Waitress 配置
-            max_retries=3   # 增加自动重试机制
-        )
-        self.model = model
+        self.router = router or LLMRouter([LLMEndpoint(base_url, api_key, model)])
+        # 逻辑模型名：取首个端点的模型（用于合并请求等与具体端点无关的场景）；
+        # 缓存键与调度分组按每次请求路由到的端点模型确定
+        self.model = self.router.endpoints[0].model
+        self.cache = cache
+        self.replay_chunk_chars = max(1, replay_chunk_chars)
+        self.replay_interval = replay_interval
+        self.stream_usage = stream_usage
+        self.usage_stats = LLMUsageStats()
+        self.dispatcher = dispatcher or LLMDispatcher()
 
-    def chat_stream(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> Generator[str, None, None]:
+    def _replay(self, text: str) -> Generator[str, None, None]:
+        """
+        以流式节奏回放缓存内容，保证前端渲染体验与实时生成一致
+        """
+        for i in range(0, len(text), self.replay_chunk_chars):
+            yield text[i:i + self.replay_chunk_chars]
+            if self.replay_interval > 0:
+                time.sleep(self.replay_interval)
+
+    def chat_stream(self, messages: List[Dict[str, str]], temperature: float = 0.7, endpoint: str = "default", heartbeat: bool = True, user_id: Optional[str] = None, priority: int = PRIORITY_NORMAL) -> Generator[str, None, None]:
         """
         流式对话生成
         :param messages: 对话历史 [{"role": "user", "content": "..."}]
         :param temperature: 温度参数
+        :param endpoint: 调用方接口名称（用于分接口统计缓存命中率）
+        :param heartbeat: 等待模型输出期间是否产出空行保活
+        :param user_id: 用户标识（调度器按用户公平排队）
+        :param priority: 调度优先级（数值越小越优先）
         :return: 生成器，产生流式文本块
         """
         try:
-            logger.info(f"Sending request to LLM model: {self.model}")
+            # 按当前路由到的端点模型查缓存、进入该模型的调度分组
+            preferred = self.router.preferred()
+            model = preferred.model if preferred is not None else self.model
+            if self.cache is not None:
+                cache_key = build_completion_key(model, messages, temperature)
+                cached_text = self.cache.get(cache_key, endpoint)
+                if cached_text is not None:
+                    logger.info(f"LLM cache hit ({endpoint}): {cache_key[:12]}")
+                    yield from self._replay(cached_text)
+                    return
+
+            logger.info(f"Sending request to LLM model: {model} ({len(self.router.endpoints)} endpoints)")
             output_queue: "queue.Queue[object]" = queue.Queue()
             done_sentinel = object()
+            # 实际完成请求的端点（故障切换后可能是其他模型）
+            served: Dict[str, LLMEndpoint] = {}
+            # 本次请求中已失败的端点（跨模型重新排队后继续排除）
+            tried: List[LLMEndpoint] = []
 
-            def run_llm_stream():
+            def run_llm_stream(request: LLMRequest):
                 try:
-                    stream = self.client.chat.completions.create(
-                        model=self.model,
-                        messages=messages,
-                        stream=True,
-                        temperature=temperature
-                    )
-
-                    for chunk in stream:
-                        if chunk.choices and chunk.choices[0].delta.content:
-                            output_queue.put(chunk.choices[0].delta.content)
+                    served["endpoint"] = self._stream_with_failover(request, messages, temperature, endpoint, output_queue, tried)
                     output_queue.put(done_sentinel)
+                except _ModelHandoff as handoff:
+                    output_queue.put(handoff)
                 except Exception as e:
                     output_queue.put(e)
 
-            t = threading.Thread(target=run_llm_stream, daemon=True)
-            t.start()
+            completion_parts = []
+            completed = False
+            request = None
 
-            while True:
-                try:
-                    item = output_queue.get(timeout=2.0)
-                except queue.Empty:
-                    if not t.is_alive():
+            try:
+                while True:
+                    # 交由进程级调度器执行（排队期间同样按间隔产出心跳）
+                    request = self.dispatcher.submit(model, run_llm_stream, user_id, priority)
+                    handoff = yield from self._drain(output_queue, done_sentinel, request, heartbeat, completion_parts if self.cache is not None else None)
+                    if handoff is None:
                         break
-                    yield "\n\n"
-                    continue
-
-                if item is done_sentinel:
-                    break
+                    # 故障切换到其他模型：原模型的名额已随任务结束释放，在新模型的调度分组中重新排队
+                    logger.warning(f"LLM model {model} has no healthy endpoint, requeueing on model {handoff}")
+                    model = handoff
+                completed = True
+            finally:
+                if request is not None and not request.done:
+                    self.dispatcher.cancel(request)
 
-                if isinstance(item, Exception):
-                    raise item
+            # 仅缓存完整结束的输出，缓存键取实际生成该输出的模型
+            if self.cache is not None and completed and served.get("endpoint") is not None:
+                served_model = served["endpoint"].model
+                self.cache.set(build_completion_key(served_model, messages, temperature), "".join(completion_parts), messages, model=served_model)
 
-                if isinstance(item, str) and item:
-                    yield item
-                    
         except Exception as e:
             logger.error(f"LLM request failed: {str(e)}")
             # 这里抛出异常，让上层处理（比如返回给前端错误信息）
             raise e
+
+    def _stream_with_failover(self, request: LLMRequest, messages: List[Dict[str, str]], temperature: float, endpoint: str, output_queue: "queue.Queue[object]", tried: List[LLMEndpoint]) -> Optional[LLMEndpoint]:
+        """
+        选择端点并执行流式请求；首个 token 之前失败时切换到其他端点重试，之后失败直接抛出
+        只在调度分组对应模型的端点间切换（占用的是该模型的并发名额）
+        :param tried: 本次请求中已失败的端点（就地追加）
+        :return: 完成请求的端点（调用方中途放弃时为 None）
+        :raises _ModelHandoff: 该模型的端点均不可用而其他模型仍有可用端点
+        """
+        last_error: Optional[Exception] = None
+        while True:
+            target = self.router.acquire(exclude=tried, model=request.model, strict=True)
+            if target is None:
+                fallback = self.router.preferred(exclude=tried)
+                if fallback is not None and fallback.model != request.model:
+                    raise _ModelHandoff(fallback.model)
+                raise last_error or RuntimeError("no LLM endpoint available")
+            tried.append(target)
+
+            request_kwargs = {}
+            if self.stream_usage:
+                # 请求在最后一个分块中返回用量（含前缀缓存命中的 cached_tokens）
+                request_kwargs["stream_options"] = {"include_usage": True}
+            started_at = time.perf_counter()
+            ttft = None
+            usage = None
+            completion_chars = []
+            try:
+                stream = target.client.chat.completions.create(
+                    model=target.model,
+                    messages=messages,
+                    stream=True,
+                    temperature=temperature,
+                    **request_kwargs
+                )
+
+                for chunk in stream:
+                    if request.cancelled:
+                        # 调用方已断开：关闭上游连接，尽快释放并发名额
+                        close = getattr(stream, "close", None)
+                        if close:
+                            close()
+                        self.router.release_cancelled(target)
+                        return None
+                    if getattr(chunk, "usage", None):
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        content = chunk.choices[0].delta.content
+                        if ttft is None:
+                            ttft = time.perf_counter() - started_at
+                        if usage is None:
+                            completion_chars.append(content)
+                        output_queue.put(content)
+            except Exception as e:
+                self.router.release_failure(target, e)
+                if ttft is not None:
+                    # 已向调用方输出部分内容，无法透明切换
+                    raise
+                logger.warning(f"LLM endpoint {target.name} failed before first token, failing over: {str(e)}")
+                last_error = e
+                continue
+
+            completion_tokens = (usage.completion_tokens or 0) if usage is not None else estimator_for(target.model).count("".join(completion_chars))
+            generation_seconds = time.perf_counter() - started_at - (ttft or 0.0)
+            self.router.release_success(target, ttft, completion_tokens, generation_seconds)
+
+            if usage is not None:
+                cached_tokens = _read_cached_tokens(usage)
+                self.usage_stats.record(endpoint, usage.prompt_tokens or 0, usage.completion_tokens or 0, cached_tokens, ttft)
+                logger.info(f"LLM usage ({endpoint} via {target.name}): prompt={usage.prompt_tokens}, cached={cached_tokens}, completion={usage.completion_tokens}, ttft={ttft}")
+            else:
+                self.usage_stats.record(endpoint, 0, 0, 0, ttft)
+            return target
+
+    def _drain(self, output_queue: "queue.Queue[object]", done_sentinel: object, request: LLMRequest, heartbeat: bool, completion_parts: Optional[list]) -> Generator[str, None, Optional[str]]:
+        """
+        从输出队列读取模型输出，直到收到结束标记
+        :param completion_parts: 非 None 时同时收集输出（用于写入缓存）
+        :return: 需要换到其他模型重新排队时返回该模型，否则为 None
+        """
+        while True:
+            try:
+                item = output_queue.get(timeout=2.0)
+            except queue.Empty:
+                if request.done and output_queue.empty():
+                    raise RuntimeError("LLM stream ended unexpectedly")
+                if heartbeat:
+                    yield "\n\n"
+                continue
+
+            if item is done_sentinel:
+                return None
+
+            if isinstance(item, _ModelHandoff):
+                return item.model
+
+            if isinstance(item, Exception):
+                raise item
+
+            if isinstance(item, str) and item:
+                if completion_parts is not None:
+                    completion_parts.append(item)
+                yield item
+
+    def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7, endpoint: str = "default", user_id: Optional[str] = None, priority: int = PRIORITY_NORMAL) -> str:
+        """
+        非流式对话：收集完整输出后返回（用于后台的中间步骤，如长文档章节摘要）
+        """
+        return "".join(self.chat_stream(messages, temperature=temperature, endpoint=endpoint, heartbeat=False, user_id=user_id, priority=priority))
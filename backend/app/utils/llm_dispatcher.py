@@ -0,0 +1,198 @@
+# 文件名：llm_dispatcher.py
+"""
+功能说明：进程级 LLM 请求调度器
+核心功能：
+1. 按模型限制同时进行的上游流式请求数（固定数量的常驻工作线程，不再为每次调用新建线程）
+2. 同一优先级内按用户轮转，避免单个用户的批量请求占满通道
+3. 支持优先级（如思维导图等短任务优先于完整诊断），等待过久的请求逐步提升优先级，避免饿死
+4. 统计排队等待时间
+说明：仅使用 threading 原语；gevent 部署（wsgi.py 中 monkey.patch_all）下自动变为协程调度
+依赖模块：threading, collections
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class LLMRequest:
+    """
+    提交到调度器的单个 LLM 请求
+    """
+
+    def __init__(self, model: str, fn: Callable[["LLMRequest"], None], user_key: str, priority: int):
+        self.model = model
+        self.fn = fn
+        self.user_key = user_key
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        # 调用方已放弃（客户端断开），执行函数应尽快结束上游流
+        self.cancelled = False
+        self._done = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def queue_wait(self) -> float:
+        end = self.started_at if self.started_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+
+class LLMDispatcher:
+    """
+    按模型限流、按用户公平排队的 LLM 调度器
+    """
+
+    def __init__(self, max_in_flight: int = 8, model_limits: Optional[Dict[str, int]] = None, aging_seconds: float = 30.0):
+        """
+        :param max_in_flight: 每个模型默认的最大并发流数
+        :param model_limits: 按模型覆盖的并发上限 {"model": n}
+        :param aging_seconds: 每等待该秒数，请求的优先级提升一级
+        """
+        self.max_in_flight = max(1, max_in_flight)
+        self.model_limits = {k: max(1, v) for k, v in (model_limits or {}).items()}
+        self.aging_seconds = max(0.001, aging_seconds)
+        self._cond = threading.Condition()
+        # model -> priority -> user_key -> deque[LLMRequest]
+        self._pending: Dict[str, Dict[int, "OrderedDict[str, deque]"]] = {}
+        self._workers: Dict[str, list] = {}
+        self._running: Dict[str, int] = {}
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0}
+        self._wait_stats: Dict[int, Dict[str, float]] = {}
+
+    def limit_for(self, model: str) -> int:
+        return self.model_limits.get(model, self.max_in_flight)
+
+    def submit(self, model: str, fn: Callable[[LLMRequest], None], user_key: Optional[str] = None, priority: int = PRIORITY_NORMAL) -> LLMRequest:
+        """
+        提交请求；fn(request) 在工作线程中执行，负责调用上游并输出结果
+        """
+        request = LLMRequest(model, fn, user_key or "anonymous", priority)
+        with self._cond:
+            levels = self._pending.setdefault(model, {})
+            users = levels.setdefault(priority, OrderedDict())
+            users.setdefault(request.user_key, deque()).append(request)
+            self._stats["submitted"] += 1
+            self._ensure_workers(model)
+            self._cond.notify_all()
+        return request
+
+    def cancel(self, request: LLMRequest) -> bool:
+        """
+        撤销请求：仍在排队时直接移除；已在执行时标记取消，由执行函数提前结束
+        :return: 是否在排队阶段被移除
+        """
+        with self._cond:
+            request.cancelled = True
+            users = self._pending.get(request.model, {}).get(request.priority, {})
+            queue = users.get(request.user_key)
+            if queue is None or request not in queue:
+                return False
+            queue.remove(request)
+            if not queue:
+                del users[request.user_key]
+            self._stats["cancelled"] += 1
+        request._done.set()
+        return True
+
+    def _ensure_workers(self, model: str) -> None:
+        workers = self._workers.setdefault(model, [])
+        while len(workers) < self.limit_for(model):
+            t = threading.Thread(target=self._worker_loop, args=(model,), name=f"llm-{model}-{len(workers)}", daemon=True)
+            workers.append(t)
+            t.start()
+
+    def _pick_next(self, model: str) -> Optional[LLMRequest]:
+        """
+        选取下一个请求（需持有锁）：按 (优先级 - 等待时长折算的提升) 选择级别，级别内按用户轮转
+        """
+        levels = self._pending.get(model)
+        if not levels:
+            return None
+        now = time.monotonic()
+        best_priority = None
+        best_score = None
+        for priority, users in levels.items():
+            if not users:
+                continue
+            oldest = min(queue[0].enqueued_at for queue in users.values())
+            score = priority - (now - oldest) / self.aging_seconds
+            if best_score is None or score < best_score:
+                best_priority, best_score = priority, score
+        if best_priority is None:
+            return None
+
+        users = levels[best_priority]
+        user_key, queue = next(iter(users.items()))
+        request = queue.popleft()
+        if queue:
+            users.move_to_end(user_key)
+        else:
+            del users[user_key]
+        return request
+
+    def _worker_loop(self, model: str) -> None:
+        while True:
+            with self._cond:
+                request = self._pick_next(model)
+                while request is None:
+                    self._cond.wait()
+                    request = self._pick_next(model)
+                self._running[model] = self._running.get(model, 0) + 1
+                request.started_at = time.monotonic()
+                self._record_wait(request)
+
+            failed = False
+            try:
+                request.fn(request)
+            except BaseException as e:
+                failed = True
+                logger.error(f"LLM dispatcher task failed: {str(e)}")
+            finally:
+                with self._cond:
+                    self._running[model] -= 1
+                    self._stats["failed" if failed else "completed"] += 1
+                request._done.set()
+
+    def _record_wait(self, request: LLMRequest) -> None:
+        waited = request.queue_wait
+        stats = self._wait_stats.setdefault(request.priority, {"count": 0, "total": 0.0, "max": 0.0, "ewma": 0.0})
+        stats["count"] += 1
+        stats["total"] += waited
+        stats["max"] = max(stats["max"], waited)
+        stats["ewma"] = waited if stats["count"] == 1 else 0.8 * stats["ewma"] + 0.2 * waited
+        if waited >= 1.0:
+            logger.info(f"LLM request waited {waited:.2f}s in queue (model={request.model}, priority={request.priority}, user={request.user_key})")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["models"] = {
+                model: {
+                    "limit": self.limit_for(model),
+                    "running": self._running.get(model, 0),
+                    "queued": sum(len(q) for users in levels.values() for q in users.values()),
+                    "queued_users": len({u for users in levels.values() for u in users})
+                }
+                for model, levels in self._pending.items()
+            }
+            stats["queue_wait"] = {
+                str(priority): {
+                    "count": int(s["count"]),
+                    "avg_seconds": round(s["total"] / s["count"], 3) if s["count"] else 0.0,
+                    "recent_seconds": round(s["ewma"], 3),
+                    "max_seconds": round(s["max"], 3)
+                }
+                for priority, s in sorted(self._wait_stats.items())
+            }
+        return stats
@@ -0,0 +1,219 @@
+# 文件名：llm_router.py
+"""
+功能说明：多端点 LLM 路由
+核心功能：
+1. 维护一组 OpenAI 兼容端点（base_url / api_key / model / 权重）
+2. 按首 token 耗时（TTFT）与生成速度（tokens/s）的指数滑动平均及当前并发数选择端点
+3. 熔断：连续失败达到阈值的端点在冷却期内移出轮转，冷却结束后放行一个探测请求
+4. 记录路由决策与各端点延迟，供运行时统计接口查看
+依赖模块：openai, threading
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional
+
+from openai import OpenAI
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+# 评分时估算的一次典型输出长度（token），用于把生成速度折算为耗时
+_TYPICAL_COMPLETION_TOKENS = 1000
+
+
+class LLMEndpoint:
+    """
+    单个 LLM 端点及其健康状态
+    """
+
+    def __init__(self, base_url: str, api_key: str, model: str, weight: float = 1.0, name: Optional[str] = None, max_retries: int = 3):
+        if not api_key or not base_url:
+            raise ValueError("api_key and base_url are required")
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.weight = weight if weight > 0 else 1.0
+        self.name = name or f"{model}@{base_url}"
+        self.client = OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=600.0,  # 显式设置超时时间，匹配 Nginx 和 Waitress 配置
+            max_retries=max_retries
+        )
+        # 健康状态（由 LLMRouter 在锁内更新）
+        self.ewma_ttft: Optional[float] = None
+        self.ewma_tps: Optional[float] = None
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.circuit = CIRCUIT_CLOSED
+        self.open_until = 0.0
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+
+class LLMRouter:
+    """
+    延迟感知的端点选择与熔断
+    """
+
+    def __init__(self, endpoints: Iterable[LLMEndpoint], failure_threshold: int = 3, cooldown_seconds: float = 30.0, ewma_alpha: float = 0.3, decision_log_size: int = 100):
+        self.endpoints: List[LLMEndpoint] = list(endpoints)
+        if not self.endpoints:
+            raise ValueError("at least one LLM endpoint is required")
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown_seconds = cooldown_seconds
+        self.ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+        self._decisions: deque = deque(maxlen=decision_log_size)
+
+    def _score(self, endpoint: LLMEndpoint) -> float:
+        """
+        预计耗时评分（越小越优）：(TTFT + 典型输出长度 / 生成速度) × (1 + 当前并发) / 权重
+        尚无样本的端点评分为 0，优先获得流量以建立基线
+        """
+        if endpoint.ewma_ttft is None:
+            return 0.0
+        generation = _TYPICAL_COMPLETION_TOKENS / endpoint.ewma_tps if endpoint.ewma_tps else 0.0
+        return (endpoint.ewma_ttft + generation) * (1 + endpoint.in_flight) / endpoint.weight
+
+    @staticmethod
+    def _is_available(endpoint: LLMEndpoint, now: float) -> bool:
+        if endpoint.circuit == CIRCUIT_CLOSED:
+            return True
+        if endpoint.circuit == CIRCUIT_OPEN:
+            return now >= endpoint.open_until
+        # 半开状态下已有探测请求在执行时不再放行
+        return endpoint.in_flight == 0
+
+    def _available(self, endpoint: LLMEndpoint, now: float) -> bool:
+        if not self._is_available(endpoint, now):
+            return False
+        if endpoint.circuit == CIRCUIT_OPEN:
+            # 冷却结束：放行一个探测请求
+            endpoint.circuit = CIRCUIT_HALF_OPEN
+        return True
+
+    def _candidates(self, excluded: set, now: float, model: Optional[str], probe: bool, strict: bool = False) -> tuple:
+        """
+        可选端点及选择原因（调用方持有锁）
+        :param probe: 是否允许把冷却结束的端点切换为半开（仅实际占用端点时）
+        :param strict: 只返回 model 对应的端点，该模型无可用端点时返回空
+        """
+        available = self._available if probe else self._is_available
+        candidates = [e for e in self.endpoints if id(e) not in excluded and available(e, now)]
+        if not candidates:
+            # 全部熔断时仍尝试最早恢复的端点，避免整体不可用
+            fallback = [e for e in self.endpoints if id(e) not in excluded]
+            if not fallback:
+                return [], None
+            earliest = min(fallback, key=lambda e: e.open_until)
+            if strict and model is not None and earliest.model != model:
+                return [], None
+            return [earliest], "all_circuits_open"
+        if model is not None:
+            # 优先选择指定模型的端点（调度分组 / 缓存键已按该模型确定），该模型无可用端点时再选其他模型
+            same_model = [e for e in candidates if e.model == model]
+            if same_model:
+                candidates = same_model
+            elif strict:
+                return [], None
+        return candidates, ("failover" if excluded else "best_score")
+
+    def preferred(self, exclude: Iterable[LLMEndpoint] = ()) -> Optional[LLMEndpoint]:
+        """
+        当前评分最优的端点（只读，不占用并发计数），用于在排队前确定调度分组与缓存键的模型
+        :param exclude: 本次请求中已失败的端点（跨模型故障切换时确定重新排队的模型）
+        """
+        excluded = set(id(e) for e in exclude)
+        now = time.monotonic()
+        with self._lock:
+            candidates, _ = self._candidates(excluded, now, None, probe=False)
+            return min(candidates, key=self._score) if candidates else None
+
+    def acquire(self, exclude: Iterable[LLMEndpoint] = (), model: Optional[str] = None, strict: bool = False) -> Optional[LLMEndpoint]:
+        """
+        选择端点并占用一个并发计数；无可用端点时返回 None
+        :param exclude: 本次请求中已失败的端点
+        :param model: 优先选择该模型的端点
+        :param strict: 只选择 model 对应的端点（请求已占用该模型的调度名额）
+        """
+        excluded = set(id(e) for e in exclude)
+        now = time.monotonic()
+        with self._lock:
+            candidates, reason = self._candidates(excluded, now, model, probe=True, strict=strict)
+            if not candidates:
+                return None
+            scores = {e.name: round(self._score(e), 3) for e in candidates}
+            chosen = min(candidates, key=self._score)
+            chosen.in_flight += 1
+            chosen.requests += 1
+            self._decisions.append({
+                "at": time.time(),
+                "chosen": chosen.name,
+                "reason": reason,
+                "scores": scores
+            })
+        return chosen
+
+    def release_success(self, endpoint: LLMEndpoint, ttft: Optional[float], completion_tokens: int, generation_seconds: float) -> None:
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.successes += 1
+            endpoint.consecutive_failures = 0
+            if endpoint.circuit != CIRCUIT_CLOSED:
+                logger.info(f"LLM endpoint {endpoint.name} recovered, circuit closed")
+            endpoint.circuit = CIRCUIT_CLOSED
+            a = self.ewma_alpha
+            if ttft is not None:
+                endpoint.ewma_ttft = ttft if endpoint.ewma_ttft is None else (1 - a) * endpoint.ewma_ttft + a * ttft
+            if completion_tokens > 0 and generation_seconds > 0:
+                tps = completion_tokens / generation_seconds
+                endpoint.ewma_tps = tps if endpoint.ewma_tps is None else (1 - a) * endpoint.ewma_tps + a * tps
+
+    def release_failure(self, endpoint: LLMEndpoint, error: BaseException) -> None:
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            endpoint.last_error = str(error)[:300]
+            if endpoint.circuit == CIRCUIT_HALF_OPEN or endpoint.consecutive_failures >= self.failure_threshold:
+                endpoint.circuit = CIRCUIT_OPEN
+                endpoint.open_until = time.monotonic() + self.cooldown_seconds
+                logger.warning(f"LLM endpoint {endpoint.name} circuit opened for {self.cooldown_seconds}s: {endpoint.last_error}")
+
+    def release_cancelled(self, endpoint: LLMEndpoint) -> None:
+        """
+        调用方中途放弃：只释放并发计数，不影响健康状态
+        """
+        with self._lock:
+            endpoint.in_flight -= 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            endpoints = []
+            for e in self.endpoints:
+                endpoints.append({
+                    "name": e.name,
+                    "model": e.model,
+                    "weight": e.weight,
+                    "circuit": e.circuit,
+                    "cooldown_remaining_seconds": round(max(0.0, e.open_until - now), 1) if e.circuit == CIRCUIT_OPEN else 0.0,
+                    "in_flight": e.in_flight,
+                    "requests": e.requests,
+                    "successes": e.successes,
+                    "failures": e.failures,
+                    "consecutive_failures": e.consecutive_failures,
+                    "ewma_ttft_seconds": round(e.ewma_ttft, 3) if e.ewma_ttft is not None else None,
+                    "ewma_tokens_per_second": round(e.ewma_tps, 1) if e.ewma_tps is not None else None,
+                    "score": round(self._score(e), 3),
+                    "last_error": e.last_error
+                })
+            return {"endpoints": endpoints, "recent_decisions": list(self._decisions)[-20:]}
@@ -0,0 +1,268 @@
+# 文件名：ocr_cache.py
+"""
+功能说明：OCR 识别结果缓存
+核心功能：
+1. 以 文件内容 SHA-256 + OCR 参数 作为内容寻址的缓存键
+2. 支持本地磁盘存储（按容量 LRU 淘汰 + TTL 过期）与 MongoDB 集合存储
+3. 统计命中/未命中/节省字节数
+依赖模块：hashlib, json, os, threading, extensions
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file_content(file_content: bytes) -> str:
+    """
+    计算文件内容的 SHA-256 摘要
+    :param file_content: 文件二进制内容
+    :return: 十六进制摘要
+    """
+    return hashlib.sha256(file_content or b"").hexdigest()
+
+
+def build_cache_key(file_digest: str, options: Optional[Dict[str, Any]] = None) -> str:
+    """
+    构建缓存键：文件摘要 + 规范化后的 OCR 参数
+    :param file_digest: 文件内容 SHA-256 摘要
+    :param options: OCR 参数
+    :return: 缓存键 (SHA-256 十六进制)
+    """
+    normalized_options = {str(k): str(v) for k, v in (options or {}).items()}
+    payload = file_digest + "|" + json.dumps(normalized_options, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskOCRCacheStore:
+    """
+    本地磁盘缓存存储
+    - mtime 记录写入时间（用于 TTL）
+    - atime 记录最后访问时间（用于 LRU 淘汰）
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, ttl_seconds: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.md")
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        now = time.time()
+        if self.ttl_seconds > 0 and now - st.st_mtime > self.ttl_seconds:
+            self._remove(path)
+            return None
+
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            # 仅刷新访问时间，保留写入时间用于 TTL 判断
+            os.utime(path, (now, st.st_mtime))
+            return text
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, text: str) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        """
+        清理过期条目，并在总容量超过上限时按最后访问时间淘汰
+        """
+        with self._lock:
+            now = time.time()
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".md"):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if self.ttl_seconds > 0 and now - st.st_mtime > self.ttl_seconds:
+                    self._remove(path)
+                    continue
+                entries.append((st.st_atime, st.st_size, path))
+                total += st.st_size
+
+            if self.max_bytes <= 0 or total <= self.max_bytes:
+                return
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+
+
+class MongoOCRCacheStore:
+    """
+    MongoDB 缓存存储 (集合：ocr_cache)
+    - created_at 上建立 TTL 索引
+    - 总容量超过上限时按 last_access 淘汰
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: int, collection_name: str = "ocr_cache"):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.collection_name = collection_name
+        self._index_ready = False
+
+    def _collection(self):
+        # 延迟导入：Service 在应用工厂初始化 mongo 之前实例化
+        from app.extensions import mongo
+
+        collection = mongo.db[self.collection_name]
+        if not self._index_ready:
+            if self.ttl_seconds > 0:
+                collection.create_index("created_at", expireAfterSeconds=self.ttl_seconds)
+            collection.create_index("last_access")
+            self._index_ready = True
+        return collection
+
+    def get(self, key: str) -> Optional[str]:
+        collection = self._collection()
+        doc = collection.find_one_and_update(
+            {"_id": key},
+            {"$set": {"last_access": datetime.utcnow()}},
+            projection={"text": 1, "created_at": 1}
+        )
+        if not doc:
+            return None
+        # TTL 索引由后台线程清理，存在延迟，这里再做一次判断
+        created_at = doc.get("created_at")
+        if self.ttl_seconds > 0 and created_at and datetime.utcnow() - created_at > timedelta(seconds=self.ttl_seconds):
+            return None
+        return doc.get("text")
+
+    def set(self, key: str, text: str) -> None:
+        collection = self._collection()
+        now = datetime.utcnow()
+        collection.replace_one(
+            {"_id": key},
+            {
+                "_id": key,
+                "text": text,
+                "size": len(text.encode("utf-8")),
+                "created_at": now,
+                "last_access": now
+            },
+            upsert=True
+        )
+        self._evict(collection)
+
+    def _evict(self, collection) -> None:
+        if self.max_bytes <= 0:
+            return
+        stats = list(collection.aggregate([{"$group": {"_id": None, "total": {"$sum": "$size"}}}]))
+        total = stats[0]["total"] if stats else 0
+        if total <= self.max_bytes:
+            return
+        for doc in collection.find({}, {"size": 1}).sort("last_access", 1):
+            if total <= self.max_bytes:
+                break
+            collection.delete_one({"_id": doc["_id"]})
+            total -= doc.get("size", 0)
+
+
+class OCRCache:
+    """
+    OCR 结果缓存（对外门面）
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "bytes_saved": 0, "errors": 0}
+
+    @classmethod
+    def from_config(cls, config) -> "OCRCache":
+        backend = (getattr(config, "OCR_CACHE_BACKEND", "disk") or "none").lower()
+        max_bytes = getattr(config, "OCR_CACHE_MAX_BYTES", 0)
+        ttl_seconds = getattr(config, "OCR_CACHE_TTL_SECONDS", 0)
+        store = None
+        try:
+            if backend == "disk":
+                store = DiskOCRCacheStore(config.OCR_CACHE_DIR, max_bytes, ttl_seconds)
+            elif backend == "mongo":
+                store = MongoOCRCacheStore(max_bytes, ttl_seconds)
+        except Exception as e:
+            logger.error(f"Failed to init OCR cache store ({backend}): {str(e)}")
+            store = None
+        return cls(store)
+
+    @property
+    def enabled(self) -> bool:
+        return self.store is not None
+
+    def get(self, key: str, file_size: int = 0) -> Optional[str]:
+        """
+        读取缓存，命中时累加节省的上传字节数
+        """
+        if not self.enabled:
+            return None
+        try:
+            text = self.store.get(key)
+        except Exception as e:
+            logger.error(f"OCR cache read failed: {str(e)}")
+            self._incr("errors")
+            return None
+
+        if text is None:
+            self._incr("misses")
+            return None
+
+        self._incr("hits")
+        self._incr("bytes_saved", file_size)
+        return text
+
+    def set(self, key: str, text: str) -> None:
+        if not self.enabled or not text:
+            return
+        try:
+            self.store.set(key, text)
+        except Exception as e:
+            logger.error(f"OCR cache write failed: {str(e)}")
+            self._incr("errors")
+
+    def _incr(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += value
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["backend"] = type(self.store).__name__ if self.store else None
+        return stats
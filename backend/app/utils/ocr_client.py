@@ -5,12 +5,28 @@
 依赖模块：requests
 """
 import requests
+import json
 import logging
-from typing import Dict, Any, Optional
+import mmap
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, Optional, Callable, List, Tuple, Union, IO, Iterable
+
+# 请求体类型：bytes / 内存视图 / 文件对象（从磁盘流式上传）/ 字节块迭代器（分块传输）
+OCRBody = Union[bytes, bytearray, memoryview, mmap.mmap, IO[bytes], Iterable[bytes]]
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
+# PDF 页树节点的 /Count（键顺序不固定；[^>] 限定在同一字典内匹配）
+_PDF_PAGES_COUNT_PATTERN = re.compile(
+    rb"/Type\s*/Pages(?![a-zA-Z])[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages(?![a-zA-Z])"
+)
+
 class OCRClient:
     """
     TextIn OCR API 客户端
@@ -19,22 +35,47 @@ class OCRClient:
     # API 地址
     API_URL = "https://api.textin.com/ai/service/v1/pdf_to_markdown"
     
-    def __init__(self, app_id: str, secret_code: str):
+    # 连接超时 / 读取超时 (秒)
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 300 # 增加超时时间到 300秒 (5分钟)
+
+    def __init__(self, app_id: str, secret_code: str, api_url: Optional[str] = None, pool_size: int = 8, pool_block: bool = True, rate_limiter=None, max_in_flight: int = 0):
         """
         初始化 OCR 客户端
         :param app_id: x-ti-app-id
         :param secret_code: x-ti-secret-code
+        :param api_url: API 地址（默认 TextIn 官方地址，测试时可指向本地替身服务）
+        :param pool_size: 每个主机的最大连接数（建议与 waitress threads / gunicorn 并发数一致）
+        :param pool_block: 连接池耗尽时是否阻塞等待，而不是额外新建连接
+        :param rate_limiter: 限流器（需提供 acquire()），每次 HTTP 调用前获取令牌
+        :param max_in_flight: 同时进行的 HTTP 调用上限（整体识别与各分片共用，0 表示不限制）；
+                              分片模式下每个 OCR 任务会并发多个分片请求，由此保证进程内发往 TextIn 的请求总数有界
         """
         if not app_id or not secret_code:
             raise ValueError("app_id and secret_code are required")
             
         self.app_id = app_id
         self.secret_code = secret_code
+        self.api_url = api_url or self.API_URL
+        self.rate_limiter = rate_limiter
+        self.max_in_flight = max(0, max_in_flight)
+        self._in_flight_slots = threading.BoundedSemaphore(self.max_in_flight) if self.max_in_flight else None
+
+        # 复用连接池（keep-alive），避免每次识别重新建立 TCP+TLS 连接
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size), pool_block=pool_block)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._adapter = adapter
 
-    def recognize(self, file_content: bytes, options: Optional[Dict[str, Any]] = None) -> str:
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "errors": 0, "bytes_sent": 0, "total_seconds": 0.0, "max_seconds": 0.0, "in_flight": 0, "slot_wait_seconds": 0.0}
+        self._recent_calls = deque(maxlen=50)
+
+    def recognize(self, file_content: OCRBody, options: Optional[Dict[str, Any]] = None) -> str:
         """
         调用 OCR API 进行识别
-        :param file_content: 文件二进制内容
+        :param file_content: 文件内容；支持 bytes、文件对象（流式上传，不做额外内存拷贝）或字节块迭代器
         :param options: 可选参数 (e.g., {'pdf_pwd': 'password', 'page_start': 0, ...})
         :return: 识别结果文本 (Markdown格式)
         """
@@ -53,19 +94,52 @@ class OCRClient:
             "Content-Type": "application/octet-stream"
         }
 
+        # 文件对象发送后读取位置位于末尾，需在发送前计算请求体大小
+        body_size = self._body_size(file_content)
+        self._acquire_slot()
+        try:
+            if self.rate_limiter is not None:
+                # 按 TextIn 配额限流（分片模式下每个分片各占一个令牌）
+                self.rate_limiter.acquire()
+            return self._post(file_content, params, headers, body_size)
+        finally:
+            self._release_slot()
+
+    def _acquire_slot(self) -> None:
+        """
+        占用一个 HTTP 调用名额（先于限流令牌获取，排队等待名额时不消耗令牌）
+        """
+        waited = 0.0
+        if self._in_flight_slots is not None:
+            wait_started = time.perf_counter()
+            self._in_flight_slots.acquire()
+            waited = time.perf_counter() - wait_started
+        with self._stats_lock:
+            self._stats["in_flight"] += 1
+            self._stats["slot_wait_seconds"] += waited
+
+    def _release_slot(self) -> None:
+        with self._stats_lock:
+            self._stats["in_flight"] -= 1
+        if self._in_flight_slots is not None:
+            self._in_flight_slots.release()
+
+    def _post(self, file_content: OCRBody, params: Dict[str, str], headers: Dict[str, str], body_size: Optional[int]) -> str:
+        started_at = time.perf_counter()
         try:
-            logger.info(f"Sending OCR request to {self.API_URL}")
+            logger.info(f"Sending OCR request to {self.api_url}")
             # 发送请求
-            response = requests.post(
-                self.API_URL,
+            response = self.session.post(
+                self.api_url,
                 params=params,
                 headers=headers,
                 data=file_content,
-                timeout=300 # 增加超时时间到 300秒 (5分钟)
+                timeout=(self.CONNECT_TIMEOUT, self.READ_TIMEOUT)
             )
 
             # 检查响应状态
             response.raise_for_status()
+            self._record_call(started_at, response, body_size)
             
             # 解析响应内容，确保返回的是预期的格式
             # 注意：API可能返回JSON，其中包含result字段，或者直接返回文本，视API具体定义而定。
@@ -88,4 +162,242 @@ class OCRClient:
 
         except requests.exceptions.RequestException as e:
             logger.error(f"OCR request failed: {str(e)}")
+            self._record_call(started_at, getattr(e, "response", None), body_size, error=True)
             raise e
+
+    def _record_call(self, started_at: float, response, body_size: Optional[int], error: bool = False) -> None:
+        """
+        记录单次调用耗时：elapsed 为总耗时，ttfb 为发送完成到收到响应头的耗时
+        """
+        elapsed = time.perf_counter() - started_at
+        call = {
+            "elapsed": round(elapsed, 3),
+            "ttfb": round(response.elapsed.total_seconds(), 3) if response is not None else None,
+            "status": response.status_code if response is not None else None,
+            "bytes_sent": body_size,
+            "at": time.time()
+        }
+        with self._stats_lock:
+            self._stats["requests"] += 1
+            self._stats["bytes_sent"] += body_size or 0
+            self._stats["total_seconds"] += elapsed
+            self._stats["max_seconds"] = max(self._stats["max_seconds"], elapsed)
+            if error:
+                self._stats["errors"] += 1
+            self._recent_calls.append(call)
+
+    @staticmethod
+    def _body_size(file_content) -> Optional[int]:
+        if isinstance(file_content, (bytes, bytearray, mmap.mmap)):
+            return len(file_content)
+        if isinstance(file_content, memoryview):
+            return file_content.nbytes
+        try:
+            return requests.utils.super_len(file_content)
+        except Exception:
+            return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        连接池复用统计与调用耗时
+        - connections_opened: 实际新建的连接数
+        - connections_reused: 复用已有连接发出的请求数
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+            recent_calls = list(self._recent_calls)
+
+        connections_opened = 0
+        pool_requests = 0
+        pools = self._adapter.poolmanager.pools
+        # RecentlyUsedContainer 不支持遍历，keys() 返回加锁拷贝
+        for pool in filter(None, (pools.get(key) for key in pools.keys())):
+            connections_opened += getattr(pool, "num_connections", 0)
+            pool_requests += getattr(pool, "num_requests", 0)
+
+        stats["avg_seconds"] = round(stats["total_seconds"] / stats["requests"], 3) if stats["requests"] else 0.0
+        stats["total_seconds"] = round(stats["total_seconds"], 3)
+        stats["max_seconds"] = round(stats["max_seconds"], 3)
+        stats["pool_maxsize"] = self._adapter._pool_maxsize
+        stats["connections_opened"] = connections_opened
+        stats["connections_reused"] = max(pool_requests - connections_opened, 0)
+        stats["rate_limit_wait_seconds"] = round(getattr(self.rate_limiter, "total_wait_seconds", 0.0), 3)
+        stats["slot_wait_seconds"] = round(stats["slot_wait_seconds"], 3)
+        stats["max_in_flight"] = self.max_in_flight
+        stats["recent_calls"] = recent_calls
+        return stats
+
+    def close(self) -> None:
+        self.session.close()
+
+    def recognize_sharded(
+        self,
+        file_content: OCRBody,
+        options: Optional[Dict[str, Any]] = None,
+        pages_per_shard: int = 20,
+        max_workers: int = 4,
+        max_retries: int = 2,
+        progress_callback: Optional[Callable[[int, int], None]] = None
+    ) -> str:
+        """
+        分片并发识别：按 page_start/page_count 将 PDF 切分为页窗口并发调用 OCR，
+        仅重试失败的分片，最后按页序合并 Markdown
+        :param file_content: 文件二进制内容
+        :param options: 可选参数（同 recognize）
+        :param pages_per_shard: 每个分片的页数
+        :param max_workers: 单个文件的并发分片数（所有请求共同受 max_in_flight 限制）
+        :param max_retries: 失败分片的最大重试次数
+        :param progress_callback: 进度回调 (已完成分片数, 总分片数)
+        :return: 与 recognize 相同格式的响应文本（TextIn JSON，result.markdown 为合并后的 Markdown）
+        """
+        options = dict(options or {})
+        base_start = int(options.pop("page_start", 0) or 0)
+        requested_count = options.pop("page_count", None)
+
+        buffer = self._as_buffer(file_content)
+        try:
+            if bytes(buffer[:4]) != b"%PDF" or pages_per_shard <= 0:
+                # 非 PDF（图片/Office 文档）无法按页切分，退化为整体识别
+                if requested_count is not None:
+                    options["page_count"] = requested_count
+                if base_start:
+                    options["page_start"] = base_start
+                return self.recognize(buffer, options)
+            return self._recognize_shards(buffer, options, base_start, requested_count, pages_per_shard, max_workers, max_retries, progress_callback)
+        finally:
+            if isinstance(buffer, mmap.mmap) and buffer is not file_content:
+                # 由 _as_buffer 为文件对象创建的内存映射
+                buffer.close()
+
+    def _recognize_shards(
+        self,
+        file_content,
+        options: Dict[str, Any],
+        base_start: int,
+        requested_count: Optional[int],
+        pages_per_shard: int,
+        max_workers: int,
+        max_retries: int,
+        progress_callback: Optional[Callable[[int, int], None]]
+    ) -> str:
+        results: Dict[int, str] = {}
+        # 响应中的文档总页数；页数按文件结构估算偏大时，超出的分片视为空
+        reported_pages = 0
+        total_pages = self._count_pdf_pages(file_content) - base_start
+        if total_pages <= 0:
+            # 页数无法从文件结构中解析（如压缩对象流），先识别首个分片，从响应中获取总页数
+            first_count = pages_per_shard
+            if requested_count is not None:
+                first_count = min(first_count, int(requested_count))
+            first_text, reported_pages = self._recognize_shard(file_content, options, base_start, first_count)
+            results[base_start] = first_text
+            total_pages = max(reported_pages - base_start, first_count)
+
+        if requested_count is not None:
+            total_pages = min(total_pages, int(requested_count))
+
+        shards: List[Tuple[int, int]] = []
+        for offset in range(0, total_pages, pages_per_shard):
+            shards.append((base_start + offset, min(pages_per_shard, total_pages - offset)))
+
+        total = len(shards)
+        pending = [shard for shard in shards if shard[0] not in results]
+        if progress_callback:
+            progress_callback(total - len(pending), total)
+
+        logger.info(f"Sharded OCR: {total_pages} pages -> {total} shards, concurrency={max_workers}")
+
+        attempt = 0
+        last_error: Optional[Exception] = None
+        while pending:
+            failed: List[Tuple[int, int]] = []
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pending)))) as executor:
+                futures = {
+                    executor.submit(self._recognize_shard, file_content, options, start, count): (start, count)
+                    for start, count in pending
+                }
+                for future in as_completed(futures):
+                    start, count = futures[future]
+                    try:
+                        results[start], shard_pages = future.result()
+                        reported_pages = max(reported_pages, shard_pages)
+                        if progress_callback:
+                            progress_callback(len(results), total)
+                    except Exception as e:
+                        logger.warning(f"OCR shard failed (pages {start}-{start + count - 1}, attempt {attempt + 1}): {str(e)}")
+                        last_error = e
+                        failed.append((start, count))
+
+            if reported_pages:
+                # 起始页超出实际页数的分片（页数估算偏大）不再重试
+                for start, _ in [shard for shard in failed if shard[0] >= reported_pages]:
+                    results[start] = ""
+                failed = [shard for shard in failed if shard[0] < reported_pages]
+            if failed and attempt >= max_retries:
+                raise RuntimeError(f"OCR failed for {len(failed)} of {total} shards: {str(last_error)}")
+            pending = failed
+            attempt += 1
+
+        markdown = "\n\n".join(results[start] for start, _ in shards if results.get(start))
+        return json.dumps({
+            "code": 200,
+            "message": "success",
+            "result": {"markdown": markdown, "total_page_number": reported_pages or base_start + total_pages}
+        }, ensure_ascii=False)
+
+    @staticmethod
+    def _as_buffer(file_content: OCRBody):
+        """
+        分片需要对同一文件多次并发上传，将文件对象映射为只读内存（不读入堆内存）
+        """
+        if isinstance(file_content, (bytes, bytearray, memoryview, mmap.mmap)):
+            return file_content
+        if hasattr(file_content, "fileno"):
+            try:
+                return mmap.mmap(file_content.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                pass
+        if hasattr(file_content, "read"):
+            return file_content.read()
+        return b"".join(file_content)
+
+    def _recognize_shard(self, file_content, options: Dict[str, Any], page_start: int, page_count: int) -> Tuple[str, int]:
+        """
+        识别单个页窗口
+        :return: (Markdown 文本, 文档总页数)
+        """
+        shard_options = dict(options)
+        shard_options["page_start"] = page_start
+        shard_options["page_count"] = page_count
+        # 每个分片使用独立的内存视图，避免并发请求共享读取位置；用完即释放，内存映射才能关闭
+        with memoryview(file_content) as view:
+            response_text = self.recognize(view, shard_options)
+        return self._parse_markdown_result(response_text)
+
+    @staticmethod
+    def _parse_markdown_result(response_text: str) -> Tuple[str, int]:
+        """
+        从 pdf_to_markdown 响应中提取 Markdown 与总页数
+        """
+        try:
+            result_json = json.loads(response_text)
+        except ValueError:
+            # 不是JSON，视为纯文本结果
+            return response_text, 0
+
+        if not isinstance(result_json, dict):
+            return response_text, 0
+        if result_json.get("code") != 200:
+            raise RuntimeError(f"OCR error {result_json.get('code')}: {result_json.get('message')}")
+
+        result = result_json.get("result") or {}
+        return result.get("markdown", ""), int(result.get("total_page_number") or 0)
+
+    @staticmethod
+    def _count_pdf_pages(file_content) -> int:
+        """
+        读取页树根节点的 /Count（各页树节点中最大的 /Count），无法解析时返回 0
+        说明：增量更新可能保留旧版本页树，结果可能偏大，超出的分片由响应中的总页数修正
+        """
+        counts = [int(a or b) for a, b in _PDF_PAGES_COUNT_PATTERN.findall(file_content)]
+        return max(counts, default=0)
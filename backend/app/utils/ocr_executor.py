@@ -0,0 +1,201 @@
+# 文件名：ocr_executor.py
+"""
+功能说明：进程级 OCR 任务执行器
+核心功能：
+1. 固定数量的工作线程，限制同时进行的 OCR 任务数
+2. 有界等待队列，队列满时拒绝新任务（准入控制）
+3. 令牌桶限流，匹配 TextIn 接口配额
+4. 提供排队位置与预计等待时间，供 SSE 心跳展示
+依赖模块：threading, collections
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class OCRQueueFullError(Exception):
+    """
+    OCR 等待队列已满
+    """
+    pass
+
+
+class TokenBucket:
+    """
+    令牌桶限流器（线程安全）
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        """
+        :param rate: 每秒补充的令牌数，<= 0 表示不限流
+        :param capacity: 桶容量（允许的突发请求数）
+        """
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.total_wait_seconds = 0.0
+
+    def acquire(self) -> float:
+        """
+        获取一个令牌，必要时阻塞等待
+        :return: 本次等待的秒数
+        """
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.total_wait_seconds += waited
+                    return waited
+                sleep_for = (1 - self._tokens) / self.rate
+            time.sleep(sleep_for)
+            waited += sleep_for
+
+
+class OCRJob:
+    """
+    提交到执行器的单个 OCR 任务
+    """
+
+    def __init__(self, fn: Callable, args: tuple, kwargs: dict):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self._done = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    def get(self) -> Any:
+        """
+        获取结果（任务失败时抛出原始异常）
+        """
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class OCRExecutor:
+    """
+    有界 OCR 执行器
+    """
+
+    def __init__(self, max_workers: int = 4, max_queue: int = 32):
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._queue: "deque[OCRJob]" = deque()
+        self._cond = threading.Condition()
+        self._workers: list = []
+        self._running = 0
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "cancelled": 0}
+        # 任务耗时的指数滑动平均，用于估算等待时间
+        self._avg_duration = 30.0
+        self._avg_queue_wait = 0.0
+
+    def submit(self, fn: Callable, *args, **kwargs) -> OCRJob:
+        """
+        提交任务；等待队列已满时抛出 OCRQueueFullError
+        """
+        job = OCRJob(fn, args, kwargs)
+        with self._cond:
+            # 空闲工作线程即将取走的任务不计入等待队列
+            idle_workers = max(0, self.max_workers - self._running)
+            if len(self._queue) >= self.max_queue + idle_workers:
+                self._stats["rejected"] += 1
+                raise OCRQueueFullError("OCR 服务繁忙，排队人数已满，请稍后重试")
+            self._queue.append(job)
+            self._stats["submitted"] += 1
+            self._ensure_workers()
+            self._cond.notify()
+        return job
+
+    def cancel(self, job: OCRJob) -> bool:
+        """
+        取消仍在排队的任务（客户端断开时调用）
+        """
+        with self._cond:
+            try:
+                self._queue.remove(job)
+            except ValueError:
+                return False
+            self._stats["cancelled"] += 1
+            return True
+
+    def position(self, job: OCRJob) -> int:
+        """
+        排队位置：1 表示下一个执行，0 表示已开始执行或已完成
+        """
+        with self._cond:
+            try:
+                return self._queue.index(job) + 1
+            except ValueError:
+                return 0
+
+    def estimated_wait(self, job: OCRJob) -> float:
+        """
+        预计开始执行前还需等待的秒数
+        """
+        position = self.position(job)
+        if position <= 0:
+            return 0.0
+        rounds = (position - 1) // self.max_workers + 1
+        return rounds * self._avg_duration
+
+    def _ensure_workers(self) -> None:
+        while len(self._workers) < self.max_workers:
+            t = threading.Thread(target=self._worker_loop, name=f"ocr-worker-{len(self._workers)}", daemon=True)
+            self._workers.append(t)
+            t.start()
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job = self._queue.popleft()
+                self._running += 1
+
+            job.started_at = time.monotonic()
+            try:
+                job.result = job.fn(*job.args, **job.kwargs)
+            except BaseException as e:
+                job.error = e
+            finally:
+                duration = time.monotonic() - job.started_at
+                with self._cond:
+                    self._running -= 1
+                    self._stats["failed" if job.error is not None else "completed"] += 1
+                    self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+                    self._avg_queue_wait = 0.8 * self._avg_queue_wait + 0.2 * (job.started_at - job.enqueued_at)
+                job._done.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["running"] = self._running
+            stats["queued"] = len(self._queue)
+        stats["max_workers"] = self.max_workers
+        stats["max_queue"] = self.max_queue
+        stats["avg_job_seconds"] = round(self._avg_duration, 3)
+        stats["avg_queue_wait_seconds"] = round(self._avg_queue_wait, 3)
+        return stats
@@ -0,0 +1,222 @@
+# 文件名：single_flight.py
+"""
+功能说明：相同流式请求合并（single-flight）
+核心功能：
+1. 相同键的并发请求只执行一次生成流程，由后台线程产出输出块
+2. 后到的请求作为订阅者加入：先回放已产出的内容，再跟随实时输出
+3. 加入窗口：流程开始超过 join_window 秒或已产出内容超过 max_replay_chars 后不再接受加入，
+   之后的相同请求各自新建流程；回放缓冲只保留在线订阅者尚未读取的部分，内存不随输出长度增长
+4. 心跳（SSE 注释，如 OCR 排队位置、分片 / 章节进度）不进入回放缓冲，只把最新一条实时转发给在线订阅者
+5. 所有订阅者断开后终止生成流程，避免无人接收时继续消耗上游资源
+依赖模块：threading
+"""
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEARTBEAT = ": waiting shared analysis keep-alive\n\n"
+
+
+def _is_heartbeat(chunk: str) -> bool:
+    # SSE 注释形式的心跳只对当时在线的连接有意义，不做回放
+    return chunk.startswith(": ") and chunk.endswith("\n\n")
+
+
+class StreamFlight:
+    """
+    一次正在执行的生成流程
+    chunks 为回放缓冲，首个元素对应全局序号 base；positions 为各订阅者已读取到的全局序号
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: List[str] = []
+        self.base = 0
+        self.buffered_chars = 0
+        self.positions: Dict[int, int] = {}
+        self.started_at = time.monotonic()
+        # 不再接受新订阅者（超出加入窗口）
+        self.closed = False
+        self.last_heartbeat: Optional[str] = None
+        self.heartbeat_seq = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.abandoned = False
+        self.cond = threading.Condition()
+
+    @property
+    def end(self) -> int:
+        return self.base + len(self.chunks)
+
+    def trim(self) -> None:
+        """
+        不再接受加入后，丢弃所有在线订阅者都已读取的块（调用方持有 cond）
+        """
+        if not self.closed:
+            return
+        consumed = min(self.positions.values(), default=self.end)
+        if consumed > self.base:
+            dropped = self.chunks[:consumed - self.base]
+            del self.chunks[:consumed - self.base]
+            self.base = consumed
+            self.buffered_chars -= sum(len(c) for c in dropped)
+
+
+class StreamCoalescer:
+    """
+    流式请求合并器
+    """
+
+    def __init__(self, heartbeat_interval: float = 2.0, join_window: float = 30.0, max_replay_chars: int = 256 * 1024):
+        """
+        :param heartbeat_interval: 没有新内容时向订阅者发送心跳的间隔（秒）
+        :param join_window: 流程开始后接受加入的时长（秒）
+        :param max_replay_chars: 已产出内容超过该字符数后不再接受加入（回放缓冲上限）
+        """
+        self.heartbeat_interval = heartbeat_interval
+        self.join_window = join_window
+        self.max_replay_chars = max_replay_chars
+        self._flights: Dict[str, StreamFlight] = {}
+        self._lock = threading.Lock()
+        self._subscriber_ids = itertools.count(1)
+        self._stats = {"started": 0, "joined": 0, "abandoned": 0, "failed": 0, "join_closed": 0}
+
+    def stream(self, key: str, start: Callable[[], Iterable[str]], cleanup: Optional[Callable[[], None]] = None) -> Generator[str, None, None]:
+        """
+        订阅键对应的生成流程，不存在（或已超出加入窗口）时新建
+        :param start: 新建流程时调用，返回输出块迭代器（仅首个请求调用）
+        :param cleanup: 流程结束后的清理回调（仅首个请求的回调生效）
+        """
+        subscriber = next(self._subscriber_ids)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and self._close_if_expired(flight):
+                flight = None
+            if flight is None:
+                flight = StreamFlight(key)
+                self._flights[key] = flight
+                self._stats["started"] += 1
+                source = start()
+                threading.Thread(target=self._produce, args=(flight, source, cleanup), name="single-flight", daemon=True).start()
+            else:
+                self._stats["joined"] += 1
+                logger.info(f"Joined in-flight stream {key[:12]} ({flight.subscribers} subscribers)")
+            flight.subscribers += 1
+            with flight.cond:
+                # 加入窗口内缓冲完整，从头回放
+                flight.positions[subscriber] = flight.base
+
+        try:
+            yield from self._follow(flight, subscriber)
+        finally:
+            with flight.cond:
+                flight.positions.pop(subscriber, None)
+                flight.trim()
+            with self._lock:
+                flight.subscribers -= 1
+                if flight.subscribers == 0 and not flight.done:
+                    # 无人接收：通知生产线程停止，并让后续请求重新发起
+                    flight.abandoned = True
+                    self._stats["abandoned"] += 1
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+
+    def _close_if_expired(self, flight: StreamFlight) -> bool:
+        """
+        超出加入窗口时停止接受加入，并从合并表中移除（调用方持有 _lock）
+        :return: 是否已停止接受加入
+        """
+        if not flight.closed:
+            with flight.cond:
+                expired = time.monotonic() - flight.started_at >= self.join_window
+                if not expired and flight.buffered_chars < self.max_replay_chars:
+                    return False
+                flight.closed = True
+                flight.trim()
+            self._stats["join_closed"] += 1
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        return True
+
+    def _follow(self, flight: StreamFlight, subscriber: int) -> Generator[str, None, None]:
+        index = flight.positions.get(subscriber, 0)
+        heartbeat_seen = 0
+        while True:
+            with flight.cond:
+                flight.positions[subscriber] = index
+                flight.trim()
+                if index >= flight.end and not flight.done and flight.heartbeat_seq == heartbeat_seen:
+                    flight.cond.wait(self.heartbeat_interval)
+                new_chunks = flight.chunks[index - flight.base:]
+                heartbeat = flight.last_heartbeat
+                heartbeat_seq = flight.heartbeat_seq
+                done = flight.done
+                error = flight.error
+            index += len(new_chunks)
+
+            if not new_chunks and not done:
+                # 转发生产方最新的进度心跳；没有时发送通用保活
+                heartbeat_seen = heartbeat_seq
+                yield heartbeat or DEFAULT_HEARTBEAT
+                continue
+            for chunk in new_chunks:
+                yield chunk
+            if done and index >= flight.end:
+                if error is not None:
+                    raise error
+                return
+
+    def _produce(self, flight: StreamFlight, source: Iterable[str], cleanup: Optional[Callable[[], None]]) -> None:
+        try:
+            for chunk in source:
+                if flight.abandoned:
+                    close = getattr(source, "close", None)
+                    if close:
+                        close()
+                    break
+                if not chunk:
+                    continue
+                if _is_heartbeat(chunk):
+                    with flight.cond:
+                        flight.last_heartbeat = chunk
+                        flight.heartbeat_seq += 1
+                        flight.cond.notify_all()
+                    continue
+                with flight.cond:
+                    flight.chunks.append(chunk)
+                    flight.buffered_chars += len(chunk)
+                    flight.trim()
+                    flight.cond.notify_all()
+                if not flight.closed:
+                    with self._lock:
+                        self._close_if_expired(flight)
+        except BaseException as e:
+            logger.error(f"Shared stream {flight.key[:12]} failed: {str(e)}")
+            flight.error = e
+            with self._lock:
+                self._stats["failed"] += 1
+        finally:
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+            with flight.cond:
+                flight.done = True
+                flight.cond.notify_all()
+            if cleanup:
+                try:
+                    cleanup()
+                except Exception as e:
+                    logger.error(f"Shared stream cleanup failed: {str(e)}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._flights)
+            stats["subscribers"] = sum(f.subscribers for f in self._flights.values())
+            stats["buffered_chars"] = sum(f.buffered_chars for f in self._flights.values())
+        return stats
@@ -0,0 +1,218 @@
+# 文件名：token_budget.py
+"""
+功能说明：按模型估算 token 并规划上下文预算
+核心功能：
+1. 离线 token 估算：按模型族区分中文（CJK）与其他字符的 token 系数
+2. 模型上下文窗口表（可由环境变量覆盖）
+3. 上下文规划：在系统提示词、方法论、文档与预留输出之间分配 token 预算
+4. 按 token 预算截断文本
+依赖模块：re
+"""
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+# CJK 字符及全角标点
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+# 连续空白（分词器通常会把多个空白合并为少量 token）
+_SPACE_RUN_PATTERN = re.compile(r"[ \t]{2,}")
+
+# 每条消息的固定开销（角色标记、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@dataclass(frozen=True)
+class ModelProfile:
+    """
+    模型参数
+    :param context_window: 上下文窗口（输入 + 输出 token 总数）
+    :param cjk_tokens_per_char: 每个中文字符对应的 token 数
+    :param chars_per_token: 非中文字符平均多少个字符对应 1 个 token
+    """
+    context_window: int
+    cjk_tokens_per_char: float
+    chars_per_token: float
+
+
+# 按模型名前缀匹配（先匹配更长的前缀）；系数取各分词器在中文技术文档上的偏保守值
+MODEL_PROFILES: Dict[str, ModelProfile] = {
+    "doubao-seed": ModelProfile(256_000, 0.75, 3.6),
+    "doubao-1.5-pro-256k": ModelProfile(256_000, 0.75, 3.6),
+    "doubao-1.5-pro-32k": ModelProfile(32_768, 0.75, 3.6),
+    "doubao-pro-256k": ModelProfile(256_000, 0.75, 3.6),
+    "doubao-pro-128k": ModelProfile(128_000, 0.75, 3.6),
+    "doubao-pro-32k": ModelProfile(32_768, 0.75, 3.6),
+    "doubao": ModelProfile(32_768, 0.75, 3.6),
+    "deepseek": ModelProfile(64_000, 0.7, 3.6),
+    "qwen": ModelProfile(32_768, 0.75, 3.6),
+    "glm": ModelProfile(128_000, 0.75, 3.6),
+    "moonshot-v1-128k": ModelProfile(128_000, 0.8, 3.6),
+    "moonshot-v1-32k": ModelProfile(32_768, 0.8, 3.6),
+    "moonshot": ModelProfile(8_192, 0.8, 3.6),
+    "gpt-4o": ModelProfile(128_000, 0.9, 4.0),
+    "gpt-4.1": ModelProfile(1_000_000, 0.9, 4.0),
+    "gpt-4-turbo": ModelProfile(128_000, 1.3, 3.8),
+    "gpt-4": ModelProfile(8_192, 1.3, 3.8),
+    "gpt-3.5-turbo": ModelProfile(16_385, 1.3, 3.8),
+}
+
+# 未知模型：按 32K 窗口与偏大的中文系数处理，宁可少放也不超限
+DEFAULT_PROFILE = ModelProfile(32_768, 1.0, 3.5)
+
+
+def get_model_profile(model: Optional[str], context_window: int = 0) -> ModelProfile:
+    """
+    获取模型参数
+    :param model: 模型名（或推理接入点名称）
+    :param context_window: 显式配置的上下文窗口，> 0 时覆盖内置值
+    """
+    name = (model or "").lower()
+    profile = DEFAULT_PROFILE
+    for prefix in sorted(MODEL_PROFILES, key=len, reverse=True):
+        if name.startswith(prefix):
+            profile = MODEL_PROFILES[prefix]
+            break
+    if context_window > 0:
+        profile = ModelProfile(context_window, profile.cjk_tokens_per_char, profile.chars_per_token)
+    return profile
+
+
+@lru_cache(maxsize=64)
+def estimator_for(model: Optional[str]) -> "TokenEstimator":
+    """
+    按模型名获取 token 估算器（统计、缓存与上下文规划共用同一套系数）
+    """
+    return TokenEstimator(get_model_profile(model))
+
+
+class TokenEstimator:
+    """
+    离线 token 估算器（无需加载分词器词表）
+    """
+
+    def __init__(self, profile: ModelProfile):
+        self.profile = profile
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        cjk = len(_CJK_PATTERN.findall(text))
+        other = len(_SPACE_RUN_PATTERN.sub(" ", text)) - cjk
+        return int(cjk * self.profile.cjk_tokens_per_char + max(0, other) / self.profile.chars_per_token + 0.999)
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.count(m.get("content", "")) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+    def _search_limit(self, text: str, max_tokens: int, from_end: bool) -> int:
+        """
+        二分查找的上界：先按非中文字符系数估算一个长度，若该长度已超预算则以其为上界，避免对超长文本反复全量计数
+        """
+        guess = int(max_tokens * self.profile.chars_per_token) + 1
+        if guess >= len(text):
+            return len(text)
+        sample = text[-guess:] if from_end else text[:guess]
+        return guess if self.count(sample) > max_tokens else len(text)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        截断文本，使其 token 数不超过 max_tokens（二分查找最长前缀）
+        """
+        if max_tokens <= 0 or not text:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        low, high = 0, self._search_limit(text, max_tokens, from_end=False)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.count(text[:mid]) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low]
+
+    def truncate_tail(self, text: str, max_tokens: int) -> str:
+        """
+        保留文本末尾，使其 token 数不超过 max_tokens
+        """
+        if max_tokens <= 0 or not text:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        low, high = 0, self._search_limit(text, max_tokens, from_end=True)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.count(text[-mid:]) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return text[-low:] if low else ""
+
+
+class ContextPlanner:
+    """
+    上下文预算规划：窗口 = 预留输出 + 安全余量 + 提示词开销 + 方法论 + 文档
+    """
+
+    def __init__(self, estimator: TokenEstimator, reserved_output_tokens: int = 8192, safety_ratio: float = 0.05, methodology_max_tokens: int = 6000, methodology_max_ratio: float = 0.25, document_max_tokens: int = 0):
+        """
+        :param reserved_output_tokens: 为模型输出预留的 token 数
+        :param safety_ratio: 估算误差安全余量（占窗口比例）
+        :param methodology_max_tokens: 方法论 token 上限
+        :param methodology_max_ratio: 方法论最多占可用输入预算的比例
+        :param document_max_tokens: 文档 token 上限（0 表示仅受窗口限制）
+        """
+        self.estimator = estimator
+        self.reserved_output_tokens = reserved_output_tokens
+        self.safety_ratio = safety_ratio
+        self.methodology_max_tokens = methodology_max_tokens
+        self.methodology_max_ratio = methodology_max_ratio
+        self.document_max_tokens = document_max_tokens
+
+    @property
+    def input_budget(self) -> int:
+        """
+        可用于输入的 token 总数
+        """
+        window = self.estimator.profile.context_window
+        reserved = min(self.reserved_output_tokens, window // 2)
+        return max(0, int(window * (1 - self.safety_ratio)) - reserved)
+
+    def methodology_budget(self) -> int:
+        return max(0, min(self.methodology_max_tokens, int(self.input_budget * self.methodology_max_ratio)))
+
+    def document_budget(self, messages_without_document: List[Dict[str, str]]) -> int:
+        """
+        文档可用的 token 数
+        :param messages_without_document: 文档位置为空时构建的完整消息（含系统提示词与方法论）
+        """
+        remaining = self.input_budget - self.estimator.count_messages(messages_without_document)
+        if self.document_max_tokens > 0:
+            remaining = min(remaining, self.document_max_tokens)
+        return max(0, remaining)
+
+    def describe(self) -> Dict[str, int]:
+        return {
+            "context_window": self.estimator.profile.context_window,
+            "input_budget": self.input_budget,
+            "reserved_output_tokens": self.reserved_output_tokens,
+            "methodology_budget": self.methodology_budget(),
+            "document_max_tokens": self.document_max_tokens
+        }
+
+    @classmethod
+    def from_config(cls, config) -> "ContextPlanner":
+        # 多端点池中模型可能不同：取最小窗口与最大中文系数，保证任一端点都不超限
+        models = [m for m in [config.LLM_MODEL] + [item.get("model") for item in getattr(config, "LLM_ENDPOINTS", [])] if m] or [None]
+        profiles = [get_model_profile(model, config.LLM_CONTEXT_WINDOW) for model in models]
+        profile = ModelProfile(
+            min(p.context_window for p in profiles),
+            max(p.cjk_tokens_per_char for p in profiles),
+            min(p.chars_per_token for p in profiles)
+        )
+        return cls(
+            TokenEstimator(profile),
+            reserved_output_tokens=config.LLM_RESERVED_OUTPUT_TOKENS,
+            methodology_max_tokens=config.LLM_METHODOLOGY_MAX_TOKENS,
+            document_max_tokens=config.LLM_DOCUMENT_MAX_TOKENS
+        )
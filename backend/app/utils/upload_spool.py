@@ -0,0 +1,185 @@
+# 文件名：upload_spool.py
+"""
+功能说明：上传文件落盘暂存
+核心功能：
+1. 将上传文件分块写入临时文件，避免 file.read() 将整个文件读入内存
+2. 写入过程中增量计算 SHA-256，供缓存/去重直接使用；
+   multipart 解析时可直接写入暂存文件（HashingSpoolFile），解析完成后原地接管，不再复制
+3. 提供文件句柄与只读内存映射两种读取方式
+4. 引用计数：多个使用方共享同一暂存文件时，最后一个释放者负责删除
+依赖模块：hashlib, mmap, tempfile
+"""
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+from typing import BinaryIO, Optional
+
+logger = logging.getLogger(__name__)
+
+# 每次从请求流读取的块大小
+CHUNK_SIZE = 1024 * 1024
+
+
+class SpooledUpload:
+    """
+    已落盘的上传文件
+    """
+
+    def __init__(self, path: str, filename: str, size: int, sha256: str):
+        self.path = path
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256
+        self._mmap: Optional[mmap.mmap] = None
+        self._mmap_file: Optional[BinaryIO] = None
+        self._refs = 1
+        self._refs_lock = threading.Lock()
+
+    @classmethod
+    def from_stream(cls, stream: BinaryIO, filename: str, spool_dir: Optional[str] = None) -> "SpooledUpload":
+        """
+        从请求流分块写入临时文件并增量计算摘要
+        :param stream: 文件流（如 werkzeug FileStorage.stream）
+        :param filename: 原始文件名
+        :param spool_dir: 临时目录（默认系统临时目录）
+        """
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix="upload_", suffix=".bin", dir=spool_dir)
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            _remove_quietly(path)
+            raise
+        return cls(path, filename, size, hasher.hexdigest())
+
+    @classmethod
+    def from_file_storage(cls, file_storage, spool_dir: Optional[str] = None) -> "SpooledUpload":
+        """
+        从 werkzeug FileStorage 获取暂存文件：解析时已写入 HashingSpoolFile 的直接接管（摘要已算好），否则分块复制
+        """
+        if isinstance(file_storage.stream, HashingSpoolFile):
+            return file_storage.stream.adopt(file_storage.filename)
+        return cls.from_stream(file_storage.stream, file_storage.filename, spool_dir)
+
+    def open(self) -> BinaryIO:
+        """
+        打开一个新的只读文件句柄（每个消费者独立的读取位置，可直接作为流式上传的请求体）
+        """
+        return open(self.path, "rb")
+
+    def buffer(self):
+        """
+        只读内存映射（按需分页加载，不占用进程堆内存）
+        """
+        if self.size == 0:
+            return b""
+        if self._mmap is None:
+            self._mmap_file = open(self.path, "rb")
+            self._mmap = mmap.mmap(self._mmap_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def __len__(self) -> int:
+        return self.size
+
+    def retain(self) -> "SpooledUpload":
+        """
+        增加一个使用方（如合并请求的后台执行），需对应调用一次 close()
+        """
+        with self._refs_lock:
+            self._refs += 1
+        return self
+
+    def close(self) -> None:
+        """
+        释放一个引用；最后一个引用释放时关闭映射并删除临时文件
+        """
+        with self._refs_lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # 仍有内存视图引用映射时无法关闭，交由 GC 回收
+                pass
+            self._mmap = None
+        if self._mmap_file is not None:
+            self._mmap_file.close()
+            self._mmap_file = None
+        _remove_quietly(self.path)
+
+    def __enter__(self) -> "SpooledUpload":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+class HashingSpoolFile:
+    """
+    multipart 解析时文件内容的写入目标（werkzeug stream_factory）：写入临时文件的同时增量计算摘要，
+    解析完成后由 SpooledUpload 接管同一文件；未被接管时随请求结束关闭并删除
+    """
+
+    def __init__(self, spool_dir: Optional[str] = None):
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix="upload_", suffix=".bin", dir=spool_dir)
+        self._file = os.fdopen(fd, "w+b")
+        self._hasher = hashlib.sha256()
+        self.size = 0
+        self._upload: Optional[SpooledUpload] = None
+        self._lock = threading.Lock()
+
+    def write(self, data: bytes) -> int:
+        self._hasher.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        # 读取 / 定位等操作直接使用底层文件（FileStorage.save、read 等）
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def adopt(self, filename: str) -> SpooledUpload:
+        """
+        交由 SpooledUpload 管理（删除随其引用计数）；重复接管时返回同一对象并增加引用
+        """
+        with self._lock:
+            if self._upload is not None:
+                return self._upload.retain()
+            self._file.close()
+            self._upload = SpooledUpload(self.path, filename, self.size, self._hasher.hexdigest())
+            return self._upload
+
+    def close(self) -> None:
+        with self._lock:
+            if self._upload is not None:
+                return
+            self._file.close()
+        _remove_quietly(self.path)
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Failed to remove spooled upload {path}: {str(e)}")
@@ -0,0 +1,357 @@
+# 文件名：write_behind.py
+"""
+功能说明：写后（write-behind）缓冲
+核心功能：
+1. CounterAggregator：在内存中按键累加计数增量，定期或达到键数阈值时交给回调批量写入
+2. TelemetryWriter：有界插入队列，按集合分组批量写入；队列满时阻塞等待（背压）或丢弃并计数
+3. 后台线程负责刷写，请求线程只做内存操作
+4. 计数刷写失败时将增量合并回缓冲，下次重试；进程正常退出时（atexit）最后刷写一次
+5. 插入失败时按指数退避重试（确认写入级），重试耗尽后记录失败序号，等待方据此得知自己的文档未落库
+依赖模块：threading, atexit
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# 单次重试等待上限（秒）/ 记录的失败序号上限（超出后淘汰最早的）
+MAX_RETRY_BACKOFF_SECONDS = 10.0
+MAX_FAILED_SEQS = 100000
+
+
+class WriteBehindError(RuntimeError):
+    """
+    排队的文档重试耗尽后仍未写入
+    """
+
+    def __init__(self, name: str, failed_seqs: Set[int]):
+        super().__init__(f"{len(failed_seqs)} queued documents of {name} were not written")
+        self.failed_seqs = failed_seqs
+
+
+class CounterDelta:
+    """
+    单个键待写入的增量：incs 累加，maxes 取最大值（如最后使用时间），sets 取并集（如去重用户）
+    """
+
+    __slots__ = ("incs", "maxes", "sets")
+
+    def __init__(self):
+        self.incs: Dict[str, int] = {}
+        self.maxes: Dict[str, Any] = {}
+        self.sets: Dict[str, Set[Hashable]] = {}
+
+    def merge(self, incs: Dict[str, int], maxes: Optional[Dict[str, Any]] = None, sets: Optional[Dict[str, Iterable[Hashable]]] = None) -> None:
+        for field, value in incs.items():
+            self.incs[field] = self.incs.get(field, 0) + value
+        for field, value in (maxes or {}).items():
+            current = self.maxes.get(field)
+            if current is None or value > current:
+                self.maxes[field] = value
+        for field, values in (sets or {}).items():
+            self.sets.setdefault(field, set()).update(values)
+
+
+class CounterAggregator:
+    """
+    计数写后缓冲
+    """
+
+    def __init__(self, flush_fn: Callable[[Dict[Hashable, CounterDelta]], None], flush_interval: float = 5.0, max_keys: int = 500, name: str = "counters"):
+        """
+        :param flush_fn: 批量写入回调，参数为 {键: CounterDelta}；抛出异常视为写入失败
+        :param flush_interval: 定期刷写间隔（秒）
+        :param max_keys: 待写入的键数达到该值时立即触发刷写
+        :param name: 线程名与日志标识
+        """
+        self.flush_fn = flush_fn
+        self.flush_interval = max(0.1, flush_interval)
+        self.max_keys = max(1, max_keys)
+        self.name = name
+        self._pending: Dict[Hashable, CounterDelta] = {}
+        self._lock = threading.Lock()
+        # 串行化刷写，避免定期刷写与退出刷写并发执行
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"added": 0, "flushes": 0, "flushed_keys": 0, "failures": 0}
+        self._last_flush_ms = 0.0
+
+    def add(self, key: Hashable, incs: Dict[str, int], maxes: Optional[Dict[str, Any]] = None, sets: Optional[Dict[str, Iterable[Hashable]]] = None) -> None:
+        """
+        累加一次增量（仅内存操作）
+        """
+        with self._lock:
+            delta = self._pending.get(key)
+            if delta is None:
+                delta = self._pending[key] = CounterDelta()
+            delta.merge(incs, maxes, sets)
+            self._stats["added"] += 1
+            pending = len(self._pending)
+            if self._thread is None and not self._closed:
+                self._start()
+        if pending >= self.max_keys:
+            self._wakeup.set()
+
+    def _start(self) -> None:
+        # 首次写入时再启动后台线程（需持有 _lock）
+        self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.name}", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._closed:
+                break
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        将当前缓冲写出
+        :return: 写出的键数
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+
+            started = time.perf_counter()
+            try:
+                self.flush_fn(batch)
+            except Exception as e:
+                # 写入失败：增量合并回缓冲，下次重试
+                with self._lock:
+                    for key, delta in batch.items():
+                        target = self._pending.get(key)
+                        if target is None:
+                            self._pending[key] = delta
+                        else:
+                            target.merge(delta.incs, delta.maxes, delta.sets)
+                    self._stats["failures"] += 1
+                logger.error(f"Write-behind flush of {self.name} failed ({len(batch)} keys): {str(e)}")
+                return 0
+
+            with self._lock:
+                self._stats["flushes"] += 1
+                self._stats["flushed_keys"] += len(batch)
+                self._last_flush_ms = (time.perf_counter() - started) * 1000
+            return len(batch)
+
+    def close(self) -> None:
+        """
+        停止后台线程并写出剩余增量（可重复调用）
+        """
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["pending_keys"] = len(self._pending)
+            stats["last_flush_ms"] = round(self._last_flush_ms, 2)
+        return stats
+
+
+class TelemetryWriter:
+    """
+    批量插入写后队列
+    """
+
+    def __init__(self, insert_fn: Callable[[str, List[dict]], None], max_queue: int = 10000, batch_size: int = 500, flush_interval: float = 1.0, block_timeout: Optional[float] = None, max_retries: int = 0, retry_backoff: float = 0.5, name: str = "telemetry"):
+        """
+        :param insert_fn: 批量插入回调 insert_fn(集合名, 文档列表)；抛出异常视为该批写入失败，重试时须能容忍已写入的文档
+        :param max_queue: 队列容量（文档数）
+        :param batch_size: 单批最多写入的文档数
+        :param flush_interval: 队列未满一批时的最长等待时间（秒）
+        :param block_timeout: 队列满时入队最多等待的秒数；None 表示不等待，直接丢弃并计数
+        :param max_retries: 写入失败后的重试次数；0 表示不重试，失败的文档直接丢弃并计数
+        :param retry_backoff: 首次重试前的等待秒数，之后每次翻倍
+        :param name: 线程名与日志标识
+        """
+        self.insert_fn = insert_fn
+        self.max_queue = max(1, max_queue)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.05, flush_interval)
+        self.block_timeout = block_timeout
+        self.max_retries = max(0, max_retries)
+        self.retry_backoff = max(0.0, retry_backoff)
+        self.name = name
+        self._queue: deque = deque()
+        self._cond = threading.Condition()
+        # 串行化刷写，保证批次按入队顺序完成
+        self._flush_lock = threading.Lock()
+        # 入队序号 / 已处理（写入或失败）的最大序号，供调用方等待自己的文档落库
+        self._seq = 0
+        self._completed_seq = 0
+        # 重试耗尽仍未写入的序号（有上限，按失败先后淘汰）
+        self._failed_seqs: Set[int] = set()
+        self._failed_order: deque = deque()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "retries": 0, "batches": 0, "blocked": 0}
+        self._flush_ms = {"last": 0.0, "max": 0.0, "total": 0.0}
+
+    def put(self, collection: str, doc: dict) -> Optional[int]:
+        """
+        文档入队
+        :return: 入队序号；队列已满且等待超时（或不等待）时返回 None
+        """
+        with self._cond:
+            if len(self._queue) >= self.max_queue and self.block_timeout:
+                self._stats["blocked"] += 1
+                self._cond.wait_for(lambda: len(self._queue) < self.max_queue or self._closed, self.block_timeout)
+            if len(self._queue) >= self.max_queue:
+                self._stats["dropped"] += 1
+                dropped = self._stats["dropped"]
+            else:
+                dropped = None
+                self._seq += 1
+                seq = self._seq
+                self._queue.append((seq, collection, doc))
+                self._stats["enqueued"] += 1
+                if self._thread is None and not self._closed:
+                    self._start()
+                if len(self._queue) >= self.batch_size:
+                    self._cond.notify_all()
+        if dropped is not None:
+            # 按 2 的幂次记录日志，避免持续溢出时刷屏
+            if dropped & (dropped - 1) == 0:
+                logger.warning(f"Write-behind queue {self.name} full, dropped {dropped} documents so far")
+            return None
+        return seq
+
+    def _start(self) -> None:
+        # 首次入队时再启动后台线程（需持有 _cond）
+        self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.name}", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._closed and len(self._queue) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                if self._closed and not self._queue:
+                    return
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        写出队列中的一批文档
+        :return: 本批处理的文档数（含写入失败的）
+        """
+        with self._flush_lock:
+            return self._flush_batch()
+
+    def _flush_batch(self) -> int:
+        with self._cond:
+            count = min(len(self._queue), self.batch_size)
+            batch = [self._queue.popleft() for _ in range(count)]
+            if batch:
+                # 腾出空间，唤醒等待入队的线程
+                self._cond.notify_all()
+        if not batch:
+            return 0
+
+        # 按集合分组，保持各集合首次出现的顺序（同批内先入队集合的文档先写入）
+        groups: Dict[str, List[Tuple[int, dict]]] = {}
+        for seq, collection, doc in batch:
+            groups.setdefault(collection, []).append((seq, doc))
+
+        started = time.perf_counter()
+        written = 0
+        failed_seqs: List[int] = []
+        for collection, items in groups.items():
+            if self._insert_with_retry(collection, [doc for _, doc in items]):
+                written += len(items)
+            else:
+                failed_seqs.extend(seq for seq, _ in items)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        with self._cond:
+            for seq in failed_seqs:
+                self._failed_seqs.add(seq)
+                self._failed_order.append(seq)
+            while len(self._failed_order) > MAX_FAILED_SEQS:
+                self._failed_seqs.discard(self._failed_order.popleft())
+            self._completed_seq = max(self._completed_seq, batch[-1][0])
+            self._stats["written"] += written
+            self._stats["failed"] += len(failed_seqs)
+            self._stats["batches"] += 1
+            self._flush_ms["last"] = elapsed_ms
+            self._flush_ms["max"] = max(self._flush_ms["max"], elapsed_ms)
+            self._flush_ms["total"] += elapsed_ms
+            self._cond.notify_all()
+        return len(batch)
+
+    def _insert_with_retry(self, collection: str, docs: List[dict]) -> bool:
+        """
+        写入一组文档，失败时按指数退避重试（在刷写线程中等待，期间队列积压由入队背压限制）
+        :return: 是否写入成功
+        """
+        attempt = 0
+        while True:
+            try:
+                self.insert_fn(collection, docs)
+                return True
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    logger.error(f"Write-behind insert into {collection} failed ({len(docs)} documents, {attempt + 1} attempts): {str(e)}")
+                    return False
+                delay = min(self.retry_backoff * (2 ** attempt), MAX_RETRY_BACKOFF_SECONDS)
+                attempt += 1
+                with self._cond:
+                    self._stats["retries"] += 1
+                logger.warning(f"Write-behind insert into {collection} failed, retry {attempt}/{self.max_retries} in {delay:.1f}s: {str(e)}")
+                time.sleep(delay)
+
+    def wait_for(self, seqs: Union[int, Iterable[int], None], timeout: float) -> bool:
+        """
+        等待指定序号（及之前入队）的文档处理完毕
+        :param seqs: 调用方关心的入队序号（单个或多个）
+        :return: 是否在超时前完成
+        :raises WriteBehindError: 其中有文档重试耗尽仍未写入
+        """
+        if isinstance(seqs, int):
+            seqs = [seqs]
+        wanted = [seq for seq in (seqs or ()) if seq]
+        if not wanted:
+            return True
+        last = max(wanted)
+        with self._cond:
+            self._cond.notify_all()
+            if not self._cond.wait_for(lambda: self._completed_seq >= last, timeout):
+                return False
+            failed = {seq for seq in wanted if seq in self._failed_seqs}
+        if failed:
+            raise WriteBehindError(self.name, failed)
+        return True
+
+    def close(self) -> None:
+        """
+        停止后台线程并写出队列中的全部文档（可重复调用）
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        while self.flush():
+            pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["queue_depth"] = len(self._queue)
+            stats["max_queue"] = self.max_queue
+            stats["last_flush_ms"] = round(self._flush_ms["last"], 2)
+            stats["max_flush_ms"] = round(self._flush_ms["max"], 2)
+            stats["avg_flush_ms"] = round(self._flush_ms["total"] / self._stats["batches"], 2) if self._stats["batches"] else 0.0
+        return stats
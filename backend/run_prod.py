@@ -7,6 +7,8 @@
 from app import create_app
 from waitress import serve
 import logging
+import signal
+import sys
 
 # 初始化应用
 app = create_app()
@@ -16,6 +18,9 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger('waitress')
     logger.info("Starting Blueprint Master Backend on port 5000...")
+
+    # SIGTERM 转为正常退出，触发 atexit 刷写写后缓冲（书籍统计等）
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     
     # 启动Waitress服务器
     # threads: 处理请求的线程数
@@ -0,0 +1,15 @@
+# 文件名：conftest.py
+"""
+功能说明：测试公共配置
+说明：导入 app 包会初始化各服务（OCR / LLM 客户端、会话签名），这里为必填配置提供占位值；
+      测试不访问真实的 TextIn / LLM / MongoDB 服务
+"""
+import os
+
+os.environ.setdefault("TEXTIN_APP_ID", "test-app-id")
+os.environ.setdefault("TEXTIN_SECRET_CODE", "test-secret-code")
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "http://127.0.0.1:9/v1")
+os.environ.setdefault("LLM_MODEL", "test-model")
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+os.environ.setdefault("DB_ENSURE_INDEXES", "false")
@@ -0,0 +1,137 @@
+# 文件名：test_llm_client.py
+"""
+功能说明：LLMClient 多端点故障切换测试
+说明：在本地启动两个 OpenAI 兼容的 chat.completions 替身服务（SSE 流式输出），
+      其中一个在首个分块之前失败（返回 500 或直接断开连接），
+      验证 LLMClient 从另一个端点完整输出，且路由记录了切换决策
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.utils.llm_client import LLMClient
+from app.utils.llm_dispatcher import LLMDispatcher
+from app.utils.llm_router import LLMEndpoint, LLMRouter
+
+MESSAGES = [{"role": "user", "content": "评审这份蓝图"}]
+
+
+class FakeChatCompletions:
+    """
+    chat.completions 替身：mode 为 ok（逐块输出 pieces）/ error（返回 500）/ close（不响应直接断开）
+    """
+
+    def __init__(self, mode: str, pieces=("Hello", " world")):
+        self.mode = mode
+        self.pieces = list(pieces)
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def record(self, body: dict) -> None:
+        with self._lock:
+            self.requests.append(body)
+
+    def chunks(self, body: dict):
+        model = body.get("model")
+        for piece in self.pieces:
+            yield {"id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0, "model": model,
+                   "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+        yield {"id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0, "model": model,
+               "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield {"id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0, "model": model, "choices": [],
+                   "usage": {"prompt_tokens": 10, "completion_tokens": len(self.pieces), "total_tokens": 10 + len(self.pieces)}}
+
+
+def serve(state: FakeChatCompletions):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            state.record(body)
+            if state.mode == "close":
+                self.close_connection = True
+                return
+            if state.mode == "error":
+                data = json.dumps({"error": {"message": "injected failure", "type": "server_error"}}).encode("utf-8")
+                self.send_response(500)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for chunk in state.chunks(body):
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    return server
+
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def start(mode: str) -> FakeChatCompletions:
+        state = FakeChatCompletions(mode)
+        started.append(serve(state))
+        return state
+
+    yield start
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+
+def make_client(*endpoints):
+    # 关闭 SDK 自身的重试，失败立即交给路由切换
+    router = LLMRouter([LLMEndpoint(state.base_url, "key", model, name=name, max_retries=0) for name, model, state in endpoints])
+    return LLMClient(router=router, dispatcher=LLMDispatcher(max_in_flight=2))
+
+
+@pytest.mark.parametrize("mode", ["error", "close"])
+def test_fails_over_to_healthy_endpoint_before_first_chunk(servers, mode):
+    broken = servers(mode)
+    healthy = servers("ok")
+    # 尚无样本的端点评分相同，按配置顺序先选中故障端点
+    client = make_client(("broken", "model-a", broken), ("healthy", "model-a", healthy))
+
+    assert client.chat(MESSAGES, endpoint="test") == "Hello world"
+
+    assert len(broken.requests) == 1 and len(healthy.requests) == 1
+    assert healthy.requests[0]["model"] == "model-a" and healthy.requests[0]["stream"] is True
+    stats = client.router.get_stats()
+    assert [(d["chosen"], d["reason"]) for d in stats["recent_decisions"]] == [("broken", "best_score"), ("healthy", "failover")]
+    by_name = {e["name"]: e for e in stats["endpoints"]}
+    assert by_name["broken"]["failures"] == 1 and by_name["broken"]["last_error"]
+    assert by_name["healthy"]["successes"] == 1
+    assert all(e["in_flight"] == 0 for e in stats["endpoints"])
+    assert client.usage_stats.get_stats()["endpoints"]["test"]["completion_tokens"] == 2
+
+
+def test_cross_model_failover_requeues_on_the_new_model(servers):
+    broken = servers("error")
+    healthy = servers("ok")
+    client = make_client(("broken", "model-a", broken), ("healthy", "model-b", healthy))
+
+    assert client.chat(MESSAGES) == "Hello world"
+
+    assert healthy.requests[0]["model"] == "model-b"
+    decisions = client.router.get_stats()["recent_decisions"]
+    assert [(d["chosen"], d["reason"]) for d in decisions] == [("broken", "best_score"), ("healthy", "failover")]
+    # 原模型的调度名额随切换释放，输出在新模型的调度分组中完成
+    dispatcher = client.dispatcher.get_stats()
+    assert dispatcher["submitted"] == 2 and dispatcher["completed"] == 2
+    assert {model: s["running"] for model, s in dispatcher["models"].items()} == {"model-a": 0, "model-b": 0}
@@ -0,0 +1,193 @@
+# 文件名：test_llm_router.py
+"""
+功能说明：LLMRouter 端点选择与熔断测试
+说明：端点指向不可达地址，测试只驱动路由状态（acquire / release_*），不发起真实请求；
+      通过替换 llm_router.time.monotonic 控制冷却期
+"""
+import pytest
+
+from app.utils import llm_router
+from app.utils.llm_router import CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN, LLMEndpoint, LLMRouter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(llm_router.time, "monotonic", fake)
+    return fake
+
+
+def make_router(*names, **kwargs):
+    endpoints = [LLMEndpoint(f"http://127.0.0.1:9/{name}", "key", "model", name=name) for name in names]
+    return LLMRouter(endpoints, **kwargs)
+
+
+def endpoint(router, name):
+    return next(e for e in router.endpoints if e.name == name)
+
+
+def warm_up(router, name, ttft, tokens=1000, seconds=10.0):
+    target = endpoint(router, name)
+    target.in_flight += 1
+    router.release_success(target, ttft, tokens, seconds)
+
+
+def test_prefers_lowest_expected_latency(clock):
+    router = make_router("slow", "fast")
+    warm_up(router, "slow", ttft=2.0)
+    warm_up(router, "fast", ttft=0.5)
+
+    chosen = router.acquire()
+    assert chosen.name == "fast"
+    assert chosen.in_flight == 1
+
+
+def test_failover_tries_remaining_endpoints_in_score_order(clock):
+    router = make_router("a", "b", "c")
+    warm_up(router, "a", ttft=0.2)
+    warm_up(router, "b", ttft=0.4)
+    warm_up(router, "c", ttft=0.8)
+
+    tried = []
+    order = []
+    while True:
+        target = router.acquire(exclude=tried)
+        if target is None:
+            break
+        order.append(target.name)
+        router.release_failure(target, RuntimeError("boom"))
+        tried.append(target)
+
+    assert order == ["a", "b", "c"]
+    reasons = [d["reason"] for d in router.get_stats()["recent_decisions"]]
+    assert reasons == ["best_score", "failover", "failover"]
+
+
+def test_circuit_opens_after_threshold_and_skips_endpoint(clock):
+    router = make_router("flaky", "backup", failure_threshold=2, cooldown_seconds=30)
+    warm_up(router, "flaky", ttft=0.1)
+    warm_up(router, "backup", ttft=1.0)
+    flaky = endpoint(router, "flaky")
+
+    for _ in range(2):
+        target = router.acquire()
+        assert target is flaky
+        router.release_failure(target, RuntimeError("timeout"))
+
+    assert flaky.circuit == CIRCUIT_OPEN
+    chosen = router.acquire()
+    assert chosen.name == "backup"
+    router.release_success(chosen, 1.0, 1000, 10.0)
+
+
+def test_half_open_probe_failure_reopens_circuit(clock):
+    router = make_router("flaky", "backup", failure_threshold=1, cooldown_seconds=30)
+    warm_up(router, "flaky", ttft=0.1)
+    warm_up(router, "backup", ttft=1.0)
+    flaky = endpoint(router, "flaky")
+    router.release_failure(router.acquire(), RuntimeError("down"))
+    assert flaky.circuit == CIRCUIT_OPEN
+
+    clock.now += 31
+    probe = router.acquire()
+    assert probe is flaky and flaky.circuit == CIRCUIT_HALF_OPEN
+    # 探测请求执行期间不再放行第二个请求
+    assert router.acquire().name == "backup"
+
+    router.release_failure(probe, RuntimeError("still down"))
+    assert flaky.circuit == CIRCUIT_OPEN
+    assert flaky.open_until == pytest.approx(clock.now + 30)
+
+
+def test_half_open_probe_success_closes_circuit(clock):
+    router = make_router("flaky", "backup", failure_threshold=1, cooldown_seconds=30)
+    warm_up(router, "flaky", ttft=0.1)
+    warm_up(router, "backup", ttft=1.0)
+    flaky = endpoint(router, "flaky")
+    router.release_failure(router.acquire(), RuntimeError("down"))
+
+    clock.now += 31
+    probe = router.acquire()
+    router.release_success(probe, 0.1, 1000, 10.0)
+
+    assert flaky.circuit == CIRCUIT_CLOSED
+    assert flaky.consecutive_failures == 0
+    assert router.acquire() is flaky
+
+
+def test_all_circuits_open_falls_back_to_earliest_recovery(clock):
+    router = make_router("a", "b", failure_threshold=1, cooldown_seconds=30)
+    a, b = endpoint(router, "a"), endpoint(router, "b")
+    a.in_flight += 1
+    router.release_failure(a, RuntimeError("down"))
+    clock.now += 5
+    b.in_flight += 1
+    router.release_failure(b, RuntimeError("down"))
+
+    chosen = router.acquire()
+    assert chosen is a
+    assert router.get_stats()["recent_decisions"][-1]["reason"] == "all_circuits_open"
+    assert router.acquire(exclude=[a, b]) is None
+
+
+def test_cancelled_request_does_not_change_health(clock):
+    router = make_router("only")
+    target = router.acquire()
+    router.release_cancelled(target)
+
+    assert target.in_flight == 0
+    assert target.failures == 0 and target.circuit == CIRCUIT_CLOSED
+
+
+def test_preferred_does_not_reserve_or_probe(clock):
+    router = make_router("a", "b", failure_threshold=1, cooldown_seconds=30)
+    warm_up(router, "a", ttft=0.1)
+    warm_up(router, "b", ttft=1.0)
+    a = endpoint(router, "a")
+    router.release_failure(router.acquire(), RuntimeError("down"))
+
+    assert router.preferred().name == "b"
+    clock.now += 31
+    assert router.preferred() is a
+    # 只读：不占用并发计数、不切换为半开、不记录路由决策
+    assert a.in_flight == 0 and a.circuit == CIRCUIT_OPEN
+    assert len(router.get_stats()["recent_decisions"]) == 1
+
+
+def test_acquire_prefers_requested_model_then_fails_over_across_models():
+    endpoints = [
+        LLMEndpoint("http://127.0.0.1:9/a", "key", "model-a", name="a"),
+        LLMEndpoint("http://127.0.0.1:9/b", "key", "model-b", name="b"),
+    ]
+    router = LLMRouter(endpoints)
+    warm_up(router, "a", ttft=0.1)
+    warm_up(router, "b", ttft=1.0)
+
+    first = router.acquire(model="model-b")
+    assert first.name == "b"
+    router.release_failure(first, RuntimeError("boom"))
+    assert router.acquire(exclude=[first]).name == "a"
+
+
+def test_strict_acquire_stays_on_requested_model():
+    endpoints = [
+        LLMEndpoint("http://127.0.0.1:9/a", "key", "model-a", name="a"),
+        LLMEndpoint("http://127.0.0.1:9/b", "key", "model-b", name="b"),
+    ]
+    router = LLMRouter(endpoints)
+
+    first = router.acquire(model="model-b", strict=True)
+    assert first.name == "b"
+    router.release_failure(first, RuntimeError("boom"))
+    # 该模型已无可用端点：不占用其他模型的端点，由调用方换到其他模型重新排队
+    assert router.acquire(exclude=[first], model="model-b", strict=True) is None
+    assert endpoint(router, "a").in_flight == 0
+    assert router.preferred(exclude=[first]).name == "a"
@@ -0,0 +1,226 @@
+# 文件名：test_ocr_client.py
+"""
+功能说明：OCRClient 分片识别测试
+说明：在本地启动 TextIn pdf_to_markdown 替身服务（按 page_start / page_count 返回页窗口），
+      通过 api_url 指向替身，验证分片拆分、并发请求、失败分片重试与非 PDF 退化
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from app.utils.ocr_client import OCRClient
+
+
+def make_pdf(pages: int, declared_count: int = None) -> bytes:
+    """
+    构造最小的 PDF 结构：页树 /Count 与逐页 /Type /Page 对象（替身服务不解析内容）
+    :param declared_count: 页树声明的页数（默认与实际页数一致）
+    """
+    count = pages if declared_count is None else declared_count
+    parts = [b"%PDF-1.4\n", b"1 0 obj << /Type /Pages /Count %d /Kids [] >> endobj\n" % count]
+    parts += [b"%d 0 obj << /Type /Page /Parent 1 0 R /Annots [<< /Type /Annot >>] >> endobj\n" % (i + 2) for i in range(pages)]
+    parts.append(b"%%EOF\n")
+    return b"".join(parts)
+
+
+def markdown_of(response_text: str) -> str:
+    payload = json.loads(response_text)
+    assert payload["code"] == 200
+    return payload["result"]["markdown"]
+
+
+class FakeTextIn:
+    """
+    TextIn 替身：记录每次请求的参数，可按 page_start 注入失败
+    """
+
+    def __init__(self, total_pages: int):
+        self.total_pages = total_pages
+        self.requests = []
+        self.failures = {}  # page_start -> 剩余失败次数
+        self.delay = 0.0  # 每次请求的处理耗时（秒）
+        self.active = 0
+        self.peak = 0  # 同时处理中的最大请求数
+        self._lock = threading.Lock()
+
+    def handle_slowly(self, params: dict, body: bytes):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            time.sleep(self.delay)
+            return self.handle(params, body)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def handle(self, params: dict, body: bytes):
+        with self._lock:
+            self.requests.append({"params": params, "size": len(body)})
+            start = params.get("page_start")
+            if start is not None and self.failures.get(int(start), 0) > 0:
+                self.failures[int(start)] -= 1
+                return 500, {"code": 500, "message": "injected failure"}
+        if start is None:
+            return 200, {"code": 200, "message": "success", "result": {"markdown": "whole document", "total_page_number": self.total_pages}}
+        start = int(start)
+        if start >= self.total_pages:
+            return 200, {"code": 40003, "message": "page_start out of range"}
+        count = int(params.get("page_count", self.total_pages))
+        last = min(start + count, self.total_pages) - 1
+        return 200, {"code": 200, "message": "success", "result": {"markdown": f"pages {start}-{last}", "total_page_number": self.total_pages}}
+
+
+@pytest.fixture
+def textin():
+    state = FakeTextIn(total_pages=45)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+            status, payload = state.handle_slowly(params, body)
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state.url = f"http://127.0.0.1:{server.server_address[1]}/pdf_to_markdown"
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(textin):
+    ocr = OCRClient("app-id", "secret", api_url=textin.url, pool_size=4)
+    yield ocr
+    ocr.close()
+
+
+def _windows(textin):
+    return sorted((int(r["params"]["page_start"]), int(r["params"]["page_count"])) for r in textin.requests)
+
+
+def test_sharded_fans_out_page_windows_and_merges_in_order(textin, client):
+    progress = []
+    result = client.recognize_sharded(make_pdf(45), pages_per_shard=20, max_workers=3, progress_callback=lambda done, total: progress.append((done, total)))
+
+    assert _windows(textin) == [(0, 20), (20, 20), (40, 5)]
+    assert markdown_of(result) == "pages 0-19\n\npages 20-39\n\npages 40-44"
+    assert progress[0] == (0, 3) and progress[-1] == (3, 3)
+    # 每个分片都上传完整文件
+    assert {r["size"] for r in textin.requests} == {len(make_pdf(45))}
+
+
+def test_sharded_respects_page_start_and_page_count(textin, client):
+    result = client.recognize_sharded(make_pdf(45), options={"page_start": 10, "page_count": 25}, pages_per_shard=20)
+
+    assert _windows(textin) == [(10, 20), (30, 5)]
+    assert markdown_of(result) == "pages 10-29\n\npages 30-34"
+
+
+def test_sharded_retries_only_failed_shards(textin, client):
+    textin.failures[20] = 1
+    result = client.recognize_sharded(make_pdf(45), pages_per_shard=20, max_retries=2)
+
+    starts = [int(r["params"]["page_start"]) for r in textin.requests]
+    assert sorted(starts) == [0, 20, 20, 40]
+    assert markdown_of(result) == "pages 0-19\n\npages 20-39\n\npages 40-44"
+
+
+def test_sharded_raises_when_retries_exhausted(textin, client):
+    textin.failures[40] = 10
+    with pytest.raises(RuntimeError, match="1 of 3 shards"):
+        client.recognize_sharded(make_pdf(45), pages_per_shard=20, max_retries=1)
+
+    assert [int(r["params"]["page_start"]) for r in textin.requests].count(40) == 2
+
+
+def test_sharded_learns_page_count_from_first_shard(textin, client):
+    # 无法从文件结构统计页数时：先识别首个分片，按响应中的总页数拆分其余分片
+    pdf = b"%PDF-1.5\n" + b"\x00" * 64
+    result = client.recognize_sharded(pdf, pages_per_shard=20)
+
+    assert textin.requests[0]["params"]["page_start"] == "0"
+    assert _windows(textin) == [(0, 20), (20, 20), (40, 5)]
+    assert markdown_of(result) == "pages 0-19\n\npages 20-39\n\npages 40-44"
+
+
+def test_non_pdf_falls_back_to_single_request(textin, client):
+    result = client.recognize_sharded(b"\x89PNG\r\n\x1a\n" + b"\x00" * 32, pages_per_shard=20)
+
+    assert len(textin.requests) == 1
+    assert "page_start" not in textin.requests[0]["params"]
+    assert markdown_of(result) == "whole document"
+
+
+def test_sharded_returns_same_format_as_recognize(textin, client):
+    sharded = json.loads(client.recognize_sharded(make_pdf(45), pages_per_shard=20))
+    whole = json.loads(client.recognize(make_pdf(45)))
+
+    assert sharded.keys() == whole.keys()
+    assert sharded["result"]["total_page_number"] == whole["result"]["total_page_number"] == 45
+
+
+def test_sharded_treats_out_of_range_shards_as_empty(textin, client):
+    # 页树声明的页数偏大（如增量更新残留的旧页树）：超出实际页数的分片不重试、不报错
+    result = client.recognize_sharded(make_pdf(45, declared_count=80), pages_per_shard=20, max_retries=2)
+
+    starts = [int(r["params"]["page_start"]) for r in textin.requests]
+    assert starts.count(60) == 1
+    assert markdown_of(result) == "pages 0-19\n\npages 20-39\n\npages 40-44"
+    assert json.loads(result)["result"]["total_page_number"] == 45
+
+
+def test_page_count_reads_page_tree_not_page_objects():
+    # /Type /Page 与 /Type /Pages 以外的对象不影响页数；以页树根节点的 /Count 为准
+    assert OCRClient._count_pdf_pages(make_pdf(3)) == 3
+    nested = b"%PDF-1.7\n2 0 obj << /Type /Pages /Kids [3 0 R] /Count 2 /Parent 1 0 R >> endobj\n" \
+             b"1 0 obj << /Count 5 /Type /Pages /Kids [2 0 R 4 0 R] >> endobj\n"
+    assert OCRClient._count_pdf_pages(nested) == 5
+    assert OCRClient._count_pdf_pages(b"%PDF-1.5\n" + b"\x00" * 32) == 0
+
+
+def test_sharded_accepts_file_objects_and_releases_mapping(textin, client, tmp_path, monkeypatch):
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(make_pdf(45))
+    buffers = []
+    as_buffer = OCRClient._as_buffer
+    monkeypatch.setattr(OCRClient, "_as_buffer", staticmethod(lambda content: buffers.append(as_buffer(content)) or buffers[-1]))
+    with open(path, "rb") as f:
+        result = client.recognize_sharded(f, pages_per_shard=20)
+
+    assert markdown_of(result) == "pages 0-19\n\npages 20-39\n\npages 40-44"
+    assert len(buffers) == 1 and buffers[0].closed
+
+
+def test_shard_requests_share_the_in_flight_limit(textin):
+    # 两个 OCR 任务各自并发 3 个分片：发往 TextIn 的请求总数仍不超过 max_in_flight
+    textin.delay = 0.05
+    ocr = OCRClient("app-id", "secret", api_url=textin.url, pool_size=8, max_in_flight=2)
+    results = []
+    jobs = [threading.Thread(target=lambda: results.append(ocr.recognize_sharded(make_pdf(45), pages_per_shard=10, max_workers=3))) for _ in range(2)]
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+    ocr.close()
+
+    assert len(textin.requests) == 10
+    assert textin.peak == 2
+    assert [markdown_of(r).count("pages") for r in results] == [5, 5]
+    stats = ocr.get_stats()
+    assert stats["in_flight"] == 0 and stats["max_in_flight"] == 2
@@ -0,0 +1,92 @@
+# 文件名：test_schema_service.py
+"""
+功能说明：索引声明与查询计划校验测试
+说明：使用内存中的 Database 替身（记录 create_index、按预设返回 explain 结果），不连接 MongoDB
+"""
+import pytest
+
+from app.services.schema_service import INDEX_DECLARATIONS, SchemaError, bootstrap_schema, hot_queries
+
+
+class FakeCollection:
+    def __init__(self):
+        self.indexes = {"_id_": {"key": [("_id", 1)]}}
+
+    def index_information(self):
+        return dict(self.indexes)
+
+    def create_index(self, keys, name, **options):
+        self.indexes[name] = dict(key=list(keys), **options)
+        return name
+
+
+class FakeDatabase:
+    """
+    explain 结果按目标集合预设：plans[集合] 为胜出计划，默认走索引且被覆盖
+    """
+
+    def __init__(self, plans=None, docs_examined=0):
+        self.collections = {}
+        self.plans = plans or {}
+        self.docs_examined = docs_examined
+        self.explained = []
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+    def command(self, name, command, verbosity=None):
+        assert name == "explain"
+        collection = next(iter(command.values()))
+        self.explained.append((collection, verbosity))
+        plan = self.plans.get(collection, {"stage": "PROJECTION_COVERED", "inputStage": {"stage": "IXSCAN"}})
+        return {
+            "queryPlanner": {"winningPlan": plan, "rejectedPlans": [{"stage": "COLLSCAN"}]},
+            "executionStats": {"totalDocsExamined": self.docs_examined},
+        }
+
+
+def test_bootstrap_creates_declared_indexes_idempotently():
+    db = FakeDatabase()
+    bootstrap_schema(db)
+    for collection, specs in INDEX_DECLARATIONS.items():
+        assert {spec["name"] for spec in specs} <= set(db[collection].indexes)
+
+    # 再次启动：定义一致，不报错
+    bootstrap_schema(db)
+
+
+def test_bootstrap_rejects_conflicting_index_definition():
+    db = FakeDatabase()
+    spec = INDEX_DECLARATIONS["users"][0]
+    db["users"].indexes[spec["name"]] = {"key": [("username", 1)]}  # 缺少 unique
+    with pytest.raises(SchemaError, match="different definition"):
+        bootstrap_schema(db)
+
+
+def test_bootstrap_verify_passes_when_hot_queries_use_indexes():
+    db = FakeDatabase()
+    bootstrap_schema(db, verify=True)
+    assert len(db.explained) == len(hot_queries())
+    # 覆盖查询以 executionStats 级别执行，其余只取查询计划
+    assert ("analysis_histories", "executionStats") in db.explained
+    assert ("users", "queryPlanner") in db.explained
+
+
+def test_bootstrap_verify_raises_on_collscan():
+    db = FakeDatabase(plans={"usage_logs": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}})
+    with pytest.raises(SchemaError, match="COLLSCAN") as excinfo:
+        bootstrap_schema(db, verify=True)
+    assert "recent usage logs" in str(excinfo.value)
+
+
+def test_bootstrap_verify_raises_when_list_query_fetches_documents():
+    fetch_plan = {"stage": "PROJECTION_SIMPLE", "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}
+    db = FakeDatabase(plans={"analysis_histories": fetch_plan}, docs_examined=11)
+    with pytest.raises(SchemaError, match="not covered"):
+        bootstrap_schema(db, verify=True)
+
+
+def test_bootstrap_verify_raises_when_docs_examined_without_fetch_stage():
+    db = FakeDatabase(docs_examined=3)
+    with pytest.raises(SchemaError, match="docs_examined=3"):
+        bootstrap_schema(db, verify=True)
@@ -1,4 +1,17 @@
 const BASE_URL = import.meta.env.VITE_API_BASE_URL
+const USER_STORAGE_KEY = 'blueprint_user'
+
+// 登录返回的会话令牌随用户信息保存在 localStorage，请求历史记录 / 分析 / 反馈等接口时通过 Authorization 携带
+export const sessionHeaders = () => {
+  try {
+    const user = JSON.parse(localStorage.getItem(USER_STORAGE_KEY) || 'null')
+    if (user && user.session_token) {
+      return { Authorization: `Bearer ${user.session_token}` }
+    }
+  } catch (e) {
+  }
+  return {}
+}
 
 export const login = async (username, fingerprint) => {
   const response = await fetch(`${BASE_URL}/auth/login`, {
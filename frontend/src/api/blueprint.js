@@ -1,3 +1,5 @@
+import { sessionHeaders } from './auth'
+
 const BASE_URL = import.meta.env.VITE_API_BASE_URL
 const SSE_BASE_URL = import.meta.env.VITE_SSE_API_BASE_URL || BASE_URL
 const STREAM_DONE_MARKER = '[[__STREAM_DONE__]]'
@@ -28,12 +30,15 @@ export const analyzeBlueprintStream = async (file, customPrompt, methodologies,
   try {
     const response = await fetch(`${SSE_BASE_URL}/blueprint/analyze`, {
       method: 'POST',
+      headers: sessionHeaders(),
       body: formData,
       signal // 传递 AbortSignal
     })
 
     if (!response.ok) {
-      throw new Error(`HTTP error! status: ${response.status}`)
+      // 会话令牌无效 / 过期等鉴权错误返回 JSON 消息
+      const errorData = await response.json().catch(() => null)
+      throw new Error((errorData && errorData.message) || `HTTP error! status: ${response.status}`)
     }
 
     const reader = response.body.getReader()
@@ -92,7 +97,8 @@ export const getAnalysisHistory = async (userId, page = 1, pageSize = 10) => {
   params.set('page_size', String(pageSize))
 
   const response = await fetch(`${BASE_URL}/blueprint/history?${params.toString()}`, {
-    method: 'GET'
+    method: 'GET',
+    headers: sessionHeaders()
   })
 
   const data = await response.json().catch(() => null)
@@ -110,7 +116,8 @@ export const getAnalysisHistoryDetail = async (userId, historyId) => {
   params.set('user_id', userId)
 
   const response = await fetch(`${BASE_URL}/blueprint/history/${historyId}?${params.toString()}`, {
-    method: 'GET'
+    method: 'GET',
+    headers: sessionHeaders()
   })
 
   const data = await response.json().catch(() => null)
@@ -1,10 +1,13 @@
+import { sessionHeaders } from './auth'
+
 const BASE_URL = import.meta.env.VITE_API_BASE_URL
 
 export const submitFeedback = async (userId, username, content) => {
   const response = await fetch(`${BASE_URL}/feedback/submit`, {
     method: 'POST',
     headers: {
-      'Content-Type': 'application/json'
+      'Content-Type': 'application/json',
+      ...sessionHeaders()
     },
     body: JSON.stringify({ user_id: userId, username, content })
   })